@@ -0,0 +1,78 @@
+from __future__ import print_function, absolute_import
+import argparse
+import time
+
+import numpy as np
+
+from reid.index import BinaryIndex, exact_search, recall_at_k
+
+
+def synthetic_features(centers, num_samples, noise, rng):
+    # Samples scattered around the centers of random identities
+    labels = rng.randint(len(centers), size=num_samples)
+    noise = noise * rng.randn(num_samples, centers.shape[1])
+    return (centers[labels] + noise).astype(np.float32)
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    if args.gallery_file:
+        gallery = np.load(args.gallery_file).astype(np.float32)
+        query = np.load(args.query_file).astype(np.float32)
+    else:
+        centers = rng.randn(args.num_identities, args.dim)
+        gallery = synthetic_features(centers, args.num_gallery, args.noise,
+                                     rng)
+        query = synthetic_features(centers, args.num_query, args.noise, rng)
+    print("{} queries, {} gallery samples of dim {}"
+          .format(len(query), len(gallery), gallery.shape[1]))
+
+    start = time.time()
+    _, exact_indices = exact_search(query, gallery, args.topk)
+    exact_time = time.time() - start
+    print("Float search: {:.2f}s, {:.3g} candidates/s"
+          .format(exact_time, len(query) * len(gallery) / exact_time))
+
+    for method in args.methods:
+        index = BinaryIndex(num_bits=args.num_bits, method=method,
+                            shortlist=0, seed=args.seed)
+        start = time.time()
+        index.train(gallery)
+        index.add(gallery)
+        print("\n{} codes of {} bytes, built in {:.2f}s"
+              .format(method, index.bytes_per_vector, time.time() - start))
+        print("{:>10}{:>12}{:>12}{:>12}{:>14}".format(
+            'shortlist', 'recall@1', 'recall@{}'.format(args.topk),
+            'time (s)', 'candidates/s'))
+        for shortlist in [0] + args.shortlists:
+            start = time.time()
+            # Shortlist 0 ranks by Hamming distance alone
+            _, indices = index.search(
+                query, args.topk,
+                shortlist=max(shortlist, args.topk) if shortlist else 0)
+            search_time = time.time() - start
+            print("{:>10}{:>12.3f}{:>12.3f}{:>12.2f}{:>14.3g}".format(
+                shortlist or '-', recall_at_k(indices, exact_indices, 1),
+                recall_at_k(indices, exact_indices), search_time,
+                len(query) * len(gallery) / search_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Binary hash benchmark")
+    parser.add_argument('--gallery-file', type=str, default='',
+                        metavar='PATH', help="npy gallery features, "
+                        "default: synthetic clusters")
+    parser.add_argument('--query-file', type=str, default='', metavar='PATH')
+    parser.add_argument('--num-gallery', type=int, default=100000)
+    parser.add_argument('--num-query', type=int, default=1000)
+    parser.add_argument('--num-identities', type=int, default=5000)
+    parser.add_argument('--dim', type=int, default=2048)
+    parser.add_argument('--noise', type=float, default=0.5)
+    parser.add_argument('--num-bits', type=int, default=256)
+    parser.add_argument('--methods', type=str, nargs='+',
+                        default=['sign', 'itq'], choices=['sign', 'itq'])
+    parser.add_argument('--shortlists', type=int, nargs='+',
+                        default=[100, 500, 2000])
+    parser.add_argument('-k', '--topk', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,71 @@
+from __future__ import print_function, absolute_import
+import argparse
+import time
+
+import numpy as np
+
+from reid.index import IVFIndex, exact_search, recall_at_k
+
+
+def synthetic_features(centers, num_samples, noise, rng):
+    # Samples scattered around the centers of random identities
+    labels = rng.randint(len(centers), size=num_samples)
+    noise = noise * rng.randn(num_samples, centers.shape[1])
+    return (centers[labels] + noise).astype(np.float32)
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    if args.gallery_file:
+        gallery = np.load(args.gallery_file).astype(np.float32)
+        query = np.load(args.query_file).astype(np.float32)
+    else:
+        centers = rng.randn(args.num_identities, args.dim)
+        gallery = synthetic_features(centers, args.num_gallery, args.noise,
+                                     rng)
+        query = synthetic_features(centers, args.num_query, args.noise, rng)
+    print("{} queries, {} gallery samples of dim {}"
+          .format(len(query), len(gallery), gallery.shape[1]))
+
+    start = time.time()
+    _, exact_indices = exact_search(query, gallery, args.topk)
+    exact_time = time.time() - start
+    print("Exact search: {:.2f}s".format(exact_time))
+
+    index = IVFIndex(num_lists=args.num_lists, seed=args.seed)
+    start = time.time()
+    index.train(gallery)
+    index.add(gallery)
+    print("IVF build with {} lists: {:.2f}s"
+          .format(len(index.centroids), time.time() - start))
+
+    print("{:>8}{:>12}{:>12}{:>12}{:>10}".format(
+        'probes', 'recall@1', 'recall@{}'.format(args.topk), 'time (s)',
+        'speedup'))
+    for num_probes in args.num_probes:
+        start = time.time()
+        _, indices = index.search(query, args.topk, num_probes=num_probes)
+        search_time = time.time() - start
+        print("{:>8}{:>12.3f}{:>12.3f}{:>12.2f}{:>9.1f}x".format(
+            num_probes, recall_at_k(indices, exact_indices, 1),
+            recall_at_k(indices, exact_indices), search_time,
+            exact_time / search_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gallery index benchmark")
+    parser.add_argument('--gallery-file', type=str, default='',
+                        metavar='PATH', help="npy gallery features, "
+                        "default: synthetic clusters")
+    parser.add_argument('--query-file', type=str, default='', metavar='PATH')
+    parser.add_argument('--num-gallery', type=int, default=100000)
+    parser.add_argument('--num-query', type=int, default=2000)
+    parser.add_argument('--num-identities', type=int, default=5000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--noise', type=float, default=0.5)
+    parser.add_argument('--num-lists', type=int, default=1024)
+    parser.add_argument('--num-probes', type=int, nargs='+',
+                        default=[1, 4, 16, 64])
+    parser.add_argument('-k', '--topk', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,83 @@
+from __future__ import print_function, absolute_import
+import argparse
+import time
+
+import numpy as np
+
+from reid.index import PQIndex, exact_search, recall_at_k
+
+
+def synthetic_features(centers, num_samples, noise, rng):
+    # Samples scattered around the centers of random identities
+    labels = rng.randint(len(centers), size=num_samples)
+    noise = noise * rng.randn(num_samples, centers.shape[1])
+    return (centers[labels] + noise).astype(np.float32)
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    if args.gallery_file:
+        gallery = np.load(args.gallery_file).astype(np.float32)
+        query = np.load(args.query_file).astype(np.float32)
+    else:
+        centers = rng.randn(args.num_identities, args.dim)
+        gallery = synthetic_features(centers, args.num_gallery, args.noise,
+                                     rng)
+        query = synthetic_features(centers, args.num_query, args.noise, rng)
+    print("{} queries, {} gallery samples of dim {}"
+          .format(len(query), len(gallery), gallery.shape[1]))
+
+    start = time.time()
+    _, exact_indices = exact_search(query, gallery, args.topk)
+    exact_time = time.time() - start
+    print("Exact search: {:.2f}s".format(exact_time))
+
+    index = PQIndex(num_subspaces=args.num_subspaces,
+                    num_centroids=args.num_centroids, shortlist=args.topk,
+                    max_train_samples=args.max_train_samples,
+                    seed=args.seed)
+    start = time.time()
+    index.train(gallery)
+    index.add(gallery)
+    print("PQ build with {} subspaces: {:.2f}s"
+          .format(args.num_subspaces, time.time() - start))
+    print("Memory per vector: {} bytes of codes vs {} bytes of float32 "
+          "({:.0f}x smaller)".format(index.bytes_per_vector,
+                                     gallery[0].nbytes,
+                                     gallery[0].nbytes /
+                                     float(index.bytes_per_vector)))
+
+    print("{:>10}{:>12}{:>12}{:>12}{:>10}".format(
+        'shortlist', 'recall@1', 'recall@{}'.format(args.topk), 'time (s)',
+        'speedup'))
+    for shortlist in args.shortlists:
+        start = time.time()
+        _, indices = index.search(query, args.topk,
+                                  shortlist=max(shortlist, args.topk))
+        search_time = time.time() - start
+        print("{:>10}{:>12.3f}{:>12.3f}{:>12.2f}{:>9.1f}x".format(
+            shortlist, recall_at_k(indices, exact_indices, 1),
+            recall_at_k(indices, exact_indices), search_time,
+            exact_time / search_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Product quantization "
+                                     "benchmark")
+    parser.add_argument('--gallery-file', type=str, default='',
+                        metavar='PATH', help="npy gallery features, "
+                        "default: synthetic clusters")
+    parser.add_argument('--query-file', type=str, default='', metavar='PATH')
+    parser.add_argument('--num-gallery', type=int, default=100000)
+    parser.add_argument('--num-query', type=int, default=1000)
+    parser.add_argument('--num-identities', type=int, default=5000)
+    parser.add_argument('--dim', type=int, default=2048)
+    parser.add_argument('--noise', type=float, default=0.5)
+    parser.add_argument('--num-subspaces', type=int, default=64)
+    parser.add_argument('--num-centroids', type=int, default=256)
+    parser.add_argument('--max-train-samples', type=int, default=20000)
+    parser.add_argument('--shortlists', type=int, nargs='+',
+                        default=[100, 200, 500, 1000])
+    parser.add_argument('-k', '--topk', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    main(parser.parse_args())
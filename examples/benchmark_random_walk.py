@@ -0,0 +1,70 @@
+from __future__ import print_function, absolute_import
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from reid.models.multi_branch import random_walk
+
+
+def per_query_inverse(affinity, scores, alpha):
+    # Propagation one query at a time through an explicit inverse, as done
+    # before the batched operator
+    outputs = []
+    one_diag = torch.eye(affinity.size(1))
+    for A, p_g_score in zip(affinity, scores):
+        A = (1 - alpha) * torch.inverse(one_diag - alpha * A)
+        A = A.transpose(0, 1)
+        p_g_score = torch.matmul(p_g_score.permute(2, 0, 1), A).permute(1, 2, 0)
+        outputs.append(p_g_score.contiguous())
+    return torch.stack(outputs, 0)
+
+
+def benchmark(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    return (time.time() - start) / repeat, out
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    g_g_score = torch.randn(args.num_queries, args.topk, args.topk, 2)
+    affinity = F.softmax(g_g_score[:, :, :, 1], dim=2)
+    p_g_score = torch.randn(args.num_queries, args.num_probes, args.topk, 2)
+
+    print("{} queries, top-{} gallery, alpha {}, {} threads on CPU"
+          .format(args.num_queries, args.topk, args.alpha, args.threads))
+    base_time, base = benchmark(
+        lambda: per_query_inverse(affinity, p_g_score, args.alpha),
+        args.repeat)
+    print("{:>16}  {:9.2f} ms".format('per-query', base_time * 1000))
+    for solver in ('inverse', 'solve', 'series'):
+        solver_time, out = benchmark(
+            lambda: random_walk(affinity, p_g_score, args.alpha,
+                                solver=solver, num_terms=args.num_terms),
+            args.repeat)
+        print("{:>16}  {:9.2f} ms  speedup {:6.2f}x  max abs diff {:.2e}"
+              .format('batched ' + solver, solver_time * 1000,
+                      base_time / solver_time, (out - base).abs().max()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Random walk propagation benchmark")
+    parser.add_argument('-q', '--num-queries', type=int, default=1024)
+    parser.add_argument('-k', '--topk', type=int, default=75)
+    parser.add_argument('--num-probes', type=int, default=1,
+                        help="rows propagated per query, e.g. 1 at test "
+                             "time, probes plus gallery while training")
+    parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--num-terms', type=int, default=None,
+                        help="terms of the series solver, default: enough "
+                             "for a 1e-6 residual")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    main(parser.parse_args())
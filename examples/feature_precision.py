@@ -0,0 +1,104 @@
+from __future__ import print_function, absolute_import
+import argparse
+import os.path as osp
+import time
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from reid import datasets
+from reid import models
+from reid.evaluators import (extract_features, evaluate_all,
+                             quantize_features, quantized_pairwise_distance)
+from reid.utils.data import transforms as T
+from reid.utils.data.preprocessor import Preprocessor
+from reid.utils.serialization import load_checkpoint, copy_state_dict
+
+
+def get_data(name, split_id, data_dir, height, width, batch_size, workers):
+    root = osp.join(data_dir, name)
+    dataset = datasets.create(name, root, split_id=split_id)
+
+    normalizer = T.Normalize(mean=[0.485, 0.456, 0.406],
+                             std=[0.229, 0.224, 0.225])
+    test_transformer = T.Compose([
+        T.RectScale(height, width),
+        T.ToTensor(),
+        normalizer,
+    ])
+    test_loader = DataLoader(
+        Preprocessor(list(set(dataset.query) | set(dataset.gallery)),
+                     root=dataset.images_dir, transform=test_transformer),
+        batch_size=batch_size, num_workers=workers,
+        shuffle=False, pin_memory=True)
+    return dataset, test_loader
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    dataset, test_loader = get_data(args.dataset, args.split, args.data_dir,
+                                    args.height, args.width, args.batch_size,
+                                    args.workers)
+
+    model = models.create(args.arch, cut_at_pooling=True)
+    if args.resume:
+        checkpoint = load_checkpoint(args.resume)
+        copy_state_dict(checkpoint['state_dict'], model, strip=args.strip)
+    model = nn.DataParallel(model).cuda()
+    features, _ = extract_features(model, test_loader)
+
+    results = []
+    for mode in args.modes:
+        print("\n{} features:".format(mode))
+        start = time.time()
+        quantized = quantize_features(features, dataset.query,
+                                      dataset.gallery, mode=mode)
+        quantize_time = time.time() - start
+        start = time.time()
+        distmat = quantized_pairwise_distance(
+            quantized, dataset.query, dataset.gallery,
+            block_size=args.block_size)
+        distance_time = time.time() - start
+        _, mAP = evaluate_all(distmat, query=dataset.query,
+                              gallery=dataset.gallery, dataset=args.dataset)
+        results.append((mode, quantized.bytes_per_vector, quantized.nbytes,
+                        quantize_time, distmat.size / distance_time, mAP))
+
+    print("\n{:>8}{:>14}{:>12}{:>14}{:>16}{:>8}{:>10}".format(
+        'mode', 'bytes/vector', 'total MB', 'quantize (s)', 'distances/s',
+        'mAP', 'delta'))
+    base_mAP = results[0][-1]
+    for mode, bytes_per_vector, nbytes, quantize_time, throughput, mAP \
+            in results:
+        print("{:>8}{:>14}{:>12.1f}{:>14.2f}{:>16.3g}{:>8.1%}{:>+10.2%}"
+              .format(mode, bytes_per_vector, nbytes / 2. ** 20,
+                      quantize_time, throughput, mAP, mAP - base_mAP))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Feature precision report")
+    # data
+    parser.add_argument('-d', '--dataset', type=str, default='market1501',
+                        choices=datasets.names())
+    parser.add_argument('-b', '--batch-size', type=int, default=64)
+    parser.add_argument('-j', '--workers', type=int, default=4)
+    parser.add_argument('--split', type=int, default=0)
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=128)
+    # model
+    parser.add_argument('-a', '--arch', type=str, default='resnet50',
+                        choices=models.names())
+    parser.add_argument('--resume', type=str, default='', metavar='PATH')
+    parser.add_argument('--strip', type=str, default='module.base_model.',
+                        help="prefix of the base model in the checkpoint")
+    # modes, the first one being the mAP reference
+    parser.add_argument('--modes', type=str, nargs='+',
+                        default=['float32', 'float16', 'int8'],
+                        choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--seed', type=int, default=1)
+    working_dir = osp.dirname(osp.abspath(__file__))
+    parser.add_argument('--data-dir', type=str, metavar='PATH',
+                        default=osp.join(working_dir, 'data'))
+    main(parser.parse_args())
@@ -108,7 +108,12 @@ def main(args):
     # Net structure: avgpool -> FC(1024) -> FC(args.features)
     base_model = models.create(args.arch, cut_at_pooling=True)
     embed_model = RandomWalkEmbed(instances_num=args.num_instances,
-                            feat_num=2048, num_classes=2)
+                            feat_num=2048, num_classes=2,
+                            tile_size=args.tile_size)
+    num_gallery = args.batch_size // args.num_instances * (args.num_instances - 1)
+    print('Estimated peak memory of the gallery pair grid (not measured): '
+          '{:.2f} GB'.format(embed_model.peak_memory(num_gallery, num_gallery)
+                             / 1024. ** 3))
 
     if args.retrain:
         print('loading base part of pretrained model...')
@@ -187,6 +192,9 @@ def main(args):
     for epoch in range(start_epoch, args.epochs):
         adjust_lr(epoch)
         trainer.train(epoch, train_loader, optimizer)
+        if hasattr(torch.cuda, 'max_memory_allocated'):
+            print('Measured peak GPU memory of training: {:.2f} GB'
+                  .format(torch.cuda.max_memory_allocated() / 1024. ** 3))
         top1, mAP = evaluator.evaluate(val_loader, dataset.val, dataset.val, dataset=args.dataset)
 
         is_best = mAP > best_mAP
@@ -237,6 +245,9 @@ if __name__ == '__main__':
                         choices=models.names())
     parser.add_argument('--features', type=int, default=2048)
     parser.add_argument('--dropout', type=float, default=0.5)
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help="probe rows of the pair grid built at a time "
+                             "by the embed model, default: all")
     # loss
     parser.add_argument('--margin', type=float, default=0.5,
                         help="margin of the triplet loss, default: 0.5")
@@ -129,7 +129,12 @@ def main(args):
         embed_dist_fn=lambda x: F.softmax(Variable(x)).data[:, 0])
     if args.evaluate:
         print("Test:")
-        evaluator.evaluate(test_loader, dataset.query, dataset.gallery, rerank_topk=100, dataset=args.dataset)
+        if len(args.rerank_topk) > 1:
+            evaluator.sweep_rerank_topk(test_loader, dataset.query, dataset.gallery,
+                                        args.rerank_topk, dataset=args.dataset)
+        else:
+            evaluator.evaluate(test_loader, dataset.query, dataset.gallery,
+                               rerank_topk=args.rerank_topk[0], dataset=args.dataset)
         return
 
     # Criterion
@@ -214,6 +219,10 @@ if __name__ == '__main__':
     parser.add_argument('--retrain', type=str, default='', metavar='PATH')
     parser.add_argument('--evaluate', action='store_true',
                         help="evaluation only")
+    parser.add_argument('--rerank-topk', type=int, nargs='+', default=[100],
+                        help="gallery samples re-ranked per query at test "
+                             "time, several values are evaluated from a "
+                             "single second-stage pass")
     parser.add_argument('--epochs', type=int, default=50)
     parser.add_argument('--start_save', type=int, default=0,
                         help="start saving checkpoints after specific epoch")
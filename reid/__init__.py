@@ -3,12 +3,14 @@ from __future__ import absolute_import
 from . import datasets
 from . import evaluation_metrics
 from . import feature_extraction
+from . import index
 from . import loss
 from . import metric_learning
 from . import models
 from . import utils
 from . import dist_metric
 from . import evaluators
+from . import reranking
 from . import trainers
 
 __version__ = '0.2.0'
@@ -1,10 +1,16 @@
 from __future__ import absolute_import
 
 from .classification import accuracy
-from .ranking import cmc, mean_ap
+from .ranking import cmc, mean_ap, RankingContext, PartialRankingContext
+from .sharding import sharded_metrics, sharded_cmc, sharded_mean_ap
 
 __all__ = [
     'accuracy',
     'cmc',
     'mean_ap',
+    'RankingContext',
+    'PartialRankingContext',
+    'sharded_metrics',
+    'sharded_cmc',
+    'sharded_mean_ap',
 ]
@@ -1,27 +1,58 @@
 from __future__ import absolute_import
-from collections import defaultdict
 
 import numpy as np
-from sklearn.metrics import average_precision_score
 
 from ..utils import to_numpy
 
 
-def _unique_sample(ids_dict, num):
-    mask = np.zeros(num, dtype=np.bool)
-    for _, indices in ids_dict.items():
-        i = np.random.choice(indices)
-        mask[i] = True
-    return mask
+def _random_generator(random_state=None):
+    # None for the global numpy random state, an int seed, or a
+    # np.random.RandomState / np.random.Generator
+    if random_state is None:
+        return np.random
+    if isinstance(random_state, (int, np.integer)):
+        return np.random.RandomState(random_state)
+    return random_state
 
 
-def cmc(distmat, query_ids=None, gallery_ids=None,
-        query_cams=None, gallery_cams=None, topk=100,
-        separate_camera_set=False,
-        single_gallery_shot=False,
-        first_match_break=False):
-    distmat = to_numpy(distmat)
-    m, n = distmat.shape
+def _uniform(rng, size):
+    if hasattr(rng, 'random_sample'):
+        return rng.random_sample(size)
+    return rng.random(size)
+
+
+class _IdentityGroups(object):
+    """Gallery indices grouped by identity, to sample one instance of each
+    identity at once."""
+
+    def __init__(self, gallery_ids, mask):
+        members = np.nonzero(mask)[0]
+        order = np.argsort(gallery_ids[members], kind='mergesort')
+        self.members = members[order]
+        self.ids, self.starts, self.sizes = np.unique(
+            gallery_ids[self.members], return_index=True, return_counts=True)
+
+    def find(self, ids):
+        # Group of each id, and whether the id has a group at all
+        cols = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return cols, self.ids[cols] == ids
+
+    def sample(self, rng, size, cols=None):
+        # Sampled gallery indices of shape size + (num groups,), or of shape
+        # size for only the groups in cols, one per leading entry of size
+        if cols is None:
+            starts, sizes = self.starts, self.sizes
+            size = tuple(size) + (len(self.ids),)
+        else:
+            extra = (1,) * (len(size) - 1)
+            starts = self.starts[cols].reshape((-1,) + extra)
+            sizes = self.sizes[cols].reshape((-1,) + extra)
+        offsets = (_uniform(rng, size) * sizes).astype(np.int64)
+        return self.members[starts + offsets]
+
+
+def _fill_defaults(m, n, query_ids=None, gallery_ids=None,
+                   query_cams=None, gallery_cams=None):
     # Fill up default values
     if query_ids is None:
         query_ids = np.arange(m)
@@ -32,84 +63,294 @@ def cmc(distmat, query_ids=None, gallery_ids=None,
     if gallery_cams is None:
         gallery_cams = np.ones(n).astype(np.int32)
     # Ensure numpy array
-    query_ids = np.asarray(query_ids)
-    gallery_ids = np.asarray(gallery_ids)
-    query_cams = np.asarray(query_cams)
-    gallery_cams = np.asarray(gallery_cams)
-    # Sort and find correct matches
-    indices = np.argsort(distmat, axis=1)
-    matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
-    # Compute CMC for each query
-    ret = np.zeros(topk)
-    num_valid_queries = 0
-    for i in range(m):
-        # Filter out the same id and same camera
-        valid = ((gallery_ids[indices[i]] != query_ids[i]) |
-                 (gallery_cams[indices[i]] != query_cams[i]))
-        if separate_camera_set:
-            # Filter out samples from same camera
-            valid &= (gallery_cams[indices[i]] != query_cams[i])
-        if not np.any(matches[i, valid]): continue
-        if single_gallery_shot:
-            repeat = 10
-            gids = gallery_ids[indices[i][valid]]
-            inds = np.where(valid)[0]
-            ids_dict = defaultdict(list)
-            for j, x in zip(inds, gids):
-                ids_dict[x].append(j)
-        else:
-            repeat = 1
-        for _ in range(repeat):
-            if single_gallery_shot:
-                # Randomly choose one instance for each id
-                sampled = (valid & _unique_sample(ids_dict, len(valid)))
-                index = np.nonzero(matches[i, sampled])[0]
-            else:
-                index = np.nonzero(matches[i, valid])[0]
-            delta = 1. / (len(index) * repeat)
-            for j, k in enumerate(index):
-                if k - j >= topk: break
-                if first_match_break:
-                    ret[k - j] += 1
-                    break
-                ret[k - j] += delta
-        num_valid_queries += 1
+    return (np.asarray(query_ids), np.asarray(gallery_ids),
+            np.asarray(query_cams), np.asarray(gallery_cams))
+
+
+def _concat(x):
+    return np.concatenate(x).astype(np.int64) if len(x) > 0 \
+        else np.zeros(0, dtype=np.int64)
+
+
+class RankingContext(object):
+    """Ranks of the correct matches of each query, from the sorted rows.
+
+    Build it once and pass it to :func:`cmc` and :func:`mean_ap` in place of
+    the distance matrix, so that all the metrics share a single sort. Rows
+    are sorted ``block_size`` queries at a time and only the counts at the
+    valid correct matches are kept, the same as in
+    :class:`PartialRankingContext` except that ``neg_lt`` counts the wrong
+    matches sorted before, ties included.
+    """
+
+    def __init__(self, distmat, query_ids=None, gallery_ids=None,
+                 query_cams=None, gallery_cams=None, block_size=256):
+        distmat = to_numpy(distmat)
+        m, n = distmat.shape
+        self.query_ids, self.gallery_ids, self.query_cams, self.gallery_cams = \
+            _fill_defaults(m, n, query_ids, gallery_ids,
+                           query_cams, gallery_cams)
+        self.distmat = distmat
+        rows, pos_le, neg_lt, neg_le, same_cam_neg_lt = [], [], [], [], []
+        self.num_matches = np.zeros(m, dtype=np.int64)
+        for i in range(0, m, block_size):
+            dist = distmat[i:i + block_size]
+            b = len(dist)
+            # Sort and find correct matches
+            indices = np.argsort(dist, axis=1)
+            sorted_dist = np.take_along_axis(dist, indices, axis=1)
+            matches = (self.gallery_ids[indices] ==
+                       self.query_ids[i:i + b, np.newaxis])
+            same_cams = (self.gallery_cams[indices] ==
+                         self.query_cams[i:i + b, np.newaxis])
+            # Filter out the same id and same camera
+            hits = matches > same_cams
+            hit_rows, hit_cols = np.nonzero(hits)
+            self.num_matches[i:i + b] = np.bincount(hit_rows, minlength=b)
+            # Position of the last sample tied with each correct match
+            tie_ends = np.ones((b, n), dtype=bool)
+            tie_ends[:, :-1] = sorted_dist[:, 1:] != sorted_dist[:, :-1]
+            last = np.where(tie_ends, np.arange(n, dtype=np.int32), n - 1)
+            last = np.minimum.accumulate(last[:, ::-1], axis=1)[:, ::-1]
+            last = last[hit_rows, hit_cols]
+            num_neg = np.cumsum(~matches, axis=1, dtype=np.int32)
+            rows.append(hit_rows + i)
+            pos_le.append(np.cumsum(hits, axis=1, dtype=np.int32)[
+                hit_rows, last])
+            neg_lt.append(num_neg[hit_rows, hit_cols])
+            neg_le.append(num_neg[hit_rows, last])
+            same_cam_neg_lt.append(np.cumsum(
+                same_cams > matches, axis=1, dtype=np.int32)[
+                    hit_rows, hit_cols])
+        # One entry per valid correct match, ordered by query then distance
+        self.rows = _concat(rows)
+        self.pos_le = _concat(pos_le)
+        self.neg_lt = _concat(neg_lt)
+        self.neg_le = _concat(neg_le)
+        self.same_cam_neg_lt = _concat(same_cam_neg_lt)
+
+
+def _nearest_sorted(x, k):
+    # The k smallest values of each row, sorted in place
+    if k < x.shape[1]:
+        x.partition(k - 1, axis=1)
+        x = x[:, :k]
+    x.sort(axis=1)
+    return x[:, :k]
+
+
+def _searchsorted_rows(a, v, side='left'):
+    # np.searchsorted of each row of v in the same row of the sorted a, by a
+    # binary search run on all the rows at once
+    rows = np.arange(len(a))[:, np.newaxis]
+    lo = np.zeros(v.shape, dtype=np.int64)
+    hi = np.full(v.shape, a.shape[1], dtype=np.int64)
+    for _ in range(a.shape[1].bit_length()):
+        mid = (lo + hi) // 2
+        values = a[rows, np.minimum(mid, a.shape[1] - 1)]
+        before = values < v if side == 'left' else values <= v
+        active = lo < hi
+        lo = np.where(active & before, mid + 1, lo)
+        hi = np.where(active & ~before, mid, hi)
+    return lo
+
+
+class PartialRankingContext(object):
+    """Ranks of the correct matches of each query, without sorting the rows.
+
+    For every valid correct match, counts the valid wrong matches closer to
+    the query. Queries are processed ``block_size`` at a time: the wrong
+    matches not farther than the farthest correct match of each query are
+    selected from all the rows of the block by ``np.partition`` and sorted,
+    and every correct match is searched among them at once. The work per
+    query is roughly linear in the gallery size. Gives the same mean AP as
+    :class:`RankingContext`, and the same CMC up to the order of samples with
+    tied distances.
+    """
+
+    def __init__(self, distmat, query_ids=None, gallery_ids=None,
+                 query_cams=None, gallery_cams=None, block_size=256):
+        distmat = to_numpy(distmat)
+        # Padded with inf, which integer distances cannot hold
+        if not np.issubdtype(distmat.dtype, np.floating):
+            distmat = distmat.astype(np.float64)
+        m, n = distmat.shape
+        self.query_ids, self.gallery_ids, self.query_cams, self.gallery_cams = \
+            _fill_defaults(m, n, query_ids, gallery_ids,
+                           query_cams, gallery_cams)
+        self.distmat = distmat
+        rows, pos_le, neg_lt, neg_le, same_cam_neg_lt = [], [], [], [], []
+        self.num_matches = np.zeros(m, dtype=np.int64)
+        for i in range(0, m, block_size):
+            dist = distmat[i:i + block_size]
+            matches = (self.gallery_ids ==
+                       self.query_ids[i:i + len(dist), np.newaxis])
+            same_cams = (self.gallery_cams ==
+                         self.query_cams[i:i + len(dist), np.newaxis])
+            hits = matches > same_cams
+            hit_rows, hit_cols = np.nonzero(hits)
+            if len(hit_rows) == 0: continue
+            num_hits = np.bincount(hit_rows, minlength=len(dist))
+            self.num_matches[i:i + len(dist)] = num_hits
+            # Distances of the correct matches, sorted in padded rows
+            hit_dist = dist[hit_rows, hit_cols]
+            order = np.lexsort((hit_dist, hit_rows))
+            starts = np.cumsum(num_hits) - num_hits
+            ranks = np.arange(len(order)) - starts[hit_rows]
+            pos_dist = np.full((len(dist), num_hits.max()), np.inf,
+                               dtype=dist.dtype)
+            pos_dist[hit_rows, ranks] = hit_dist[order]
+            # Select the wrong matches not farther than any correct match
+            farthest = np.full(len(dist), -np.inf, dtype=dist.dtype)
+            has_hits = num_hits > 0
+            farthest[has_hits] = pos_dist[has_hits, num_hits[has_hits] - 1]
+            selected = (dist <= farthest[:, np.newaxis]) > matches
+            same_cam_selected = selected & same_cams
+            num_neg = np.count_nonzero(selected, axis=1)
+            num_same_cam_neg = np.count_nonzero(same_cam_selected, axis=1)
+            neg_dist = _nearest_sorted(np.where(selected, dist, np.inf),
+                                       max(num_neg.max(), 1))
+            same_cam_neg_dist = _nearest_sorted(
+                np.where(same_cam_selected, dist, np.inf),
+                max(num_same_cam_neg.max(), 1))
+            # Padding is inf, so cap the counts of infinite distances
+            cap = (lambda counts, limit:
+                   np.minimum(counts, limit[:, np.newaxis]))
+            valid = np.zeros(pos_dist.shape, dtype=bool)
+            valid[hit_rows, ranks] = True
+            rows.append(hit_rows + i)
+            pos_le.append(cap(_searchsorted_rows(
+                pos_dist, pos_dist, 'right'), num_hits)[valid])
+            neg_lt.append(cap(_searchsorted_rows(
+                neg_dist, pos_dist, 'left'), num_neg)[valid])
+            neg_le.append(cap(_searchsorted_rows(
+                neg_dist, pos_dist, 'right'), num_neg)[valid])
+            same_cam_neg_lt.append(cap(_searchsorted_rows(
+                same_cam_neg_dist, pos_dist, 'left'), num_same_cam_neg)[valid])
+        # One entry per valid correct match, ordered by query then distance
+        self.rows = _concat(rows)
+        self.pos_le = _concat(pos_le)
+        self.neg_lt = _concat(neg_lt)
+        self.neg_le = _concat(neg_le)
+        self.same_cam_neg_lt = _concat(same_cam_neg_lt)
+
+
+def _ranking_context(distmat, query_ids, gallery_ids, query_cams,
+                     gallery_cams):
+    if isinstance(distmat, (RankingContext, PartialRankingContext)):
+        return distmat
+    return RankingContext(distmat, query_ids, gallery_ids,
+                          query_cams, gallery_cams)
+
+
+def _cmc_histogram(rows, ranks, num_hits, topk, first_match_break):
+    # rows and ranks of the correct matches, ordered by query then rank
+    if first_match_break:
+        _, first = np.unique(rows, return_index=True)
+        ranks = ranks[first]
+        return np.bincount(ranks[ranks < topk], minlength=topk)
+    weights = 1. / num_hits[rows]
+    keep = ranks < topk
+    return np.bincount(ranks[keep], weights=weights[keep], minlength=topk)
+
+
+def cmc(distmat, query_ids=None, gallery_ids=None,
+        query_cams=None, gallery_cams=None, topk=100,
+        separate_camera_set=False,
+        single_gallery_shot=False,
+        first_match_break=False,
+        random_state=None):
+    ranking = _ranking_context(distmat, query_ids, gallery_ids,
+                               query_cams, gallery_cams)
+    ret, num_valid_queries = _cmc_counts(
+        ranking, topk, separate_camera_set=separate_camera_set,
+        single_gallery_shot=single_gallery_shot,
+        first_match_break=first_match_break, random_state=random_state)
     if num_valid_queries == 0:
         raise RuntimeError("No valid query")
     return ret.cumsum() / num_valid_queries
 
 
+def _cmc_counts(ranking, topk=100, separate_camera_set=False,
+                single_gallery_shot=False, first_match_break=False,
+                random_state=None):
+    # Returns the CMC histogram before normalization and the number of
+    # valid queries
+    if single_gallery_shot:
+        return _cmc_single_gallery_shot(
+            ranking.distmat, ranking.query_ids, ranking.gallery_ids,
+            ranking.query_cams, ranking.gallery_cams, topk,
+            separate_camera_set, first_match_break, random_state)
+    ranks = ranking.neg_lt
+    if separate_camera_set:
+        # Filter out samples from same camera
+        ranks = ranks - ranking.same_cam_neg_lt
+    ret = _cmc_histogram(ranking.rows, ranks, ranking.num_matches, topk,
+                         first_match_break)
+    return ret, np.count_nonzero(ranking.num_matches)
+
+
+def _cmc_single_gallery_shot(distmat, query_ids, gallery_ids, query_cams,
+                             gallery_cams, topk, separate_camera_set,
+                             first_match_break, random_state=None, repeat=10,
+                             block_size=256):
+    """Randomly choose one valid instance for each gallery identity, and rank
+    the chosen correct match among the chosen ones. All the repeats of a block
+    of queries are sampled at once from identity groups precomputed per
+    query camera."""
+    rng = _random_generator(random_state)
+    ret = np.zeros(topk)
+    num_valid_queries = 0
+    delta = 1. if first_match_break else 1. / repeat
+    all_groups = _IdentityGroups(gallery_ids, np.ones(len(gallery_ids), bool))
+    for cam in np.unique(query_cams):
+        # Correct matches are valid only from the other cameras, and so are
+        # the wrong ones with separate_camera_set
+        cross_groups = _IdentityGroups(gallery_ids, gallery_cams != cam)
+        if len(cross_groups.ids) == 0: continue
+        groups = cross_groups if separate_camera_set else all_groups
+        rows = np.nonzero(query_cams == cam)[0]
+        pos_cols, has_matches = cross_groups.find(query_ids[rows])
+        rows, pos_cols = rows[has_matches], pos_cols[has_matches]
+        own_cols, _ = groups.find(query_ids[rows])
+        num_valid_queries += len(rows)
+        for i in range(0, len(rows), block_size):
+            block = rows[i:i + block_size]
+            b = len(block)
+            sampled = groups.sample(rng, (b, repeat))
+            dist = distmat[block[:, np.newaxis, np.newaxis], sampled]
+            pos = cross_groups.sample(rng, (b, repeat),
+                                      cols=pos_cols[i:i + block_size])
+            pos_dist = distmat[block[:, np.newaxis], pos]
+            closer = dist < pos_dist[:, :, np.newaxis]
+            # Skip the instance sampled for the query identity itself
+            closer[np.arange(b), :, own_cols[i:i + block_size]] = False
+            ranks = np.count_nonzero(closer, axis=2).ravel()
+            ret += np.bincount(ranks[ranks < topk], minlength=topk) * delta
+    return ret, num_valid_queries
+
+
 def mean_ap(distmat, query_ids=None, gallery_ids=None,
             query_cams=None, gallery_cams=None):
-    distmat = to_numpy(distmat)
-    m, n = distmat.shape
-    # Fill up default values
-    if query_ids is None:
-        query_ids = np.arange(m)
-    if gallery_ids is None:
-        gallery_ids = np.arange(n)
-    if query_cams is None:
-        query_cams = np.zeros(m).astype(np.int32)
-    if gallery_cams is None:
-        gallery_cams = np.ones(n).astype(np.int32)
-    # Ensure numpy array
-    query_ids = np.asarray(query_ids)
-    gallery_ids = np.asarray(gallery_ids)
-    query_cams = np.asarray(query_cams)
-    gallery_cams = np.asarray(gallery_cams)
-    # Sort and find correct matches
-    indices = np.argsort(distmat, axis=1)
-    matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
-    # Compute AP for each query
-    aps = []
-    for i in range(m):
-        # Filter out the same id and same camera
-        valid = ((gallery_ids[indices[i]] != query_ids[i]) |
-                 (gallery_cams[indices[i]] != query_cams[i]))
-        y_true = matches[i, valid]
-        y_score = -distmat[i][indices[i]][valid]
-        if not np.any(y_true): continue
-        aps.append(average_precision_score(y_true, y_score))
+    ranking = _ranking_context(distmat, query_ids, gallery_ids,
+                               query_cams, gallery_cams)
+    aps = _average_precisions(ranking)
     if len(aps) == 0:
         raise RuntimeError("No valid query")
     return np.mean(aps)
+
+
+def _average_precisions(ranking):
+    """AP of every query with at least one valid match. Same as sklearn's
+    average_precision_score: samples with equal distance share one
+    threshold, so each match takes the precision at the end of its group of
+    ties."""
+    precision = ranking.pos_le / (ranking.pos_le + ranking.neg_le
+                                  ).astype(np.float64)
+    return _mean_per_query(ranking.rows, precision, ranking.num_matches)
+
+
+def _mean_per_query(rows, values, counts):
+    sums = np.bincount(rows, weights=values, minlength=len(counts))
+    has_values = counts > 0
+    return sums[has_values] / counts[has_values]
@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from .ranking import (RankingContext, PartialRankingContext, _fill_defaults,
+                      _cmc_counts, _average_precisions)
+from ..utils import to_numpy
+
+
+# Read-only distance matrix and ids of the current worker process
+_shared = {}
+
+
+def _init_shard_worker(filename, dtype, shape, offset, ids):
+    _shared['distmat'] = np.memmap(filename, dtype=dtype, mode='r',
+                                   shape=shape, offset=offset)
+    _shared['ids'] = ids
+
+
+def _evaluate_shard(args):
+    shard, start, end, cmc_configs, topk, partial_ranking, seed = args
+    distmat = np.asarray(_shared['distmat'][start:end])
+    query_ids, gallery_ids, query_cams, gallery_cams = _shared['ids']
+    ids = (query_ids[start:end], gallery_ids,
+           query_cams[start:end], gallery_cams)
+    ranking_cls = PartialRankingContext if partial_ranking else RankingContext
+    ranking = ranking_cls(distmat, *ids)
+    aps = _average_precisions(ranking)
+    counts = []
+    for params in cmc_configs:
+        random_state = None
+        if seed is not None:
+            # Seed per shard so that sampled CMC does not depend on workers
+            random_state = np.random.RandomState([seed, shard])
+        counts.append(_cmc_counts(ranking, topk, random_state=random_state,
+                                  **params))
+    return aps, counts
+
+
+def _shared_memmap(distmat):
+    # Reuse the file of a memmap, or dump the matrix into a temporary one
+    if isinstance(distmat, np.memmap) and isinstance(distmat.base, mmap.mmap):
+        distmat.flush()
+        return distmat, None
+    fd, filename = tempfile.mkstemp(suffix='.distmat')
+    os.close(fd)
+    out = np.memmap(filename, dtype=distmat.dtype, mode='w+',
+                    shape=distmat.shape)
+    out[...] = distmat
+    out.flush()
+    return out, filename
+
+
+def sharded_metrics(distmat, query_ids=None, gallery_ids=None,
+                    query_cams=None, gallery_cams=None, cmc_configs=None,
+                    topk=100, partial_ranking=False, num_workers=4,
+                    shard_size=1024, seed=0):
+    """Mean AP and CMC scores computed over query shards by a process pool.
+
+    The distance matrix is shared with the workers through a read-only
+    memmap, reusing the file of ``distmat`` if it is already a memmap, so it
+    is never pickled. Each shard of ``shard_size`` queries returns its APs
+    and un-normalized CMC histograms, which are reduced in shard order.
+    Sampled CMC of each shard is seeded from ``seed`` and the shard index.
+    The results thus depend on ``shard_size`` and ``seed`` but not on
+    ``num_workers``; ``num_workers=0`` runs the shards in this process.
+
+    Returns the mean AP and an OrderedDict of CMC scores, one per entry of
+    ``cmc_configs``, a mapping from name to :func:`cmc` keyword arguments.
+    """
+    distmat = to_numpy(distmat)
+    m, n = distmat.shape
+    ids = _fill_defaults(m, n, query_ids, gallery_ids,
+                         query_cams, gallery_cams)
+    if cmc_configs is None:
+        cmc_configs = OrderedDict()
+    distmat, tmp_file = _shared_memmap(distmat)
+    initargs = (distmat.filename, distmat.dtype.str, distmat.shape,
+                distmat.offset, ids)
+    tasks = [(i, start, min(start + shard_size, m),
+              list(cmc_configs.values()), topk, partial_ranking, seed)
+             for i, start in enumerate(range(0, m, shard_size))]
+    try:
+        if num_workers > 0:
+            pool = Pool(num_workers, _init_shard_worker, initargs)
+            try:
+                results = pool.map(_evaluate_shard, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_shard_worker(*initargs)
+            results = [_evaluate_shard(task) for task in tasks]
+    finally:
+        _shared.clear()
+        if tmp_file is not None:
+            del distmat
+            os.remove(tmp_file)
+
+    aps = np.concatenate([shard_aps for shard_aps, _ in results])
+    if len(aps) == 0:
+        raise RuntimeError("No valid query")
+    cmc_scores = OrderedDict()
+    for j, name in enumerate(cmc_configs):
+        ret, num_valid_queries = np.zeros(topk), 0
+        for _, counts in results:
+            ret = ret + counts[j][0]
+            num_valid_queries += counts[j][1]
+        if num_valid_queries == 0:
+            raise RuntimeError("No valid query")
+        cmc_scores[name] = ret.cumsum() / num_valid_queries
+    return np.mean(aps), cmc_scores
+
+
+def sharded_cmc(distmat, query_ids=None, gallery_ids=None,
+                query_cams=None, gallery_cams=None, topk=100,
+                separate_camera_set=False, single_gallery_shot=False,
+                first_match_break=False, **kwargs):
+    """Same as :func:`cmc`, computed by :func:`sharded_metrics`."""
+    params = dict(separate_camera_set=separate_camera_set,
+                  single_gallery_shot=single_gallery_shot,
+                  first_match_break=first_match_break)
+    _, cmc_scores = sharded_metrics(
+        distmat, query_ids, gallery_ids, query_cams, gallery_cams,
+        cmc_configs=OrderedDict([('cmc', params)]), topk=topk, **kwargs)
+    return cmc_scores['cmc']
+
+
+def sharded_mean_ap(distmat, query_ids=None, gallery_ids=None,
+                    query_cams=None, gallery_cams=None, **kwargs):
+    """Same as :func:`mean_ap`, computed by :func:`sharded_metrics`."""
+    mAP, _ = sharded_metrics(distmat, query_ids, gallery_ids,
+                             query_cams, gallery_cams, **kwargs)
+    return mAP
@@ -1,15 +1,23 @@
 from __future__ import print_function, absolute_import
+import math
+import os
+import tempfile
 import time
 from collections import OrderedDict
 
 import torch
 import numpy as np
+from torch import nn
 from torch.utils.data import DataLoader
 
-from .evaluation_metrics import cmc, mean_ap
-from .feature_extraction import extract_cnn_feature
+from .evaluation_metrics import (cmc, mean_ap, RankingContext,
+                                 PartialRankingContext, sharded_metrics)
+from .feature_extraction import extract_cnn_feature, QuantizedFeatures
+from .models.multi_branch import random_walk
 from .utils.meters import AverageMeter
+from .utils.cache import PairwiseScoreCache
 from .utils import to_numpy
+from .utils.serialization import write_json
 from torch.autograd import Variable
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
@@ -18,32 +26,140 @@ cudnn.benchmark = True
 import pdb
 
 
-def compute_random_walk(model, probe_feature, gallery_feature, i, rerank_topk, alpha):
-    # Compute random walk
-    count = 2048 / (len(model))
-    outputs = []
-    for j in range(len(model)):
-        p_g_score = model[j](Variable(probe_feature[i].view(1, -1)[:,j*count:(j+1)*count].contiguous().cuda(), volatile=True),
-                          Variable(gallery_feature[:,j*count:(j+1)*count].contiguous().cuda(), volatile=True))
-        g_g_score = model[j](Variable(gallery_feature[:,j*count:(j+1)*count].contiguous().cuda(), volatile=True),
-                          Variable(gallery_feature[:,j*count:(j+1)*count].contiguous().cuda(), volatile=True))
-        g_g_score_sm = Variable(g_g_score.data.clone(), requires_grad=False)
-        one_diag = Variable(torch.eye(g_g_score_sm.size(0)), requires_grad=False).cuda()
-        # Row Normalization
-        A = F.softmax(g_g_score_sm[:, :, 1].squeeze())
-        A = (1 - alpha) * torch.inverse(one_diag - alpha * A)
-        A = A.transpose(0, 1)
-        p_g_score = torch.matmul(p_g_score.permute(2, 0, 1), A).permute(1, 2, 0).contiguous()
-        p_g_score = p_g_score.view(-1, 2)
-        p_g_score = p_g_score.contiguous()
-        outputs.append(p_g_score)
-
-    outputs = torch.cat(outputs, 0).view(len(model), -1 ,2)
-    outputs = torch.mean(outputs, 0)
-    #outputs = outputs[1].view(-1 ,2)
+def _as_models(model):
+    # Embedding heads given as a sequence or nn.ModuleList, or a single model
+    if isinstance(model, (list, tuple, nn.ModuleList)):
+        return list(model)
+    return [model]
+
+
+def _cached_gallery_scores(model, gallery_x, gallery_indices, score_cache,
+                           group=0):
+    # Gallery-gallery scores, computing only the pairs missing in the cache
+    k = len(gallery_indices)
+    found, cached = score_cache.lookup(group, gallery_indices, gallery_indices)
+    missing_a, missing_b = np.nonzero(~found)
+    new_scores = None
+    if len(missing_a) > 0:
+        index_a = torch.from_numpy(missing_a).long()
+        index_b = torch.from_numpy(missing_b).long()
+        if gallery_x.data.is_cuda:
+            index_a, index_b = index_a.cuda(), index_b.cuda()
+        pair_forward = getattr(model, 'pair_forward', model)
+        new_scores = pair_forward(
+            gallery_x.index_select(0, Variable(index_a)),
+            gallery_x.index_select(0, Variable(index_b)))
+        new_scores = to_numpy(new_scores.data)
+        if new_scores.ndim == 3:
+            # Grouped embedding, pairs first
+            new_scores = new_scores.transpose(1, 0, 2)
+        indices = np.asarray(gallery_indices)
+        score_cache.update(group, indices[missing_a], indices[missing_b],
+                           new_scores)
+    shape = (cached if new_scores is None else new_scores).shape[1:]
+    scores = np.zeros((k, k) + shape, dtype=np.float32)
+    if cached is not None:
+        scores[found] = cached
+    if new_scores is not None:
+        scores[missing_a, missing_b] = new_scores
+    # Group first: (G, K, K, C)
+    if scores.ndim == 3:
+        scores = scores[np.newaxis]
+    else:
+        scores = scores.transpose(2, 0, 1, 3)
+    scores = torch.from_numpy(np.ascontiguousarray(scores))
+    return Variable(scores.type_as(gallery_x.data), volatile=True)
+
+
+def _random_walk_scores(models, probe_feature, gallery_feature,
+                        gallery_indices=None, score_cache=None):
+    # Probe-gallery (G x B x 1 x K x C) and gallery-gallery (G x B x K x K x C)
+    # scores of B probes (B x D) and their own top-k gallery samples
+    # (B x K x D), for G embedding groups. Each model scores its own slice of
+    # the features, and a grouped embedding all of its groups at once.
+    B, K, D = gallery_feature.size()
+    count = D // len(models)
+    use_cuda = next(models[0].parameters()).is_cuda
+    p_g_scores, g_g_scores = [], []
+    for j in range(len(models)):
+        probe_x = probe_feature[:, j*count:(j+1)*count].contiguous()
+        gallery_x = gallery_feature[:, :, j*count:(j+1)*count].contiguous()
+        if use_cuda:
+            probe_x, gallery_x = probe_x.cuda(), gallery_x.cuda()
+        probe_x = Variable(probe_x, volatile=True)
+        gallery_x = Variable(gallery_x, volatile=True)
+        pair_forward = getattr(models[j], 'pair_forward', models[j])
+        p_g_score = pair_forward(
+            probe_x.unsqueeze(1).expand(B, K, count).contiguous().view(-1, count),
+            gallery_x.view(-1, count))
+        p_g_scores.append(p_g_score.view(-1, B, 1, K, p_g_score.size(-1)))
+        g_g_score = []
+        for b in range(B):
+            if score_cache is None:
+                score = models[j](gallery_x[b], gallery_x[b])
+            else:
+                score = _cached_gallery_scores(
+                    models[j], gallery_x[b], gallery_indices[b], score_cache, j)
+            g_g_score.append(score.view(-1, K, K, score.size(-1)))
+        g_g_scores.append(torch.stack(g_g_score, 1))
+    return torch.cat(p_g_scores, 0), torch.cat(g_g_scores, 0)
+
+
+def compute_random_walk_batch(model, probe_feature, gallery_feature, alpha,
+                              gallery_indices=None, score_cache=None,
+                              solver='solve'):
+    # Random walk scores of B probes against their own top-k gallery samples,
+    # propagated by one batched operator over all the groups
+    models = _as_models(model)
+    B, K, _ = gallery_feature.size()
+    p_g_score, g_g_score = _random_walk_scores(
+        models, probe_feature, gallery_feature, gallery_indices, score_cache)
+    G, C = p_g_score.size(0), p_g_score.size(-1)
+    # Row Normalization
+    A = F.softmax(g_g_score[..., 1], dim=-1).view(G * B, K, K)
+    outputs = random_walk(A, p_g_score.view(G * B, 1, K, C), alpha,
+                          solver=solver)
+
+    return outputs.view(G, B, K, C).mean(0)
+
+
+def random_walk_sweep(affinity, scores, alphas):
+    """Random walk propagation of numpy ``scores`` for several alphas.
+
+    Same as :func:`reid.models.multi_branch.random_walk` on (B, K, K)
+    ``affinity`` and (B, N, K, C) ``scores``, for each of ``alphas`` in
+    [0, 1). The eigendecomposition ``affinity = V diag(w) V^-1`` is computed
+    once, after which ``(1 - alpha) * inverse(I - alpha * affinity)`` is
+    ``V diag((1 - alpha) / (1 - alpha * w)) V^-1`` and every alpha costs a
+    batch of matrix products. Returns an array of shape
+    (len(alphas), B, N, K, C).
+    """
+    B, N, K, C = scores.shape
+    w, V = np.linalg.eig(affinity.astype(np.float64))
+    # Scores in the eigenbasis, gallery axis first: (B, K, N * C)
+    x = scores.transpose(0, 2, 1, 3).reshape(B, K, N * C)
+    x = np.linalg.solve(V, x.astype(V.dtype))
+    outputs = np.empty((len(alphas), B, N, K, C), dtype=scores.dtype)
+    for i, alpha in enumerate(alphas):
+        gain = (1 - alpha) / (1 - alpha * w)
+        out = np.matmul(V, gain[:, :, np.newaxis] * x).real
+        outputs[i] = out.reshape(B, K, N, C).transpose(0, 2, 1, 3)
     return outputs
 
 
+def compute_random_walk(model, probe_feature, gallery_feature, i, rerank_topk,
+                        alpha, gallery_indices=None, score_cache=None,
+                        solver='solve'):
+    # Compute random walk
+    if gallery_indices is not None:
+        gallery_indices = [gallery_indices]
+    outputs = compute_random_walk_batch(
+        model, probe_feature[i].view(1, -1), gallery_feature.unsqueeze(0),
+        alpha, gallery_indices=gallery_indices, score_cache=score_cache,
+        solver=solver)
+    return outputs[0]
+
+
 def pairwise_similarity_score(model, probe_feature, gallery_feature, i):
     p_g_score = model(Variable(probe_feature[i].view(1, -1).cuda(), volatile=True),
                         Variable(gallery_feature.cuda(), volatile=True))
@@ -51,33 +167,175 @@ def pairwise_similarity_score(model, probe_feature, gallery_feature, i):
     return p_g_score
 
 
-def extract_embeddings(model, features, alpha, query=None, topk_gallery=None, rerank_topk=0, print_freq=500):
-    # for i in model:
-    #     i.eval()
+def _random_walk_batches(models, features, query, topk_gallery,
+                         score_cache=None, batch_size=64, print_freq=10):
+    # Yield the probe and top-k gallery features of each batch of queries
+    for m in models:
+        m.eval()
+    batch_time = AverageMeter()
+    data_time = AverageMeter()
+
+    end = time.time()
+    # Index the gallery samples for the score cache
+    gallery_index = OrderedDict()
+    for topk in topk_gallery:
+        for f, _, _ in topk:
+            gallery_index.setdefault(f, len(gallery_index))
+    probe_feature = torch.cat([features[f].view(1, -1) for f, _, _ in query], 0)
+    num_batches = int(math.ceil(len(query) / float(batch_size)))
+    for i, start in enumerate(range(0, len(query), batch_size)):
+        end_i = min(start + batch_size, len(query))
+        gallery_feature = torch.stack([
+            torch.cat([features[f].view(1, -1) for f, _, _ in topk_gallery[q]], 0)
+            for q in range(start, end_i)], 0)
+        gallery_indices = [[gallery_index[f] for f, _, _ in topk_gallery[q]]
+                           for q in range(start, end_i)]
+        data_time.update(time.time() - end)
+
+        yield (start, end_i, probe_feature[start:end_i], gallery_feature,
+               gallery_indices)
+        batch_time.update(time.time() - end)
+        end = time.time()
+
+        if (i + 1) % print_freq == 0:
+            print('Extract Embedding: [{}/{}]\t'
+                  'Time {:.3f} ({:.3f})\t'
+                  'Data {:.3f} ({:.3f})\t'
+                  .format(i + 1, num_batches,
+                          batch_time.val, batch_time.avg,
+                          data_time.val, data_time.avg))
+
+    if score_cache is not None:
+        print('Gallery score cache: {} hits, {} misses, {} entries'
+              .format(score_cache.hits, score_cache.misses, len(score_cache)))
+
+
+def extract_random_walk_embeddings(model, features, alpha, query=None,
+                                   topk_gallery=None, rerank_topk=0,
+                                   print_freq=10, score_cache=None,
+                                   batch_size=64, solver='solve'):
+    models = _as_models(model)
+    pairwise_score = torch.zeros(len(query), rerank_topk, 2).cuda()
+    for start, end, probe_feature, gallery_feature, gallery_indices in \
+            _random_walk_batches(models, features, query, topk_gallery,
+                                 score_cache, batch_size, print_freq):
+        pairwise_score[start:end] = compute_random_walk_batch(
+            models, probe_feature, gallery_feature, alpha,
+            gallery_indices=gallery_indices, score_cache=score_cache,
+            solver=solver).data
+    return Variable(pairwise_score.view(-1, 2))
+
+
+def extract_random_walk_sweep(model, features, alphas, query=None,
+                              topk_gallery=None, rerank_topk=0,
+                              print_freq=10, score_cache=None,
+                              batch_size=64):
+    # Random walk embeddings for every alpha out of a single scoring pass
+    models = _as_models(model)
+    pairwise_score = np.zeros((len(alphas), len(query), rerank_topk, 2),
+                              dtype=np.float32)
+    for start, end, probe_feature, gallery_feature, gallery_indices in \
+            _random_walk_batches(models, features, query, topk_gallery,
+                                 score_cache, batch_size, print_freq):
+        p_g_score, g_g_score = _random_walk_scores(
+            models, probe_feature, gallery_feature, gallery_indices,
+            score_cache)
+        G, B, _, K, C = p_g_score.size()
+        # Row Normalization
+        A = F.softmax(g_g_score[..., 1], dim=-1).view(G * B, K, K)
+        p_g_score = random_walk_sweep(to_numpy(A.data),
+                                      to_numpy(p_g_score.view(G * B, 1, K, C).data),
+                                      alphas)
+        pairwise_score[:, start:end] = \
+            p_g_score.reshape(len(alphas), G, B, K, C).mean(axis=1)
+    return [Variable(torch.from_numpy(score).cuda().view(-1, 2))
+            for score in pairwise_score]
+
+
+def extract_random_walk_topk_sweep(model, features, alpha, rerank_topks,
+                                   query=None, topk_gallery=None,
+                                   print_freq=10, score_cache=None,
+                                   batch_size=64, solver='solve'):
+    # Random walk embeddings over the first k of the top-k gallery samples
+    # for every k, scoring the pairs of the largest k only once
+    models = _as_models(model)
+    pairwise_score = [torch.zeros(len(query), k, 2).cuda()
+                      for k in rerank_topks]
+    for start, end, probe_feature, gallery_feature, gallery_indices in \
+            _random_walk_batches(models, features, query, topk_gallery,
+                                 score_cache, batch_size, print_freq):
+        p_g_score, g_g_score = _random_walk_scores(
+            models, probe_feature, gallery_feature, gallery_indices,
+            score_cache)
+        G, B, _, _, C = p_g_score.size()
+        for k, score in zip(rerank_topks, pairwise_score):
+            # Row Normalization over the top-k gallery samples
+            A = F.softmax(g_g_score[:, :, :k, :k, 1].contiguous(), dim=-1)
+            outputs = random_walk(
+                A.view(G * B, k, k),
+                p_g_score[..., :k, :].contiguous().view(G * B, 1, k, C),
+                alpha, solver=solver)
+            score[start:end] = outputs.view(G, B, k, C).mean(0).data
+    return [Variable(score.view(-1, 2)) for score in pairwise_score]
+
+
+def extract_embeddings(model, features, alpha, query=None, topk_gallery=None,
+                       rerank_topk=0, print_freq=10, batch_size=64):
     model.eval()
+    use_cuda = next(model.parameters()).is_cuda
     batch_time = AverageMeter()
     data_time = AverageMeter()
 
     end = time.time()
-    pairwise_score = Variable(torch.zeros(len(query), rerank_topk, 2).cuda())
-    probe_feature = torch.cat([features[f].unsqueeze(0) for f, _, _ in query], 0)
-    for i in range(len(query)):
-        gallery_feature = torch.cat([features[f].unsqueeze(0) for f, _, _ in topk_gallery[i]], 0)
-        # pairwise_score[i, :, :] = compute_random_walk(model, probe_feature, gallery_feature, i, rerank_topk, alpha)
-        pairwise_score[i, :, :] = model(Variable(probe_feature[i].view(1, -1).cuda(), volatile=True),
-                                        Variable(gallery_feature.cuda(), volatile=True))
+    # Stack the features of the gallery samples in any top-k only once
+    gallery_index = OrderedDict()
+    for topk in topk_gallery:
+        for f, _, _ in topk:
+            gallery_index.setdefault(f, len(gallery_index))
+    gallery_feature = torch.cat(
+        [features[f].view(1, -1) for f in gallery_index], 0)
+    topk_index = torch.LongTensor(
+        [[gallery_index[f] for f, _, _ in topk] for topk in topk_gallery])
+    probe_feature = torch.cat([features[f].view(1, -1) for f, _, _ in query], 0)
+    num_features = probe_feature.size(1)
+
+    # Score the pairs of batch_size queries and their top-k at once, gathered
+    # into preallocated buffers
+    probe_buffer = probe_feature.new(batch_size * rerank_topk, num_features)
+    gallery_buffer = gallery_feature.new(batch_size * rerank_topk, num_features)
+    pair_forward = getattr(model, 'pair_forward', model)
+    pairwise_score = torch.zeros(len(query), rerank_topk, 2)
+    if use_cuda:
+        pairwise_score = pairwise_score.cuda()
+    num_batches = (len(query) + batch_size - 1) // batch_size
+    for i in range(num_batches):
+        start, b = i * batch_size, min(batch_size, len(query) - i * batch_size)
+        probe_x = probe_buffer[:b * rerank_topk]
+        probe_x.view(b, rerank_topk, num_features).copy_(
+            probe_feature[start:start + b].unsqueeze(1)
+            .expand(b, rerank_topk, num_features))
+        gallery_x = gallery_buffer[:b * rerank_topk]
+        torch.index_select(gallery_feature, 0,
+                           topk_index[start:start + b].view(-1), out=gallery_x)
+        data_time.update(time.time() - end)
+
+        if use_cuda:
+            probe_x, gallery_x = probe_x.cuda(), gallery_x.cuda()
+        score = pair_forward(Variable(probe_x, volatile=True),
+                             Variable(gallery_x, volatile=True))
+        pairwise_score[start:start + b] = score.data.view(b, rerank_topk, -1)
         batch_time.update(time.time() - end)
         end = time.time()
 
         if (i + 1) % print_freq == 0:
-         print('Extract Embedding: [{}/{}]\t'
-               'Time {:.3f} ({:.3f})\t'
-               'Data {:.3f} ({:.3f})\t'.format(
-               i + 1, len(query),
-               batch_time.val, batch_time.avg,
-               data_time.val, data_time.avg))
+            print('Extract Embedding: [{}/{}]\t'
+                  'Time {:.3f} ({:.3f})\t'
+                  'Data {:.3f} ({:.3f})\t'
+                  .format(i + 1, num_batches,
+                          batch_time.val, batch_time.avg,
+                          data_time.val, data_time.avg))
 
-    return torch.cat(pairwise_score)
+    return Variable(pairwise_score.view(-1, 2))
 
 
 def extract_features(model, data_loader, print_freq=1, metric=None):
@@ -135,10 +393,180 @@ def pairwise_distance(features, query=None, gallery=None, metric=None):
     return dist
 
 
+def _stack_features(features, fnames, metric=None):
+    x = torch.cat([features[f].view(1, -1) for f in fnames], 0)
+    if metric is not None:
+        x = metric.transform(x)
+    return x
+
+
+def memory_block_size(memory_budget, num_features, topk=None):
+    """Largest block size whose working set fits in ``memory_budget`` bytes.
+
+    The working set of a block is two blocks of features, the distance block
+    with its temporaries and, if ``topk`` is given, the running top-k
+    candidates with their indices.
+    """
+    a, b = 3., 2. * num_features
+    if topk is not None:
+        a, b = a + 6., b + 6. * topk
+    c = memory_budget / 4.
+    block_size = (math.sqrt(b * b + 4. * a * c) - b) / (2. * a)
+    return max(1, int(block_size))
+
+
+def blocked_pairwise_distance(features, query=None, gallery=None, metric=None,
+                              block_size=1024, topk=None, out=None):
+    """Squared euclidean distances computed block by block.
+
+    Only ``block_size`` query and gallery features are stacked at a time. If
+    ``topk`` is given, keeps a running top-k for each query and returns the
+    ``(distances, indices)`` of its nearest gallery samples, both of shape
+    ``(m, topk)`` and sorted by distance. Otherwise fills the full ``(m, n)``
+    float32 matrix block by block, into ``out`` if given (e.g. a numpy
+    memmap), and returns it.
+    """
+    if query is None and gallery is None:
+        query_fnames = gallery_fnames = list(features.keys())
+    else:
+        query_fnames = [f for f, _, _ in query]
+        gallery_fnames = [f for f, _, _ in gallery]
+    m, n = len(query_fnames), len(gallery_fnames)
+
+    gallery_norms = torch.cat(
+        [_stack_features(features, gallery_fnames[j:j + block_size], metric)
+         .pow(2).sum(1) for j in range(0, n, block_size)])
+
+    if topk is not None:
+        topk = min(topk, n)
+        top_dist = np.zeros((m, topk), dtype=np.float32)
+        top_indices = np.zeros((m, topk), dtype=np.int64)
+    elif out is None:
+        out = np.zeros((m, n), dtype=np.float32)
+
+    for i in range(0, m, block_size):
+        x = _stack_features(features, query_fnames[i:i + block_size], metric)
+        x_norms = x.pow(2).sum(1, keepdim=True)
+        best_dist = best_indices = None
+        for j in range(0, n, block_size):
+            y = _stack_features(features, gallery_fnames[j:j + block_size],
+                                metric)
+            dist = x_norms + gallery_norms[j:j + y.size(0)].view(1, -1) - \
+                   2 * torch.mm(x, y.t())
+            if topk is None:
+                out[i:i + x.size(0), j:j + y.size(0)] = to_numpy(dist)
+                continue
+            indices = torch.arange(j, j + y.size(0)).long()
+            indices = indices.view(1, -1).expand_as(dist)
+            if best_dist is not None:
+                dist = torch.cat([best_dist, dist], 1)
+                indices = torch.cat([best_indices, indices], 1)
+            best_dist, pos = dist.topk(min(topk, dist.size(1)), dim=1,
+                                       largest=False)
+            best_indices = indices.gather(1, pos)
+        if topk is not None:
+            top_dist[i:i + x.size(0)] = to_numpy(best_dist)
+            top_indices[i:i + x.size(0)] = to_numpy(best_indices)
+
+    if topk is not None:
+        return top_dist, top_indices
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def quantize_features(features, query=None, gallery=None, mode='float16',
+                      metric=None):
+    """Stack the query and gallery features into a
+    :class:`~reid.feature_extraction.QuantizedFeatures` of the given mode."""
+    if query is None and gallery is None:
+        fnames = list(features.keys())
+    else:
+        fnames = list(OrderedDict.fromkeys(
+            [f for f, _, _ in query] + [f for f, _, _ in gallery]))
+    x = np.concatenate([
+        to_numpy(_stack_features(features, fnames[i:i + 4096], metric))
+        for i in range(0, len(fnames), 4096)])
+    return QuantizedFeatures(x, mode=mode, fnames=fnames)
+
+
+def quantized_pairwise_distance(features, query=None, gallery=None,
+                                mode='float16', metric=None, block_size=1024,
+                                out=None):
+    """Squared euclidean distances between features held in a compact mode.
+
+    ``features`` is either a :class:`~reid.feature_extraction.
+    QuantizedFeatures`, or a dict of features quantized on the fly into the
+    given ``mode``. Only ``block_size`` query and gallery rows are upcast to
+    float32 at a time, so that the matrix products accumulate in float32
+    whatever the storage precision. Fills the ``(m, n)`` float32 matrix, into
+    ``out`` if given, and returns it.
+    """
+    if not isinstance(features, QuantizedFeatures):
+        features = quantize_features(features, query, gallery, mode=mode,
+                                     metric=metric)
+    if query is None and gallery is None:
+        query_rows = gallery_rows = np.arange(len(features))
+    else:
+        query_rows = features.rows([f for f, _, _ in query])
+        gallery_rows = features.rows([f for f, _, _ in gallery])
+    m, n = len(query_rows), len(gallery_rows)
+    if out is None:
+        out = np.zeros((m, n), dtype=np.float32)
+
+    gallery_norms = np.concatenate([
+        (features.dequantize(gallery_rows[j:j + block_size], offset=False)
+         ** 2).sum(axis=1) for j in range(0, n, block_size)])
+    for i in range(0, m, block_size):
+        x = features.dequantize(query_rows[i:i + block_size], offset=False)
+        x_norms = (x ** 2).sum(axis=1)[:, np.newaxis]
+        for j in range(0, n, block_size):
+            y = features.dequantize(gallery_rows[j:j + block_size],
+                                    offset=False)
+            out[i:i + len(x), j:j + len(y)] = \
+                x_norms + gallery_norms[j:j + len(y)] - 2 * x.dot(y.T)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def index_pairwise_distance(index, features, query, gallery, topk=100,
+                            metric=None, **search_kwargs):
+    """First-stage distances through an approximate gallery ``index``.
+
+    An empty ``index``, e.g. a :class:`~reid.index.IVFIndex` or a
+    :class:`~reid.index.PQIndex`, is first filled with the gallery features,
+    in gallery order, and trained on them if needed. A filled index is
+    assumed to hold exactly the gallery, and is reset and refilled if its
+    size differs, e.g. when reused for another gallery. Each query gets the squared euclidean distances of
+    the ``topk`` gallery samples found by the index and inf for all the
+    others. ``search_kwargs`` go to the ``search`` method of the index, e.g.
+    ``num_probes`` or ``shortlist``.
+    """
+    query_fnames = [f for f, _, _ in query]
+    gallery_fnames = [f for f, _, _ in gallery]
+    if len(index) != len(gallery_fnames):
+        y = to_numpy(_stack_features(features, gallery_fnames, metric))
+        if not index.is_trained:
+            index.train(y)
+        elif len(index) > 0:
+            # Stale index of another gallery
+            index.reset()
+        index.add(y)
+    x = to_numpy(_stack_features(features, query_fnames, metric))
+    dist, indices = index.search(x, topk, **search_kwargs)
+    distmat = np.full((len(query_fnames), len(gallery_fnames)), np.inf,
+                      dtype=np.float32)
+    rows, cols = np.nonzero(indices >= 0)
+    distmat[rows, indices[rows, cols]] = dist[rows, cols]
+    return distmat
+
+
 def evaluate_all(distmat, query=None, gallery=None,
                  query_ids=None, gallery_ids=None,
                  query_cams=None, gallery_cams=None,
-                 cmc_topk=(1, 5, 10), dataset=None):
+                 cmc_topk=(1, 5, 10), dataset=None, partial_ranking=False,
+                 num_workers=None, seed=0):
     if query is not None and gallery is not None:
         query_ids = [pid for _, pid, _ in query]
         gallery_ids = [pid for _, pid, _ in gallery]
@@ -148,71 +576,79 @@ def evaluate_all(distmat, query=None, gallery=None,
         assert (query_ids is not None and gallery_ids is not None
                 and query_cams is not None and gallery_cams is not None)
 
-    # Compute mean AP
-    mAP = mean_ap(distmat, query_ids, gallery_ids, query_cams, gallery_cams)
-    print('Mean AP: {:4.1%}'.format(mAP))
-
     # Compute all kinds of CMC scores
-    if not dataset:
-      cmc_configs = {
-          'allshots': dict(separate_camera_set=False,
-                           single_gallery_shot=False,
-                           first_match_break=False),
-          'cuhk03': dict(separate_camera_set=True,
-                         single_gallery_shot=True,
-                         first_match_break=False),
-          'market1501': dict(separate_camera_set=False,
-                             single_gallery_shot=False,
-                             first_match_break=True)}
-      cmc_scores = {name: cmc(distmat, query_ids, gallery_ids,
-                              query_cams, gallery_cams, **params)
-                    for name, params in cmc_configs.items()}
-
-      print('CMC Scores{:>12}{:>12}{:>12}'
-            .format('allshots', 'cuhk03', 'market1501'))
-      for k in cmc_topk:
-          print('  top-{:<4}{:12.1%}{:12.1%}{:12.1%}'
-                .format(k, cmc_scores['allshots'][k - 1],
-                        cmc_scores['cuhk03'][k - 1],
-                        cmc_scores['market1501'][k - 1]))
-
-      # Use the allshots cmc top-1 score for validation criterion
-      return cmc_scores['allshots'][0]
+    cmc_configs = OrderedDict([
+        ('allshots', dict(separate_camera_set=False,
+                          single_gallery_shot=False,
+                          first_match_break=False)),
+        ('cuhk03', dict(separate_camera_set=True,
+                        single_gallery_shot=True,
+                        first_match_break=False)),
+        ('market1501', dict(separate_camera_set=False,
+                            single_gallery_shot=False,
+                            first_match_break=True))])
+    if dataset:
+        name = 'cuhk03' if dataset == 'cuhk03' else 'market1501'
+        cmc_configs = OrderedDict([(name, cmc_configs[name])])
+
+    if num_workers is not None:
+        # Evaluate query shards in parallel
+        mAP, cmc_scores = sharded_metrics(
+            distmat, query_ids, gallery_ids, query_cams, gallery_cams,
+            cmc_configs=cmc_configs, partial_ranking=partial_ranking,
+            num_workers=num_workers, seed=seed)
+        print('Mean AP: {:4.1%}'.format(mAP))
     else:
+        # Sort once and share the ranking across all the metrics
+        ranking_cls = (PartialRankingContext if partial_ranking
+                       else RankingContext)
+        ranking = ranking_cls(distmat, query_ids, gallery_ids,
+                              query_cams, gallery_cams)
+
+        # Compute mean AP
+        mAP = mean_ap(ranking)
+        print('Mean AP: {:4.1%}'.format(mAP))
+
+        cmc_scores = OrderedDict(
+            (name, cmc(ranking, random_state=seed, **params))
+            for name, params in cmc_configs.items())
+
+    print('CMC Scores' + ''.join('{:>12}'.format(name)
+                                 for name in cmc_scores))
+    for k in cmc_topk:
+        print('  top-{:<4}'.format(k) + ''.join(
+            '{:12.1%}'.format(scores[k - 1])
+            for scores in cmc_scores.values()))
 
-      if (dataset == 'cuhk03'):
-        cmc_configs = {
-            'cuhk03': dict(separate_camera_set=True,
-                              single_gallery_shot=True,
-                              first_match_break=False),
-            }
-        cmc_scores = {name: cmc(distmat, query_ids, gallery_ids,
-                                query_cams, gallery_cams, **params)
-                      for name, params in cmc_configs.items()}
-
-        print('CMC Scores{:>12}'.format('cuhk03'))
-        for k in cmc_topk:
-            print('  top-{:<4}{:12.1%}'
-                  .format(k,
-                          cmc_scores['cuhk03'][k - 1]))
+    if not dataset:
         # Use the allshots cmc top-1 score for validation criterion
-        return cmc_scores['cuhk03'][0], mAP
-      else:
-        cmc_configs = {
-            'market1501': dict(separate_camera_set=False,
-                               single_gallery_shot=False,
-                               first_match_break=True)
-                    }
-        cmc_scores = {name: cmc(distmat, query_ids, gallery_ids,
-                                query_cams, gallery_cams, **params)
-                      for name, params in cmc_configs.items()}
-
-        print('CMC Scores{:>12}'.format('market1501'))
-        for k in cmc_topk:
-            print('  top-{:<4}{:12.1%}'
-                  .format(k,
-                          cmc_scores['market1501'][k-1]))
-        return cmc_scores['market1501'][0], mAP
+        return cmc_scores['allshots'][0]
+    return list(cmc_scores.values())[0][0], mAP
+
+
+def merge_two_stage_distances(distmat, rank_indices, embeddings, rerank_topk):
+    """Merge second-stage distances into the first-stage ``distmat`` in place.
+
+    ``embeddings`` holds the second-stage distances of the top
+    ``rerank_topk`` gallery samples of each query, in the order given by
+    ``rank_indices``. The remaining samples of a row are shifted so that they
+    stay at least 1 farther than the re-ranked ones.
+    """
+    m, n = distmat.shape
+    rows = np.arange(m)[:, np.newaxis]
+    topk_indices = rank_indices[:, :rerank_topk]
+    distmat[rows, topk_indices] = to_numpy(embeddings).reshape(m, -1)
+    if rerank_topk >= n:
+        return distmat
+    # Same precision as numpy scalar arithmetic on a single row
+    dtype = np.result_type(distmat.dtype.type(0) + 1.)
+    bar = distmat[rows, topk_indices].max(axis=1).astype(dtype)
+    gap = bar + 1. - distmat[rows[:, 0], rank_indices[:, rerank_topk]] \
+        .astype(dtype)
+    shift = gap > 0
+    distmat[rows[shift], rank_indices[shift, rerank_topk:]] += \
+        gap[shift, np.newaxis].astype(distmat.dtype)
+    return distmat
 
 
 class Evaluator(object):
@@ -220,12 +656,191 @@ class Evaluator(object):
         super(Evaluator, self).__init__()
         self.model = model
 
-    def evaluate(self, data_loader, query, gallery, metric=None, dataset=None):
+    def evaluate(self, data_loader, query, gallery, metric=None, dataset=None,
+                 memory_budget=None, distmat_file=None, qe_topk=0, qe_alpha=0.,
+                 index=None, index_topk=100, feature_mode='float32'):
         features, _ = extract_features(self.model, data_loader)
-        distmat = pairwise_distance(features, query, gallery, metric=metric)
-        return evaluate_all(distmat, query=query, gallery=gallery, dataset=dataset)
+        block_size = 1024
+        if memory_budget is not None:
+            num_features = next(iter(features.values())).numel()
+            block_size = memory_block_size(memory_budget, num_features,
+                                           topk=qe_topk or None)
+        if qe_topk > 0:
+            # Re-query with the features aggregated over the top-k gallery
+            from .reranking import query_expansion
+            features = query_expansion(features, query, gallery,
+                                       topk=qe_topk, alpha=qe_alpha,
+                                       metric=metric, block_size=block_size)
+        tmp_file = None
+        if index is not None:
+            # Approximate first stage, inf beyond the top-k of the index
+            distmat = index_pairwise_distance(index, features, query, gallery,
+                                              topk=index_topk, metric=metric)
+        elif memory_budget is None and distmat_file is None and \
+                feature_mode == 'float32':
+            distmat = pairwise_distance(features, query, gallery,
+                                        metric=metric)
+        else:
+            # Compute the distances block by block into a memmap, a temporary
+            # one if only a memory budget is given, so that the m x n output
+            # is not held in memory either
+            out = None
+            if distmat_file is None and memory_budget is not None:
+                fd, tmp_file = tempfile.mkstemp(suffix='.distmat')
+                os.close(fd)
+                distmat_file = tmp_file
+            if distmat_file is not None:
+                out = np.memmap(distmat_file, dtype=np.float32, mode='w+',
+                                shape=(len(query), len(gallery)))
+            if feature_mode == 'float32':
+                distmat = blocked_pairwise_distance(
+                    features, query, gallery, metric=metric,
+                    block_size=block_size, out=out)
+            else:
+                distmat = quantized_pairwise_distance(
+                    features, query, gallery, mode=feature_mode,
+                    metric=metric, block_size=block_size, out=out)
+        try:
+            return evaluate_all(distmat, query=query, gallery=gallery,
+                                dataset=dataset)
+        finally:
+            if tmp_file is not None:
+                del distmat, out
+                os.remove(tmp_file)
+
+
+
+def grid_embedding_distance(model, features, query, gallery,
+                            embed_dist_fn=None, block_size=1024):
+    """Second-stage distances between all the query and gallery samples.
+
+    ``model`` scores blocks of ``block_size`` queries against blocks of
+    gallery samples at once through its inference-only ``grid_scores``, e.g.
+    :class:`~reid.models.embedding.RandomWalkEmbed`, and ``embed_dist_fn``
+    maps the scores of each pair to a single distance. The scores of a
+    :class:`~reid.models.embedding.GroupedRandomWalkEmbed` are averaged over
+    its groups first, as in :func:`compute_random_walk_batch`. Returns the
+    ``(len(query), len(gallery))`` float32 distance matrix.
+    """
+    model.eval()
+    use_cuda = next(model.parameters()).is_cuda
+    query_fnames = [f for f, _, _ in query]
+    gallery_fnames = [f for f, _, _ in gallery]
+    m, n = len(query_fnames), len(gallery_fnames)
+    out = np.zeros((m, n), dtype=np.float32)
+
+    def stack(fnames):
+        x = _stack_features(features, fnames)
+        return Variable(x.cuda() if use_cuda else x, volatile=True)
+
+    for i in range(0, m, block_size):
+        x = stack(query_fnames[i:i + block_size])
+        for j in range(0, n, block_size):
+            y = stack(gallery_fnames[j:j + block_size])
+            scores = model.grid_scores(x, y).data
+            if scores.dim() == 4:
+                # (num_groups, Np, Ng, C) of a grouped model
+                scores = scores.mean(0)
+            scores = scores.contiguous().view(-1, scores.size(-1))
+            if embed_dist_fn is not None:
+                scores = embed_dist_fn(scores)
+            out[i:i + x.size(0), j:j + y.size(0)] = \
+                to_numpy(scores).reshape(x.size(0), y.size(0))
+    return out
+
+
+def camera_identity_index(gallery):
+    # Gallery indices of each (pid, cam)
+    index = {}
+    for i, (_, pid, cam) in enumerate(gallery):
+        index.setdefault((pid, cam), []).append(i)
+    return dict((key, np.asarray(indices)) for key, indices in index.items())
+
+
+def prune_junk_candidates(rank_indices, query, gallery, rerank_topk,
+                          index=None):
+    """Move the junk gallery samples of each query out of its top-k.
+
+    Junk samples share both the identity and the camera of the query and
+    are ignored by :func:`cmc` and :func:`mean_ap`. The (pid, cam) ``index``
+    of :func:`camera_identity_index` bounds how far the ranking of each
+    query has to be scanned. Returns the reordered ``rank_indices``, whose
+    first ``rerank_topk`` columns are the nearest non-junk samples while the
+    others keep their order, and the number of junk samples that left the
+    top-k.
+    """
+    if index is None:
+        index = camera_identity_index(gallery)
+    num_junk = [len(index.get((pid, cam), ())) for _, pid, cam in query]
+    width = min(rank_indices.shape[1], rerank_topk + max(num_junk + [0]))
+    query_ids = np.asarray([pid for _, pid, _ in query])
+    query_cams = np.asarray([cam for _, _, cam in query])
+    gallery_ids = np.asarray([pid for _, pid, _ in gallery])
+    gallery_cams = np.asarray([cam for _, _, cam in gallery])
+    head = rank_indices[:, :width]
+    junk = (gallery_ids[head] == query_ids[:, np.newaxis]) & \
+           (gallery_cams[head] == query_cams[:, np.newaxis])
+    # The first rerank_topk non-junk samples, then the others in rank order
+    selected = ~junk & (np.cumsum(~junk, axis=1) <= rerank_topk)
+    order = np.argsort(~selected, axis=1, kind='stable')
+    pruned = rank_indices.copy()
+    pruned[:, :width] = np.take_along_axis(head, order, axis=1)
+    return pruned, int(junk[:, :rerank_topk].sum())
 
 
+def confident_queries(distmat, rank_indices, margin=None, ratio=None):
+    """Queries confident enough in their first-stage rank-1 to skip re-ranking.
+
+    A query is confident if its rank-2 gallery distance exceeds the rank-1
+    one by at least ``margin``, or if the rank-1 distance is at most
+    ``ratio`` times the rank-2 one. Returns the boolean mask of confident
+    queries along with their rank-1 and rank-2 distances.
+    """
+    rows = np.arange(distmat.shape[0])
+    top1_dist = distmat[rows, rank_indices[:, 0]]
+    if distmat.shape[1] > 1:
+        top2_dist = distmat[rows, rank_indices[:, 1]]
+    else:
+        top2_dist = np.full_like(top1_dist, np.inf)
+    confident = np.zeros(len(rows), dtype=bool)
+    if margin is not None:
+        confident |= top2_dist - top1_dist >= margin
+    if ratio is not None:
+        confident |= top1_dist <= ratio * top2_dist
+    return confident, top1_dist, top2_dist
+
+
+def _log_early_exit(query, confident, top1_dist, top2_dist, rerank_topk,
+                    random_walk=False, fpath=None):
+    # Second-stage pair scores per query: probe-gallery, plus gallery-gallery
+    # for the random walk (before caching)
+    pairs = rerank_topk + (rerank_topk ** 2 if random_walk else 0)
+    num_skipped = int(confident.sum())
+    print('Early exit: {} of {} queries skip the second stage, saving {} of '
+          '{} pair scores ({:.1%})'
+          .format(num_skipped, len(query), num_skipped * pairs,
+                  len(query) * pairs, num_skipped / float(max(len(query), 1))))
+    if fpath is None:
+        return
+    write_json({
+        'num_queries': len(query),
+        'num_skipped': num_skipped,
+        'pairs_per_query': pairs,
+        'pairs_saved': num_skipped * pairs,
+        'queries': [{'fname': fname,
+                     'stage': 1 if skip else 2,
+                     'top1_dist': float(d1),
+                     'top2_dist': float(d2)}
+                    for (fname, _, _), skip, d1, d2 in
+                    zip(query, confident, top1_dist, top2_dist)],
+    }, fpath)
+
+
+def _topk_gallery(rank_indices, gallery, rerank_topk):
+    # Top-k gallery (fname, pid, cam) of each query
+    return [[gallery[j] for j in indices[:rerank_topk]]
+            for indices in rank_indices]
+
 
 class CascadeEvaluator(object):
     def __init__(self, base_model, embed_model, embed_dist_fn=None):
@@ -235,42 +850,193 @@ class CascadeEvaluator(object):
         self.embed_dist_fn = embed_dist_fn
 
     def evaluate(self, data_loader, query, gallery, alpha=0, cache_file=None,
-                 rerank_topk=75, second_stage=True, dataset=None):
+                 rerank_topk=75, second_stage=True, dataset=None,
+                 embed_batch_size=64, random_walk=False,
+                 score_cache_bytes=1 << 30, random_walk_solver='solve',
+                 embed_block_size=1024, exit_margin=None, exit_ratio=None,
+                 exit_log_file=None, prune_junk=False, index=None,
+                 index_topk=100):
+        if second_stage and rerank_topk is None and (
+                random_walk or prune_junk or exit_margin is not None or
+                exit_ratio is not None):
+            # The whole gallery is scored in one grid, without any of these
+            raise ValueError("random_walk, prune_junk, exit_margin and "
+                             "exit_ratio need a rerank_topk")
         # Extract features image by image
         features, _ = extract_features(self.base_model, data_loader)
 
         # Compute pairwise distance and evaluate for the first stage
-        distmat = pairwise_distance(features, query, gallery)
+        if index is not None:
+            distmat = index_pairwise_distance(index, features, query, gallery,
+                                              topk=index_topk)
+        else:
+            distmat = pairwise_distance(features, query, gallery)
         print("First stage evaluation:")
-        if second_stage:
+        if second_stage and rerank_topk is None:
+            evaluate_all(distmat, query=query, gallery=gallery, dataset=dataset)
+
+            # Re-rank the whole gallery with the folded embed model
+            distmat = grid_embedding_distance(
+                self.embed_model, features, query, gallery,
+                embed_dist_fn=self.embed_dist_fn, block_size=embed_block_size)
+            print("Second stage evaluation:")
+        elif second_stage:
             evaluate_all(distmat, query=query, gallery=gallery, dataset=dataset)
 
             # Sort according to the first stage distance
             distmat = to_numpy(distmat)
             rank_indices = np.argsort(distmat, axis=1)
 
+            if prune_junk:
+                # Give all the top-k slots to samples the metrics count
+                rank_indices, num_junk = prune_junk_candidates(
+                    rank_indices, query, gallery, rerank_topk)
+                print('Candidate pruning: {} of {} top-k candidates were '
+                      'same id and camera junk, saving their scoring'
+                      .format(num_junk, len(query) * min(rerank_topk,
+                                                         len(gallery))))
+
+            # Skip the second stage for the confident queries
+            rerank = np.arange(len(query))
+            if exit_margin is not None or exit_ratio is not None:
+                confident, top1_dist, top2_dist = confident_queries(
+                    distmat, rank_indices, margin=exit_margin,
+                    ratio=exit_ratio)
+                _log_early_exit(query, confident, top1_dist, top2_dist,
+                                rerank_topk, random_walk, exit_log_file)
+                rerank = np.flatnonzero(~confident)
+            rerank_query = [query[i] for i in rerank]
+            rerank_indices = rank_indices[rerank]
+
             # Build a data loader for topk predictions for each query
-            topk_gallery = [[] for i in range(len(query))]
-            for i, indices in enumerate(rank_indices):
-                for j in indices[:rerank_topk]:
-                    gallery_fname_id_pid = gallery[j]
-                    topk_gallery[i].append(gallery_fname_id_pid)
+            topk_gallery = _topk_gallery(rerank_indices, gallery, rerank_topk)
 
-            embeddings = extract_embeddings(self.embed_model, features, alpha,
-                                    query=query, topk_gallery=topk_gallery, rerank_topk=rerank_topk)
+            if len(rerank) == 0:
+                embeddings = None
+            elif random_walk:
+                # Score each gallery pair at most once over all the queries
+                score_cache = None
+                if score_cache_bytes:
+                    score_cache = PairwiseScoreCache(score_cache_bytes)
+                embeddings = extract_random_walk_embeddings(
+                    self.embed_model, features, alpha, query=rerank_query,
+                    topk_gallery=topk_gallery, rerank_topk=rerank_topk,
+                    score_cache=score_cache, batch_size=embed_batch_size,
+                    solver=random_walk_solver)
+            else:
+                embeddings = extract_embeddings(self.embed_model, features, alpha,
+                                        query=rerank_query, topk_gallery=topk_gallery, rerank_topk=rerank_topk,
+                                        batch_size=embed_batch_size)
 
-            if self.embed_dist_fn is not None:
-                # embeddings = embeddings[:, 0].data
-                embeddings = self.embed_dist_fn(embeddings.data)
-
-            # Merge two-stage distances
-            for k, embed in enumerate(embeddings):
-                i, j = k // rerank_topk, k % rerank_topk
-                distmat[i, rank_indices[i, j]] = embed
-            for i, indices in enumerate(rank_indices):
-                bar = max(distmat[i][indices[:rerank_topk]])
-                gap = max(bar + 1. - distmat[i, indices[rerank_topk]], 0)
-                if gap > 0:
-                    distmat[i][indices[rerank_topk:]] += gap
+            if embeddings is not None:
+                if self.embed_dist_fn is not None:
+                    # embeddings = embeddings[:, 0].data
+                    embeddings = self.embed_dist_fn(embeddings.data)
+
+                # Merge two-stage distances
+                if len(rerank) == len(query):
+                    merge_two_stage_distances(distmat, rank_indices,
+                                              embeddings, rerank_topk)
+                else:
+                    rerank_distmat = distmat[rerank]
+                    merge_two_stage_distances(rerank_distmat, rerank_indices,
+                                              embeddings, rerank_topk)
+                    distmat[rerank] = rerank_distmat
             print("Second stage evaluation:")
-        return evaluate_all(distmat, query, gallery, dataset=dataset)
\ No newline at end of file
+        return evaluate_all(distmat, query, gallery, dataset=dataset)
+
+    def sweep_alpha(self, data_loader, query, gallery, alphas,
+                    rerank_topk=75, dataset=None, embed_batch_size=64,
+                    score_cache_bytes=1 << 30):
+        """Evaluate random walk re-ranking for each of ``alphas``.
+
+        The embed model scores the probe-gallery and gallery-gallery pairs
+        once, then every alpha only costs a propagation and an evaluation.
+        Returns an OrderedDict from alpha to the result of
+        :func:`evaluate_all`.
+        """
+        features, _ = extract_features(self.base_model, data_loader)
+        distmat = pairwise_distance(features, query, gallery)
+        print("First stage evaluation:")
+        evaluate_all(distmat, query=query, gallery=gallery, dataset=dataset)
+
+        distmat = to_numpy(distmat)
+        rank_indices = np.argsort(distmat, axis=1)
+        topk_gallery = _topk_gallery(rank_indices, gallery, rerank_topk)
+        score_cache = None
+        if score_cache_bytes:
+            score_cache = PairwiseScoreCache(score_cache_bytes)
+        embeddings = extract_random_walk_sweep(
+            self.embed_model, features, alphas, query=query,
+            topk_gallery=topk_gallery, rerank_topk=rerank_topk,
+            score_cache=score_cache, batch_size=embed_batch_size)
+
+        results = OrderedDict()
+        for alpha, alpha_embeddings in zip(alphas, embeddings):
+            if self.embed_dist_fn is not None:
+                alpha_embeddings = self.embed_dist_fn(alpha_embeddings.data)
+            alpha_distmat = merge_two_stage_distances(
+                distmat.copy(), rank_indices, alpha_embeddings, rerank_topk)
+            print("Second stage evaluation, alpha = {}:".format(alpha))
+            results[alpha] = evaluate_all(alpha_distmat, query, gallery,
+                                          dataset=dataset)
+        return results
+
+    def sweep_rerank_topk(self, data_loader, query, gallery, rerank_topks,
+                          alpha=0, dataset=None, embed_batch_size=64,
+                          random_walk=False, score_cache_bytes=1 << 30,
+                          random_walk_solver='solve'):
+        """Evaluate the second stage for each of ``rerank_topks``.
+
+        The second stage is scored once for the largest k. The scores of a
+        smaller k are the first k of them, re-propagated over the smaller
+        gallery graph with ``random_walk``, and are merged into a copy of
+        the first-stage distances. Prints a table of the metrics versus k
+        and returns an OrderedDict from k to the result of
+        :func:`evaluate_all`.
+        """
+        rerank_topks = sorted(set(rerank_topks))
+        max_topk = rerank_topks[-1]
+        features, _ = extract_features(self.base_model, data_loader)
+        distmat = pairwise_distance(features, query, gallery)
+        print("First stage evaluation:")
+        evaluate_all(distmat, query=query, gallery=gallery, dataset=dataset)
+
+        distmat = to_numpy(distmat)
+        rank_indices = np.argsort(distmat, axis=1)
+        topk_gallery = _topk_gallery(rank_indices, gallery, max_topk)
+        if random_walk:
+            score_cache = None
+            if score_cache_bytes:
+                score_cache = PairwiseScoreCache(score_cache_bytes)
+            embeddings = extract_random_walk_topk_sweep(
+                self.embed_model, features, alpha, rerank_topks, query=query,
+                topk_gallery=topk_gallery, score_cache=score_cache,
+                batch_size=embed_batch_size, solver=random_walk_solver)
+        else:
+            embeddings = extract_embeddings(
+                self.embed_model, features, alpha, query=query,
+                topk_gallery=topk_gallery, rerank_topk=max_topk,
+                batch_size=embed_batch_size)
+            embeddings = embeddings.view(len(query), max_topk, -1)
+            embeddings = [embeddings[:, :k].contiguous().view(-1, 2)
+                          for k in rerank_topks]
+
+        results = OrderedDict()
+        for k, topk_embeddings in zip(rerank_topks, embeddings):
+            if self.embed_dist_fn is not None:
+                topk_embeddings = self.embed_dist_fn(topk_embeddings.data)
+            topk_distmat = merge_two_stage_distances(
+                distmat.copy(), rank_indices, topk_embeddings, k)
+            print("Second stage evaluation, rerank top-{}:".format(k))
+            results[k] = evaluate_all(topk_distmat, query, gallery,
+                                      dataset=dataset)
+
+        print('Rerank top-k' + ('{:>12}{:>12}'.format('top-1', 'mAP')
+                                if dataset else '{:>12}'.format('top-1')))
+        for k, result in results.items():
+            if dataset:
+                print('  {:<10}{:12.1%}{:12.1%}'.format(k, *result))
+            else:
+                print('  {:<10}{:12.1%}'.format(k, result))
+        return results
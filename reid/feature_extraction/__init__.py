@@ -2,8 +2,10 @@ from __future__ import absolute_import
 
 from .cnn import extract_cnn_feature
 from .database import FeatureDatabase
+from .quantization import QuantizedFeatures
 
 __all__ = [
     'extract_cnn_feature',
     'FeatureDatabase',
+    'QuantizedFeatures',
 ]
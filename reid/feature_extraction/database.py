@@ -24,6 +24,10 @@ class FeatureDatabase(Dataset):
     def _get_single_item(self, key):
         return np.asarray(self.fid[key])
 
+    def dataset(self, key):
+        # The on-disk dataset, read lazily by slicing
+        return self.fid[key]
+
     def __setitem__(self, key, value):
         if key in self.fid:
             if self.fid[key].shape == value.shape and \
@@ -38,6 +42,9 @@ class FeatureDatabase(Dataset):
     def __delitem__(self, key):
         del self.fid[key]
 
+    def __contains__(self, key):
+        return key in self.fid
+
     def __len__(self):
         return len(self.fid)
 
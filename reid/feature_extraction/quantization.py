@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class QuantizedFeatures(object):
+    """Feature rows held in a compact precision.
+
+    ``mode`` is one of ``'float32'``, ``'float16'`` (half the memory) or
+    ``'int8'`` (a quarter of it), the latter with a per-dimension affine
+    quantization onto [-127, 127] fitted on the given features. Rows are
+    read back through :meth:`dequantize`, block by block, in float32.
+    ``fnames`` optionally names the rows, for :meth:`rows`.
+    """
+    MODES = ('float32', 'float16', 'int8')
+
+    def __init__(self, x, mode='float16', fnames=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown feature mode: {}".format(mode))
+        x = np.asarray(x, dtype=np.float32).reshape(len(x), -1)
+        self.mode = mode
+        self.fnames = fnames
+        self.scale = self.offset = None
+        if mode == 'int8':
+            low, high = x.min(axis=0), x.max(axis=0)
+            self.offset = (low + high) / 2
+            self.scale = np.maximum((high - low) / 254, 1e-12)
+            self.data = np.rint((x - self.offset) / self.scale).astype(np.int8)
+        else:
+            self.data = x.astype(mode)
+        self._index = None if fnames is None else \
+            dict((f, i) for i, f in enumerate(fnames))
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def bytes_per_vector(self):
+        return self.data.itemsize * self.data.shape[1]
+
+    def rows(self, fnames):
+        return np.asarray([self._index[f] for f in fnames], dtype=np.int64)
+
+    def dequantize(self, index=slice(None), offset=True):
+        """Float32 values of the rows selected by ``index``.
+
+        The int8 offset is common to all the rows, so that it cancels out of
+        euclidean distances; ``offset=False`` saves adding it.
+        """
+        x = self.data[index].astype(np.float32)
+        if self.mode == 'int8':
+            x *= self.scale
+            if offset:
+                x += self.offset
+        return x
@@ -0,0 +1,21 @@
+from __future__ import absolute_import
+
+from .binary import BinaryIndex, hamming_distances, pack_bits
+from .gallery import GalleryStore
+from .ivf import IVFIndex
+from .pq import PQIndex, ProductQuantizer
+from .utils import exact_search, kmeans, recall_at_k, shortlist_search
+
+__all__ = [
+    'BinaryIndex',
+    'GalleryStore',
+    'IVFIndex',
+    'PQIndex',
+    'ProductQuantizer',
+    'exact_search',
+    'hamming_distances',
+    'kmeans',
+    'pack_bits',
+    'recall_at_k',
+    'shortlist_search',
+]
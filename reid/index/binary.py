@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from .utils import load_codes, save_codes, shortlist_search
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.asarray([bin(i).count('1') for i in range(256)],
+                                 dtype=np.uint8)
+
+    def popcount(x):
+        # Set bits of each uint64 element, by a lookup on its bytes
+        counts = _POPCOUNT_TABLE[x.view(np.uint8)]
+        return counts.reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def pack_bits(bits):
+    """Pack a ``(n, num_bits)`` boolean array into ``(n, ceil(num_bits /
+    64))`` uint64 words, zero padded."""
+    num_words = (bits.shape[1] + 63) // 64
+    padded = np.zeros((len(bits), num_words * 64), dtype=np.uint8)
+    padded[:, :bits.shape[1]] = bits
+    return np.packbits(padded, axis=1).view(np.uint64)
+
+
+def hamming_distances(x, y):
+    """Hamming distances between the rows of two packed code arrays."""
+    dist = np.zeros((len(x), len(y)), dtype=np.int32)
+    for w in range(x.shape[1]):
+        dist += popcount(x[:, w, np.newaxis] ^ y[np.newaxis, :, w])
+    return dist
+
+
+class BinaryIndex(object):
+    """Hamming-distance index on binarized features.
+
+    :meth:`train` centers the features and projects them onto their
+    ``num_bits`` principal components, if fewer than the feature dimension.
+    With ``method='itq'`` it then learns the rotation of iterative
+    quantization (Gong & Lazebnik, CVPR 2011) that best aligns the projected
+    features with their signs; ``method='sign'`` keeps the projection as is.
+    Each vector is stored as the signs packed into uint64 words, and
+    searched by XOR and popcount only, with the raw vectors kept for
+    re-scoring when ``shortlist`` is set.
+    """
+
+    def __init__(self, num_bits=None, method='itq', shortlist=None,
+                 num_iters=50, max_train_samples=100000, seed=0):
+        if method not in ('sign', 'itq'):
+            raise ValueError("Unknown binarization method: {}".format(method))
+        self.num_bits = num_bits
+        self.method = method
+        self.shortlist = shortlist
+        self.num_iters = num_iters
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.mean = None
+        self.projection = None
+        self.reset()
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def is_trained(self):
+        return self.projection is not None
+
+    @property
+    def bytes_per_vector(self):
+        return self.codes.shape[1] * 8 if self.is_trained else 0
+
+    def reset(self):
+        num_words = 0 if self.projection is None else \
+            (self.projection.shape[1] + 63) // 64
+        self.codes = np.zeros((0, num_words), dtype=np.uint64)
+        self.vectors = None
+
+    def train(self, x):
+        rng = np.random.RandomState(self.seed)
+        x = np.asarray(x, dtype=np.float32)
+        if self.max_train_samples is not None and \
+           len(x) > self.max_train_samples:
+            x = x[rng.choice(len(x), self.max_train_samples, replace=False)]
+        num_bits = self.num_bits or x.shape[1]
+        if num_bits > x.shape[1]:
+            raise ValueError("Cannot take {} bits from {}-d features"
+                             .format(num_bits, x.shape[1]))
+        self.mean = x.mean(axis=0)
+        x = x - self.mean
+        if num_bits < x.shape[1]:
+            _, _, vt = np.linalg.svd(x, full_matrices=False)
+            projection = vt[:num_bits].T
+        else:
+            projection = np.eye(x.shape[1], dtype=np.float32)
+        if self.method == 'itq':
+            v = x.dot(projection)
+            rotation, _ = np.linalg.qr(rng.randn(num_bits, num_bits))
+            for _ in range(self.num_iters):
+                b = np.where(v.dot(rotation) >= 0, 1., -1.)
+                # Orthogonal Procrustes for the rotation given the codes
+                u, _, wt = np.linalg.svd(v.T.dot(b))
+                rotation = u.dot(wt)
+            projection = projection.dot(rotation)
+        self.projection = projection.astype(np.float32)
+        self.reset()
+
+    def encode(self, x, block_size=4096):
+        x = np.asarray(x, dtype=np.float32)
+        codes = np.zeros((len(x), (self.projection.shape[1] + 63) // 64),
+                         dtype=np.uint64)
+        for i in range(0, len(x), block_size):
+            y = (x[i:i + block_size] - self.mean).dot(self.projection)
+            codes[i:i + block_size] = pack_bits(y >= 0)
+        return codes
+
+    def add(self, x):
+        if not self.is_trained:
+            raise RuntimeError("The index must be trained before adding")
+        x = np.asarray(x, dtype=np.float32)
+        self.codes = np.concatenate([self.codes, self.encode(x)])
+        if self.shortlist is not None:
+            self.vectors = x if self.vectors is None else \
+                np.concatenate([self.vectors, x])
+
+    def search(self, queries, topk, shortlist=None, block_size=256):
+        """Top-k by Hamming distance, see :func:`shortlist_search`."""
+        if shortlist is None:
+            shortlist = self.shortlist
+        return shortlist_search(
+            queries, self.codes, self.encode, hamming_distances, topk,
+            vectors=self.vectors, shortlist=shortlist, block_size=block_size)
+
+    def save(self, db, prefix='binary'):
+        db[prefix + '/mean'] = self.mean
+        db[prefix + '/projection'] = self.projection
+        save_codes(db, prefix, self.codes, self.vectors)
+
+    def load(self, db, prefix='binary'):
+        self.mean = db[prefix + '/mean']
+        self.projection = db[prefix + '/projection']
+        self.codes, self.vectors = load_codes(db, prefix)
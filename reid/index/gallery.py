@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+import threading
+
+import numpy as np
+
+from .utils import merge_topk, sort_topk, squared_distances
+
+
+class _Block(object):
+    # Fixed-capacity rows with their squared norms and a tombstone mask.
+    # Rows are only ever appended and killed, never moved, so that a search
+    # may scan a block while it grows.
+    def __init__(self, capacity, dim):
+        self.features = np.zeros((capacity, dim), dtype=np.float32)
+        self.norms = np.zeros(capacity, dtype=np.float32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.entries = []
+
+    @property
+    def size(self):
+        return len(self.entries)
+
+    @property
+    def capacity(self):
+        return len(self.features)
+
+    def num_dead(self):
+        return self.size - int(self.alive[:self.size].sum())
+
+
+class GalleryStore(object):
+    """Gallery that supports adding and removing samples between searches.
+
+    Features are appended to fixed-capacity blocks along with their squared
+    norms, so that a search only computes one matrix product per block.
+    Removed samples are tombstoned and skipped by searches. Blocks whose
+    tombstoned fraction reaches ``compact_ratio`` are rewritten with their
+    live rows only, either by :meth:`compact` or, once :meth:`start` is
+    called, by a background thread. Entries are the ``(fname, pid, cam)``
+    tuples of the datasets; re-adding a fname replaces its sample.
+    """
+
+    def __init__(self, dim, block_capacity=4096, compact_ratio=0.25):
+        self.dim = dim
+        self.block_capacity = block_capacity
+        self.compact_ratio = compact_ratio
+        self.blocks = []
+        self._locations = {}
+        self._pid_fnames = {}
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, fname):
+        return fname in self._locations
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def entries(self):
+        """Live entries, in storage order."""
+        with self._lock:
+            return [entry for block in self.blocks
+                    for entry, alive in zip(block.entries, block.alive)
+                    if alive]
+
+    def add(self, entries, x):
+        """Append the ``(fname, pid, cam)`` entries with their ``(n, dim)``
+        features ``x``, e.g. stacked from :func:`~reid.evaluators.
+        extract_features`. Of a fname repeated in the batch, the last sample
+        is kept."""
+        x = np.asarray(x, dtype=np.float32).reshape(len(entries), self.dim)
+        last = dict((entry[0], i) for i, entry in enumerate(entries))
+        if len(last) < len(entries):
+            keep = sorted(last.values())
+            entries = [entries[i] for i in keep]
+            x = x[keep]
+        norms = (x ** 2).sum(axis=1)
+        with self._lock:
+            self._remove([f for f, _, _ in entries
+                          if f in self._locations])
+            i = 0
+            while i < len(entries):
+                if not self.blocks or \
+                   self.blocks[-1].size == self.blocks[-1].capacity:
+                    self.blocks.append(_Block(self.block_capacity, self.dim))
+                block = self.blocks[-1]
+                start = block.size
+                n = min(len(entries) - i, block.capacity - start)
+                block.features[start:start + n] = x[i:i + n]
+                block.norms[start:start + n] = norms[i:i + n]
+                block.alive[start:start + n] = True
+                for entry in entries[i:i + n]:
+                    fname, pid, _ = entry
+                    self._locations[fname] = (block, block.size)
+                    self._pid_fnames.setdefault(pid, set()).add(fname)
+                    block.entries.append(entry)
+                i += n
+
+    def remove(self, fnames=None, pids=None):
+        """Tombstone the given fnames and all the samples of the given pids.
+        Returns the number of removed samples."""
+        with self._lock:
+            fnames = set(fnames or [])
+            for pid in pids or []:
+                fnames.update(self._pid_fnames.get(pid, ()))
+            num_removed = self._remove(
+                [f for f in fnames if f in self._locations])
+        if self._thread is not None and num_removed > 0:
+            self._wakeup.set()
+        return num_removed
+
+    def _remove(self, fnames):
+        for fname in fnames:
+            block, row = self._locations.pop(fname)
+            block.alive[row] = False
+            pid = block.entries[row][1]
+            self._pid_fnames[pid].discard(fname)
+            if not self._pid_fnames[pid]:
+                del self._pid_fnames[pid]
+        return len(fnames)
+
+    def compact(self):
+        """Rewrite the blocks with too many tombstones, returns the number of
+        rewritten blocks. Searches in progress keep scanning the old ones."""
+        num_compacted = 0
+        with self._lock:
+            blocks = []
+            for block in self.blocks:
+                num_dead = block.num_dead()
+                if num_dead == 0 or \
+                   num_dead < self.compact_ratio * block.capacity:
+                    blocks.append(block)
+                    continue
+                num_compacted += 1
+                rows = np.flatnonzero(block.alive[:block.size])
+                if len(rows) == 0:
+                    continue
+                # The last block keeps its capacity to go on appending
+                capacity = block.capacity if block is self.blocks[-1] \
+                    else len(rows)
+                compacted = _Block(capacity, self.dim)
+                compacted.features[:len(rows)] = block.features[rows]
+                compacted.norms[:len(rows)] = block.norms[rows]
+                compacted.alive[:len(rows)] = True
+                compacted.entries = [block.entries[row] for row in rows]
+                for row, entry in enumerate(compacted.entries):
+                    self._locations[entry[0]] = (compacted, row)
+                blocks.append(compacted)
+            self.blocks = blocks
+        return num_compacted
+
+    def start(self, interval=1.):
+        """Compact in a background thread, on removals and at least every
+        ``interval`` seconds."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._compact_loop,
+                                        args=(interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def _compact_loop(self, interval):
+        while not self._stopped.is_set():
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            if not self._stopped.is_set():
+                self.compact()
+
+    def search(self, queries, topk, block_size=1024):
+        """Nearest live samples of each query by squared euclidean distance.
+
+        Returns ``(distances, fnames)`` of shape ``(len(queries), topk)``
+        sorted by distance, padded with inf and None when fewer than
+        ``topk`` samples are live.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            # Rows never move within a block, so that the blocks with their
+            # current sizes and masks are a consistent view of the gallery
+            snapshot = [(block, block.size, block.alive[:block.size].copy())
+                        for block in self.blocks]
+        offsets = np.cumsum([0] + [size for _, size, _ in snapshot])
+        top_dist = np.full((len(queries), topk), np.inf, dtype=np.float32)
+        top_fnames = np.full((len(queries), topk), None, dtype=object)
+        for i in range(0, len(queries), block_size):
+            x = queries[i:i + block_size]
+            dist = indices = None
+            for (block, size, alive), offset in zip(snapshot, offsets):
+                if not alive.any():
+                    continue
+                block_dist = squared_distances(x, block.features[:size],
+                                               block.norms[:size])
+                block_dist[:, ~alive] = np.inf
+                block_indices = np.broadcast_to(
+                    np.arange(offset, offset + size), block_dist.shape)
+                dist, indices = merge_topk(dist, indices, block_dist,
+                                           block_indices, topk)
+            if dist is None:
+                continue
+            dist, indices = sort_topk(dist, indices)
+            found = np.isfinite(dist)
+            rows, cols = np.nonzero(found)
+            fnames = top_fnames[i:i + len(x)]
+            for r, c in zip(rows, cols):
+                b = np.searchsorted(offsets, indices[r, c], side='right') - 1
+                fnames[r, c] = snapshot[b][0].entries[
+                    indices[r, c] - offsets[b]][0]
+            top_dist[i:i + len(x), :dist.shape[1]] = np.where(found, dist,
+                                                               np.inf)
+        return top_dist, top_fnames
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from .utils import assign, kmeans, merge_topk, sort_topk, squared_distances
+
+
+class IVFIndex(object):
+    """Inverted-file index for approximate squared euclidean search.
+
+    :meth:`train` clusters the vectors into ``num_lists`` k-means cells and
+    :meth:`add` files each vector, numbered in order of addition, under its
+    nearest centroid. :meth:`search` only scans the lists of the
+    ``num_probes`` centroids nearest to each query, trading recall for
+    speed.
+    """
+
+    def __init__(self, num_lists=256, num_probes=8, num_iters=20,
+                 max_train_samples=None, seed=0):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.centroids = None
+        self.reset()
+
+    def __len__(self):
+        return self.ntotal
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def reset(self):
+        num_lists = 0 if self.centroids is None else len(self.centroids)
+        self.ids = [np.zeros(0, dtype=np.int64) for _ in range(num_lists)]
+        self.vectors = [None] * num_lists
+        self.norms = [None] * num_lists
+        self.ntotal = 0
+
+    def train(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        num_lists = min(self.num_lists, len(x))
+        max_samples = self.max_train_samples or 256 * num_lists
+        self.centroids = kmeans(x, num_lists, num_iters=self.num_iters,
+                                max_samples=max_samples, seed=self.seed)
+        self.reset()
+
+    def add(self, x):
+        if not self.is_trained:
+            raise RuntimeError("The index must be trained before adding")
+        x = np.asarray(x, dtype=np.float32)
+        assignments = assign(x, self.centroids)
+        ids = np.arange(self.ntotal, self.ntotal + len(x))
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        for l, rows in enumerate(np.split(order, np.cumsum(counts)[:-1])):
+            if len(rows) == 0:
+                continue
+            vectors = x[rows]
+            if self.vectors[l] is not None:
+                vectors = np.concatenate([self.vectors[l], vectors])
+            self.vectors[l] = vectors
+            self.norms[l] = (vectors ** 2).sum(axis=1)
+            self.ids[l] = np.concatenate([self.ids[l], ids[rows]])
+        self.ntotal += len(x)
+
+    def list_sizes(self):
+        return np.asarray([len(ids) for ids in self.ids])
+
+    def search(self, queries, topk, num_probes=None, block_size=1024):
+        """Approximate top-k of each query among the added vectors.
+
+        Returns ``(distances, indices)`` of shape ``(len(queries), topk)``
+        sorted by squared distance, padded with inf and -1 when the probed
+        lists hold fewer than ``topk`` vectors.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        num_probes = min(num_probes or self.num_probes, len(self.centroids))
+        top_dist = np.full((len(queries), topk), np.inf, dtype=np.float32)
+        top_indices = np.full((len(queries), topk), -1, dtype=np.int64)
+        for i in range(0, len(queries), block_size):
+            x = queries[i:i + block_size]
+            coarse = squared_distances(x, self.centroids)
+            probes = np.argpartition(coarse, num_probes - 1,
+                                     axis=1)[:, :num_probes]
+            dist, indices = top_dist[i:i + len(x)], top_indices[i:i + len(x)]
+            # Scan list by list, for all the queries probing it at once
+            for l in np.unique(probes):
+                if len(self.ids[l]) == 0:
+                    continue
+                rows = np.flatnonzero((probes == l).any(axis=1))
+                block = squared_distances(x[rows], self.vectors[l],
+                                          self.norms[l])
+                block_indices = np.broadcast_to(self.ids[l], block.shape)
+                dist[rows], indices[rows] = merge_topk(
+                    dist[rows], indices[rows], block, block_indices, topk)
+            top_dist[i:i + len(x)], top_indices[i:i + len(x)] = \
+                sort_topk(dist, indices)
+        return top_dist, top_indices
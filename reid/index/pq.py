@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from .utils import (kmeans, load_codes, save_codes, shortlist_search,
+                    squared_distances)
+
+
+class ProductQuantizer(object):
+    """Product quantization codec with uint8 codes.
+
+    The feature dimensions are split into ``num_subspaces`` contiguous
+    chunks, each quantized by its own k-means codebook of at most 256
+    centroids, so that a vector is stored as ``num_subspaces`` bytes.
+    """
+
+    def __init__(self, num_subspaces=8, num_centroids=256, num_iters=20,
+                 max_train_samples=None, seed=0):
+        if not 1 <= num_centroids <= 256:
+            raise ValueError("uint8 codes hold at most 256 centroids, got {}"
+                             .format(num_centroids))
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.num_iters = num_iters
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.codebooks = None
+
+    @property
+    def is_trained(self):
+        return self.codebooks is not None
+
+    @property
+    def code_size(self):
+        return self.num_subspaces
+
+    def _split(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if x.shape[1] % self.num_subspaces != 0:
+            raise ValueError("Feature dimension {} is not divisible into {} "
+                             "subspaces".format(x.shape[1],
+                                                self.num_subspaces))
+        return x.reshape(len(x), self.num_subspaces, -1)
+
+    def train(self, x):
+        x = self._split(x)
+        max_samples = self.max_train_samples or 256 * self.num_centroids
+        self.codebooks = np.stack([
+            kmeans(x[:, m], self.num_centroids, num_iters=self.num_iters,
+                   max_samples=max_samples, seed=self.seed + m)
+            for m in range(self.num_subspaces)])
+
+    def encode(self, x, block_size=4096):
+        x = self._split(x)
+        codes = np.zeros((len(x), self.num_subspaces), dtype=np.uint8)
+        for i in range(0, len(x), block_size):
+            for m, codebook in enumerate(self.codebooks):
+                codes[i:i + block_size, m] = squared_distances(
+                    x[i:i + block_size, m], codebook).argmin(axis=1)
+        return codes
+
+    def decode(self, codes):
+        x = np.stack([self.codebooks[m][codes[:, m]]
+                      for m in range(self.num_subspaces)], axis=1)
+        return x.reshape(len(codes), -1)
+
+    def distance_tables(self, queries):
+        """Squared distances of each query chunk to its codebook centroids.
+
+        Returns a ``(num_subspaces, num_centroids, len(queries))`` array, from
+        which :meth:`asymmetric_distances` looks up the distances to encoded
+        vectors without decoding them.
+        """
+        x = self._split(queries)
+        return np.stack([squared_distances(codebook, x[:, m])
+                         for m, codebook in enumerate(self.codebooks)])
+
+    @staticmethod
+    def asymmetric_distances(tables, codes):
+        # Sum of the table rows selected by the codes, each row holding the
+        # entries of all the queries contiguously
+        dist = np.zeros((len(codes), tables.shape[2]), dtype=np.float32)
+        for m in range(codes.shape[1]):
+            dist += tables[m][codes[:, m]]
+        return dist.T
+
+    def save(self, db, prefix='pq'):
+        db[prefix + '/codebooks'] = self.codebooks
+
+    def load(self, db, prefix='pq'):
+        self.codebooks = db[prefix + '/codebooks']
+        self.num_subspaces, self.num_centroids = self.codebooks.shape[:2]
+
+
+class PQIndex(object):
+    """Compact gallery index searched by asymmetric distance computation.
+
+    Added vectors are kept as :class:`ProductQuantizer` codes only. Queries
+    stay uncompressed and are compared to the codes through per-query
+    distance tables. With ``shortlist`` set, the raw vectors are kept too,
+    for :func:`shortlist_search` to re-score.
+    """
+
+    def __init__(self, num_subspaces=8, num_centroids=256, shortlist=None,
+                 num_iters=20, max_train_samples=None, seed=0):
+        self.quantizer = ProductQuantizer(
+            num_subspaces=num_subspaces, num_centroids=num_centroids,
+            num_iters=num_iters, max_train_samples=max_train_samples,
+            seed=seed)
+        self.shortlist = shortlist
+        self.reset()
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def is_trained(self):
+        return self.quantizer.is_trained
+
+    @property
+    def bytes_per_vector(self):
+        return self.quantizer.code_size
+
+    def reset(self):
+        self.codes = np.zeros((0, self.quantizer.num_subspaces),
+                              dtype=np.uint8)
+        self.vectors = None
+
+    def train(self, x):
+        self.quantizer.train(x)
+        self.reset()
+
+    def add(self, x):
+        if not self.is_trained:
+            raise RuntimeError("The index must be trained before adding")
+        x = np.asarray(x, dtype=np.float32)
+        self.codes = np.concatenate([self.codes, self.quantizer.encode(x)])
+        if self.shortlist is not None:
+            self.vectors = x if self.vectors is None else \
+                np.concatenate([self.vectors, x])
+
+    def search(self, queries, topk, shortlist=None, block_size=256):
+        """Top-k by asymmetric distance, see :func:`shortlist_search`."""
+        if shortlist is None:
+            shortlist = self.shortlist
+        return shortlist_search(
+            queries, self.codes, self.quantizer.distance_tables,
+            self.quantizer.asymmetric_distances, topk, vectors=self.vectors,
+            shortlist=shortlist, block_size=block_size)
+
+    def save(self, db, prefix='pq'):
+        self.quantizer.save(db, prefix)
+        save_codes(db, prefix, self.codes, self.vectors)
+
+    def load(self, db, prefix='pq'):
+        self.quantizer.load(db, prefix)
+        self.codes, self.vectors = load_codes(db, prefix)
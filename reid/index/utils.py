@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+
+def squared_distances(x, y, y_norms=None):
+    # Squared euclidean distances between the rows of x and y
+    if y_norms is None:
+        y_norms = (y ** 2).sum(axis=1)
+    dist = (x ** 2).sum(axis=1)[:, np.newaxis] + y_norms[np.newaxis, :] - \
+        2 * x.dot(y.T)
+    return np.maximum(dist, 0, out=dist)
+
+
+def merge_topk(dist, indices, new_dist, new_indices, topk):
+    # Running top-k of each row over the concatenated candidates
+    if dist is not None:
+        new_dist = np.concatenate([dist, new_dist], axis=1)
+        new_indices = np.concatenate([indices, new_indices], axis=1)
+    k = min(topk, new_dist.shape[1])
+    if k < new_dist.shape[1]:
+        part = np.argpartition(new_dist, k - 1, axis=1)[:, :k]
+        new_dist = np.take_along_axis(new_dist, part, axis=1)
+        new_indices = np.take_along_axis(new_indices, part, axis=1)
+    return new_dist, new_indices
+
+
+def sort_topk(dist, indices):
+    order = np.argsort(dist, axis=1, kind='stable')
+    return (np.take_along_axis(dist, order, axis=1),
+            np.take_along_axis(indices, order, axis=1))
+
+
+def rescore(x, vectors, indices):
+    # Exact squared distances of each row of x to its candidate vectors.
+    # Each candidate row is read once, in increasing order as h5py needs.
+    rows = np.unique(indices)
+    y = np.asarray(vectors[rows], dtype=np.float32)
+    positions = np.searchsorted(rows, indices)
+    dist = np.zeros(indices.shape, dtype=np.float32)
+    for q in range(len(x)):
+        dist[q] = ((y[positions[q]] - x[q]) ** 2).sum(axis=1)
+    return dist
+
+
+def shortlist_search(queries, codes, prepare, code_distances, topk,
+                     vectors=None, shortlist=0, block_size=256,
+                     code_block_size=4096):
+    """Top-k of each query among encoded vectors, optionally re-scored.
+
+    ``code_distances(prepare(x), codes[j:k])`` gives the approximate
+    distances of a block of queries to a block of codes. With ``shortlist``
+    non-zero, the ``max(shortlist, topk)`` best candidates of each query are
+    re-scored with exact squared distances to ``vectors``. Returns
+    ``(distances, indices)`` of shape ``(len(queries), topk)`` sorted by
+    distance, padded with inf and -1 when there are fewer than ``topk``
+    codes.
+    """
+    if shortlist and vectors is None:
+        raise RuntimeError("Re-scoring needs the raw vectors, add them "
+                           "with shortlist set")
+    queries = np.asarray(queries, dtype=np.float32)
+    num_candidates = max(shortlist, topk) if shortlist else topk
+    top_dist = np.full((len(queries), topk), np.inf, dtype=np.float32)
+    top_indices = np.full((len(queries), topk), -1, dtype=np.int64)
+    for i in range(0, len(queries), block_size):
+        x = queries[i:i + block_size]
+        prepared = prepare(x)
+        dist = indices = None
+        for j in range(0, len(codes), code_block_size):
+            block = code_distances(prepared, codes[j:j + code_block_size])
+            block_indices = np.broadcast_to(
+                np.arange(j, j + block.shape[1]), block.shape)
+            dist, indices = merge_topk(dist, indices, block, block_indices,
+                                       num_candidates)
+        if dist is None:
+            continue
+        if shortlist:
+            dist = rescore(x, vectors, indices)
+        dist, indices = sort_topk(dist, indices)
+        k = min(topk, dist.shape[1])
+        top_dist[i:i + len(x), :k] = dist[:, :k]
+        top_indices[i:i + len(x), :k] = indices[:, :k]
+    return top_dist, top_indices
+
+
+def save_codes(db, prefix, codes, vectors=None):
+    # Codes and raw vectors if any in a FeatureDatabase
+    db[prefix + '/codes'] = codes
+    if vectors is not None:
+        db[prefix + '/vectors'] = np.asarray(vectors)
+
+
+def load_codes(db, prefix):
+    # Codes, and the raw vectors left on disk if any: the database must stay
+    # open for re-scoring
+    vectors = None
+    if prefix + '/vectors' in db:
+        vectors = db.dataset(prefix + '/vectors')
+    return db[prefix + '/codes'], vectors
+
+
+def exact_search(queries, database, topk, block_size=1024):
+    """Exact top-k nearest database rows of each query by squared distance.
+
+    Returns ``(distances, indices)`` of shape ``(len(queries), topk)``,
+    sorted by distance.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    database = np.asarray(database, dtype=np.float32)
+    topk = min(topk, len(database))
+    norms = (database ** 2).sum(axis=1)
+    top_dist = np.zeros((len(queries), topk), dtype=np.float32)
+    top_indices = np.zeros((len(queries), topk), dtype=np.int64)
+    for i in range(0, len(queries), block_size):
+        x = queries[i:i + block_size]
+        dist = indices = None
+        for j in range(0, len(database), block_size):
+            block = squared_distances(x, database[j:j + block_size],
+                                      norms[j:j + block_size])
+            block_indices = np.broadcast_to(
+                np.arange(j, j + block.shape[1]), block.shape)
+            dist, indices = merge_topk(dist, indices, block, block_indices,
+                                       topk)
+        top_dist[i:i + len(x)], top_indices[i:i + len(x)] = \
+            sort_topk(dist, indices)
+    return top_dist, top_indices
+
+
+def recall_at_k(indices, exact_indices, k=None):
+    """Mean fraction of the exact top-k neighbours found in the top-k.
+
+    ``indices`` and ``exact_indices`` are the ``(m, >= k)`` neighbour
+    indices of an approximate and the exact search, -1 marking missing
+    neighbours.
+    """
+    if k is None:
+        k = exact_indices.shape[1]
+    found = [len(np.intersect1d(row[:k][row[:k] >= 0], exact_row[:k]))
+             for row, exact_row in zip(indices, exact_indices)]
+    return np.mean(found) / float(min(k, exact_indices.shape[1]))
+
+
+def kmeans(x, num_clusters, num_iters=20, max_samples=None, seed=0,
+           block_size=4096):
+    """Lloyd's k-means on the rows of ``x``.
+
+    Initialized with distinct random rows, on at most ``max_samples`` random
+    rows of ``x``. Empty clusters are re-seeded with random rows. Returns the
+    ``(num_clusters, dim)`` float32 centroids.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if max_samples is not None and len(x) > max_samples:
+        x = x[rng.choice(len(x), max_samples, replace=False)]
+    if num_clusters > len(x):
+        raise ValueError("Cannot train {} clusters on {} samples"
+                         .format(num_clusters, len(x)))
+    centroids = x[rng.choice(len(x), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignments = assign(x, centroids, block_size=block_size)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        empty = counts == 0
+        # Sum the rows of each cluster as contiguous runs
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(x[order].astype(np.float64),
+                               starts[~empty], axis=0)
+        centroids[~empty] = sums / counts[~empty, np.newaxis]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), empty.sum(),
+                                            replace=False)]
+    return centroids
+
+
+def assign(x, centroids, block_size=4096):
+    # Nearest centroid of each row of x
+    norms = (centroids ** 2).sum(axis=1)
+    assignments = np.zeros(len(x), dtype=np.int64)
+    for i in range(0, len(x), block_size):
+        assignments[i:i + block_size] = squared_distances(
+            x[i:i + block_size], centroids, norms).argmin(axis=1)
+    return assignments
@@ -3,14 +3,93 @@ import copy
 from torch import nn
 import torch
 import torch.nn.functional as F
+from torch.autograd import Variable
 import pdb
 
 
+def fold_square_embed(bn=None, classifier=None, num_features=None):
+    """Fold an inference-mode BN and a classifier on squared differences.
+
+    ``classifier(bn((p - g) ** 2))`` is ``((p - g) ** 2) W^T + b`` with a
+    per-dimension weight ``W`` of shape (num_classes, num_features) and a
+    bias ``b`` of shape (num_classes,), which are returned. Without a
+    classifier the BN outputs are summed, as a single class.
+    """
+    if classifier is not None:
+        weight = classifier.weight.data.clone()
+        bias = classifier.bias.data.clone()
+    else:
+        if num_features is None:
+            num_features = bn.num_features
+        weight = torch.ones(1, num_features)
+        bias = torch.zeros(1)
+        if bn is not None:
+            weight, bias = weight.type_as(bn.weight.data), bias.type_as(bn.weight.data)
+    if bn is not None:
+        scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias.data - bn.running_mean * scale
+        bias = bias + torch.mv(weight, shift)
+        weight = weight * scale.unsqueeze(0)
+    return weight, bias
+
+
+def square_grid_scores(probe_x, gallery_x, weight, bias):
+    """Scores ``((p - g) ** 2) W^T + b`` of every probe and gallery pair.
+
+    Expands the weighted squared distance into norms and a matrix product,
+    so that no (N_probe, N_gallery, num_features) tensor is materialized.
+    Returns a (N_probe, N_gallery, num_classes) tensor.
+    """
+    probe_norms = torch.mm(probe_x.pow(2), weight.t())
+    gallery_norms = torch.mm(gallery_x.pow(2), weight.t())
+    cross = torch.matmul(probe_x.unsqueeze(0) * weight.unsqueeze(1),
+                         gallery_x.t())
+    scores = probe_norms.t().unsqueeze(2) + gallery_norms.t().unsqueeze(1) - \
+        2 * cross + bias.view(-1, 1, 1)
+    return scores.permute(1, 2, 0).contiguous()
+
+
+def _torch_version():
+    # (major, minor) of the installed torch
+    return tuple(int(v) for v in torch.__version__.split('.')[:2])
+
+
+def _fold_like(weight, bias, x):
+    # Folded parameters with the type of x, wrapped for Variable inputs
+    data = x.data if isinstance(x, Variable) else x
+    weight, bias = weight.type_as(data), bias.type_as(data)
+    if isinstance(x, Variable):
+        weight, bias = Variable(weight), Variable(bias)
+    return weight, bias
+
+
 class RandomWalkEmbed(nn.Module):
-    def __init__(self, instances_num=4, feat_num=2048, num_classes=0, drop_ratio=0.5):
+    """Pairwise classifier on the squared difference of two features.
+
+    During training the (N_probe, N_gallery, feat_num) grid of differences
+    is built at once, unless ``tile_size`` is given. Then only ``tile_size``
+    probe rows of the grid are materialized at a time, the BN batch
+    statistics of the whole grid are derived in closed form from the
+    moments of the features, and the tiles are recomputed in the backward
+    pass. Outputs, gradients and running statistics are the same up to
+    rounding, except that dropout masks are drawn tile by tile and hence
+    differ from those of the untiled forward under the same seed. Tiling
+    needs torch >= 0.4 for checkpointing, and torch >= 1.1 with dropout, so
+    that the recomputed tiles draw the same dropout masks.
+    """
+
+    # Grid-sized tensors alive at the peak of the untiled forward: the
+    # expanded probe and gallery copies, their difference, its square, the
+    # BN output, the dropout mask and the dropout output. The backward pass
+    # frees them as it creates their gradients. Used by peak_memory only.
+    GRID_TENSORS = 7
+
+    def __init__(self, instances_num=4, feat_num=2048, num_classes=0, drop_ratio=0.5,
+                 tile_size=None):
         super(RandomWalkEmbed, self).__init__()
         self.instances_num = instances_num
         self.feat_num = feat_num
+        self.tile_size = tile_size
         self.bn = nn.BatchNorm1d(feat_num)
         self.bn.weight.data.fill_(1)
         self.bn.bias.data.zero_()
@@ -21,6 +100,10 @@ class RandomWalkEmbed(nn.Module):
 
 
     def forward(self, probe_x, gallery_x):
+        if not self.training:
+            return self.grid_scores(probe_x, gallery_x)
+        if self.tile_size is not None:
+            return self.tiled_forward(probe_x, gallery_x)
         probe_x.contiguous()
         gallery_x.contiguous()
         N_probe = probe_x.size(0)
@@ -34,16 +117,90 @@ class RandomWalkEmbed(nn.Module):
         gallery_x = gallery_x.expand(N_probe, N_gallery, self.feat_num)
         gallery_x = gallery_x.contiguous()
 
+        cls_encode = self.pair_forward(probe_x.view(N_probe * N_gallery, -1),
+                                       gallery_x.view(N_probe * N_gallery, -1))
+        cls_encode = cls_encode.view(N_probe, N_gallery, -1)
+
+        return cls_encode
+
+    def pair_forward(self, probe_x, gallery_x):
+        # Scores of the pairs formed by the i-th rows of probe_x and gallery_x
         diff = torch.pow(probe_x - gallery_x, 2)
-        diff = diff.view(N_probe * N_gallery, -1)
         diff = diff.contiguous()
         bn_diff = self.bn(diff)
         bn_diff = self.drop(bn_diff)
 
-        cls_encode = self.classifier(bn_diff)
-        cls_encode = cls_encode.view(N_probe, N_gallery, -1)
+        return self.classifier(bn_diff)
 
-        return cls_encode
+    def grid_scores(self, probe_x, gallery_x):
+        # Inference-only scores of all the probe and gallery pairs, with the
+        # BN and the classifier folded into per-dimension weights
+        weight, bias = fold_square_embed(self.bn, self.classifier)
+        weight, bias = _fold_like(weight, bias, probe_x)
+        return square_grid_scores(probe_x, gallery_x, weight, bias)
+
+    def tiled_forward(self, probe_x, gallery_x):
+        # Training forward over tiles of tile_size probe rows
+        from torch.utils.checkpoint import checkpoint
+        kwargs = {}
+        if self.drop.p > 0:
+            # The recomputed tiles must replay the dropout masks
+            if _torch_version() < (1, 1):
+                raise RuntimeError("Tiled training with dropout needs "
+                                   "torch >= 1.1")
+            kwargs['preserve_rng_state'] = True
+        N_probe, N_gallery = probe_x.size(0), gallery_x.size(0)
+        mean, var = self._grid_moments(probe_x, gallery_x)
+        self._update_running_stats(mean.data, var.data, N_probe * N_gallery)
+        scale = self.bn.weight / torch.sqrt(var + self.bn.eps)
+        shift = self.bn.bias - mean * scale
+        tiles = []
+        for i in range(0, N_probe, self.tile_size):
+            tiles.append(checkpoint(self._tile_scores,
+                                    probe_x[i:i + self.tile_size], gallery_x,
+                                    scale, shift, **kwargs))
+        return torch.cat(tiles, 0)
+
+    def _tile_scores(self, probe_x, gallery_x, scale, shift):
+        diff = torch.pow(probe_x.unsqueeze(1) - gallery_x.unsqueeze(0), 2)
+        bn_diff = self.drop(diff * scale + shift)
+        return self.classifier(bn_diff)
+
+    def _grid_moments(self, probe_x, gallery_x):
+        # Mean and biased variance over all the pairs of (p - g) ** 2, from
+        # the first four moments of p and g, in double precision
+        p, g = probe_x.double(), gallery_x.double()
+        p1, p2, p3, p4 = [p.pow(k).mean(0) for k in range(1, 5)]
+        g1, g2, g3, g4 = [g.pow(k).mean(0) for k in range(1, 5)]
+        mean = p2 - 2 * p1 * g1 + g2
+        sq_mean = p4 - 4 * p3 * g1 + 6 * p2 * g2 - 4 * p1 * g3 + g4
+        var = (sq_mean - mean.pow(2)).clamp(min=0)
+        return mean.type_as(probe_x), var.type_as(probe_x)
+
+    def _update_running_stats(self, mean, var, n):
+        bn = self.bn
+        momentum = bn.momentum
+        if getattr(bn, 'num_batches_tracked', None) is not None:
+            bn.num_batches_tracked += 1
+            if momentum is None:
+                momentum = 1. / float(bn.num_batches_tracked)
+        bn.running_mean.mul_(1 - momentum).add_(momentum * mean)
+        bn.running_var.mul_(1 - momentum).add_(
+            momentum * var * n / max(n - 1, 1))
+
+    def peak_memory(self, N_probe, N_gallery, bytes_per_element=4):
+        """Estimated peak bytes of the pair grid in a training step.
+
+        An estimate, not a measurement: counts GRID_TENSORS tensors of
+        (rows, N_gallery, feat_num) elements, rows being ``tile_size`` if
+        set, or ``N_probe``. Features, weights and the (N_probe, N_gallery,
+        num_classes) outputs are left out. Use
+        ``torch.cuda.max_memory_allocated`` for the actual peak.
+        """
+        rows = N_probe if self.tile_size is None else \
+            min(self.tile_size, N_probe)
+        return self.GRID_TENSORS * rows * N_gallery * self.feat_num * \
+            bytes_per_element
 
 
 class EltwiseSubEmbed(nn.Module):
@@ -79,4 +236,141 @@ class EltwiseSubEmbed(nn.Module):
         else:
             x = x.sum(1)
 
-        return x
\ No newline at end of file
+        return x
+
+    def grid_scores(self, probe_x, gallery_x):
+        # Inference-only scores of all the probe and gallery pairs, with the
+        # BN and the classifier folded into per-dimension weights. Returns a
+        # (N_probe, N_gallery, num_classes) tensor, num_classes being 1
+        # without a classifier.
+        if self.nonlinearity != 'square':
+            raise ValueError("Only the square nonlinearity can be folded")
+        bn = self.bn if self.use_batch_norm else None
+        classifier = self.classifier if self.use_classifier else None
+        weight, bias = fold_square_embed(bn, classifier,
+                                         num_features=probe_x.size(1))
+        weight, bias = _fold_like(weight, bias, probe_x)
+        return square_grid_scores(probe_x, gallery_x, weight, bias)
+
+
+class GroupedRandomWalkEmbed(nn.Module):
+    """RandomWalkEmbed heads of ``num_groups`` feature groups in one module.
+
+    Head g scores the g-th slice of ``feat_num`` channels of the features.
+    The BN of all the heads is a single BatchNorm1d over ``num_groups *
+    feat_num`` channels and the classifiers are stacked into a (num_groups,
+    num_classes, feat_num) weight, so that all the groups are computed by
+    batched operations. Scores are returned group first.
+    """
+
+    def __init__(self, num_groups, feat_num=2048, num_classes=2, drop_ratio=0.5):
+        super(GroupedRandomWalkEmbed, self).__init__()
+        self.num_groups = num_groups
+        self.feat_num = feat_num
+        self.num_classes = num_classes
+        self.bn = nn.BatchNorm1d(num_groups * feat_num)
+        self.bn.weight.data.fill_(1)
+        self.bn.bias.data.zero_()
+        self.classifier_weight = nn.Parameter(
+            torch.Tensor(num_groups, num_classes, feat_num).normal_(0, 0.001))
+        self.classifier_bias = nn.Parameter(
+            torch.zeros(num_groups, num_classes))
+        self.drop = nn.Dropout(drop_ratio)
+
+    @classmethod
+    def from_embeds(cls, embeds):
+        # Grouped module initialized with a copy of the parameters of
+        # RandomWalkEmbed heads. The heads are not shared: train and
+        # optimize the returned module, the heads can be discarded.
+        model = cls(len(embeds), feat_num=embeds[0].feat_num,
+                    num_classes=embeds[0].classifier.out_features,
+                    drop_ratio=embeds[0].drop.p)
+        model.load_group_state_dicts([embed.state_dict() for embed in embeds])
+        return model
+
+    def load_group_state_dicts(self, state_dicts):
+        # Stack the state dicts of per-group RandomWalkEmbed heads
+        for name in ('weight', 'bias', 'running_mean', 'running_var'):
+            value = torch.cat([state_dict['bn.' + name]
+                               for state_dict in state_dicts])
+            getattr(self.bn, name).data.copy_(value)
+        self.classifier_weight.data.copy_(torch.stack(
+            [state_dict['classifier.weight'] for state_dict in state_dicts]))
+        self.classifier_bias.data.copy_(torch.stack(
+            [state_dict['classifier.bias'] for state_dict in state_dicts]))
+
+    @staticmethod
+    def convert_state_dict(state_dict, num_groups, prefix='embed_',
+                           grouped_prefix='embed.'):
+        """Translate per-group ``<prefix><i>.*`` keys to the grouped module.
+
+        Returns a state dict where the keys of the RandomWalkEmbed heads
+        ``prefix + '0'`` to ``prefix + str(num_groups - 1)`` are replaced by
+        the stacked parameters under ``grouped_prefix``. Other keys are kept.
+        """
+        heads = ['{}{}.'.format(prefix, i) for i in range(num_groups)]
+        if not all(head + 'bn.weight' in state_dict for head in heads):
+            return state_dict
+        converted = type(state_dict)()
+        for key, value in state_dict.items():
+            if not any(key.startswith(head) for head in heads):
+                converted[key] = value
+        for name in ('weight', 'bias', 'running_mean', 'running_var'):
+            converted[grouped_prefix + 'bn.' + name] = torch.cat(
+                [state_dict[head + 'bn.' + name] for head in heads])
+        if heads[0] + 'bn.num_batches_tracked' in state_dict:
+            converted[grouped_prefix + 'bn.num_batches_tracked'] = \
+                state_dict[heads[0] + 'bn.num_batches_tracked']
+        converted[grouped_prefix + 'classifier_weight'] = torch.stack(
+            [state_dict[head + 'classifier.weight'] for head in heads])
+        converted[grouped_prefix + 'classifier_bias'] = torch.stack(
+            [state_dict[head + 'classifier.bias'] for head in heads])
+        return converted
+
+    def forward(self, probe_x, gallery_x):
+        if not self.training:
+            return self.grid_scores(probe_x, gallery_x)
+        N_probe = probe_x.size(0)
+        N_gallery = gallery_x.size(0)
+        num_features = probe_x.size(1)
+
+        probe_x = probe_x.unsqueeze(1).expand(N_probe, N_gallery, num_features)
+        probe_x = probe_x.contiguous()
+        gallery_x = gallery_x.unsqueeze(0).expand(N_probe, N_gallery, num_features)
+        gallery_x = gallery_x.contiguous()
+
+        cls_encode = self.pair_forward(probe_x.view(N_probe * N_gallery, -1),
+                                       gallery_x.view(N_probe * N_gallery, -1))
+        return cls_encode.view(self.num_groups, N_probe, N_gallery, -1)
+
+    def pair_forward(self, probe_x, gallery_x):
+        # Scores (num_groups, N, num_classes) of the pairs formed by the i-th
+        # rows of probe_x and gallery_x
+        diff = torch.pow(probe_x - gallery_x, 2)
+        bn_diff = self.drop(self.bn(diff.contiguous()))
+        bn_diff = bn_diff.view(-1, self.num_groups, self.feat_num).transpose(0, 1)
+        scores = torch.bmm(bn_diff, self.classifier_weight.transpose(1, 2))
+        return scores + self.classifier_bias.unsqueeze(1)
+
+    def grid_scores(self, probe_x, gallery_x):
+        # Inference-only scores (num_groups, N_probe, N_gallery, num_classes)
+        # with the BN and the classifiers folded into per-dimension weights
+        G, d = self.num_groups, self.feat_num
+        bn = self.bn
+        scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+        shift = (bn.bias.data - bn.running_mean * scale).view(G, d, 1)
+        weight = self.classifier_weight.data * scale.view(G, 1, d)
+        bias = self.classifier_bias.data + \
+            torch.bmm(self.classifier_weight.data, shift).squeeze(2)
+        weight, bias = _fold_like(weight, bias, probe_x)
+
+        probe_x = probe_x.view(-1, G, d).transpose(0, 1)
+        gallery_x = gallery_x.view(-1, G, d).transpose(0, 1)
+        probe_norms = torch.bmm(probe_x.pow(2), weight.transpose(1, 2))
+        gallery_norms = torch.bmm(gallery_x.pow(2), weight.transpose(1, 2))
+        cross = torch.matmul(probe_x.unsqueeze(1) * weight.unsqueeze(2),
+                             gallery_x.transpose(1, 2).unsqueeze(1))
+        scores = probe_norms.transpose(1, 2).unsqueeze(3) + \
+            gallery_norms.transpose(1, 2).unsqueeze(2) - 2 * cross + \
+            bias.view(G, -1, 1, 1)
+        return scores.permute(0, 2, 3, 1).contiguous()
@@ -1,24 +1,80 @@
+import math
 from torch import nn
 import torch
 import torch.nn.functional as F
 from torch.autograd import Variable
 import pdb
 
-
-def random_walk_compute(p_g_score, g_g_score, alpha):
-    # Random Walk Computation
-    one_diag = Variable(torch.eye(g_g_score.size(0)).cuda(), requires_grad=False)
+from .embedding import GroupedRandomWalkEmbed, _torch_version
+
+
+def _solve(A, B):
+    # Batched solution X of A X = B across torch versions
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'solve'):
+        return torch.linalg.solve(A, B)
+    if hasattr(torch, 'solve'):
+        return torch.solve(B, A)[0]
+    return torch.gesv(B, A)[0]
+
+
+def random_walk(affinity, scores, alpha, solver='solve', num_terms=None,
+                tol=1e-6):
+    """Random walk propagation of pairwise scores.
+
+    Applies ``(1 - alpha) * inverse(I - alpha * affinity)`` to ``scores``
+    along their gallery axis. ``affinity`` holds row-normalized transition
+    matrices of shape (B, K, K) and ``scores`` the scores of shape
+    (B, N, K, C) of N samples against the same K gallery samples, so that a
+    batch of B queries is propagated at once. Unbatched (K, K) and
+    (N, K, C) inputs are accepted as well.
+
+    ``solver`` is one of 'solve' for a batched linear solve, 'series' for
+    the power series of ``alpha * affinity`` truncated after ``num_terms``
+    terms, by default the fewest ones with a residual below ``tol``, which
+    is cheap for small alpha, and 'inverse' for the explicit inverse.
+    """
+    batched = affinity.dim() == 3
+    if not batched:
+        affinity, scores = affinity.unsqueeze(0), scores.unsqueeze(0)
+    B, N, K, C = scores.size()
+    # Gallery axis first, the other ones as columns: (B, K, N * C)
+    x = scores.permute(0, 2, 1, 3).contiguous().view(B, K, N * C)
+    if solver == 'series':
+        if num_terms is None:
+            num_terms = 1
+            if alpha > 0:
+                num_terms = max(1, int(math.ceil(math.log(tol) /
+                                                 math.log(alpha))))
+        out = term = x
+        for _ in range(num_terms - 1):
+            term = alpha * torch.matmul(affinity, term)
+            out = out + term
+        out = (1 - alpha) * out
+    elif solver in ('solve', 'inverse'):
+        eye = torch.eye(K).type_as(affinity)
+        system = eye.unsqueeze(0).expand(B, K, K) - alpha * affinity
+        if solver == 'solve':
+            out = (1 - alpha) * _solve(system, x)
+        else:
+            out = torch.matmul((1 - alpha) * torch.inverse(system), x)
+    else:
+        raise ValueError("Unknown random walk solver: {}".format(solver))
+    out = out.view(B, K, N, C).permute(0, 2, 1, 3).contiguous()
+    if not batched:
+        out = out[0]
+    return out
+
+
+def random_walk_compute(p_g_score, g_g_score, alpha, solver='solve'):
+    # Random Walk Computation, optionally batched over a leading group
+    # dimension of both scores
     g_g_score_sm = Variable(g_g_score.data.clone(), requires_grad=False)
     # Row Normalization
-    A = F.softmax(g_g_score_sm[:, :, 1].squeeze())
-    A = (1 - alpha) * torch.inverse(one_diag - alpha * A)
-    A = A.transpose(0, 1)
-    p_g_score = torch.matmul(p_g_score.permute(2, 0, 1), A).permute(1, 2, 0).contiguous()
-    g_g_score = torch.matmul(g_g_score.permute(2, 0, 1), A).permute(1, 2, 0).contiguous()
-    p_g_score = p_g_score.view(-1, 2)
-    g_g_score = g_g_score.view(-1, 2)
-    outputs = torch.cat((p_g_score, g_g_score), 0)
-    outputs = outputs.contiguous()
+    A = F.softmax(g_g_score_sm[..., 1], dim=-1)
+    # Propagate the probe and gallery rows in one go
+    outputs = random_walk(A, torch.cat((p_g_score, g_g_score), -3), alpha,
+                          solver=solver)
+    outputs = outputs.view(-1, 2)
 
     return outputs
 
@@ -64,14 +120,19 @@ class RandomWalkNet(nn.Module):
 
 
 class RandomWalkNetGrp(nn.Module):
-    def __init__(self, instances_num=4, base_model=None, embed_model=None, alpha=0.1):
+    def __init__(self, instances_num=4, base_model=None, embed_model=None, alpha=0.1,
+                 solver='solve'):
         super(RandomWalkNetGrp, self).__init__()
         self.instances_num = instances_num
         self.alpha = alpha
+        self.solver = solver
         self.base = base_model
+        # All the group heads as one batched module. A sequence of
+        # RandomWalkEmbed heads is copied into one: optimize the parameters
+        # of this module, not the ones of the heads.
+        if not isinstance(embed_model, GroupedRandomWalkEmbed):
+            embed_model = GroupedRandomWalkEmbed.from_embeds(list(embed_model))
         self.embed = embed_model
-        for i in range(len(embed_model)):
-            setattr(self, 'embed_'+str(i), embed_model[i])
 
     def forward(self, x):
         x = self.base(x)
@@ -84,18 +145,32 @@ class RandomWalkNetGrp(nn.Module):
         gallery_x = x[:, 1:self.instances_num, :]
         gallery_x = gallery_x.contiguous()
         gallery_x = gallery_x.view(-1, C)
-        count = 2048 / (len(self.embed))
-        outputs = []
-        for i in range(len(self.embed)):
-            p_g_score = self.embed[i](probe_x[:,i*count:(i+1)*count].contiguous(),
-                                      gallery_x[:,i*count:(i+1)*count].contiguous())
-            g_g_score = self.embed[i](gallery_x[:,i*count:(i+1)*count].contiguous(),
-                                      gallery_x[:,i*count:(i+1)*count].contiguous())
-
-            outputs.append(random_walk_compute(p_g_score, g_g_score, self.alpha))
 
-        outputs = torch.cat(outputs, 0)
-        return outputs
+        p_g_score = self.embed(probe_x, gallery_x)
+        g_g_score = self.embed(gallery_x, gallery_x)
+        return random_walk_compute(p_g_score, g_g_score, self.alpha,
+                                   solver=self.solver)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # Torch < 0.4 has no _load_from_state_dict hook: convert here, a
+        # parent module must load GroupedRandomWalkEmbed.convert_state_dict
+        if _torch_version() < (0, 4):
+            state_dict = GroupedRandomWalkEmbed.convert_state_dict(
+                state_dict, self.embed.num_groups)
+        return super(RandomWalkNetGrp, self).load_state_dict(
+            state_dict, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Also load checkpoints with one embed_<i> module per group. Called
+        # before loading the children, from this module or any parent.
+        converted = GroupedRandomWalkEmbed.convert_state_dict(
+            state_dict, self.embed.num_groups, prefix=prefix + 'embed_',
+            grouped_prefix=prefix + 'embed.')
+        if converted is not state_dict:
+            state_dict.clear()
+            state_dict.update(converted)
+        super(RandomWalkNetGrp, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
 
 
 class SiameseNet(nn.Module):
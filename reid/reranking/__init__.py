@@ -0,0 +1,9 @@
+from __future__ import absolute_import
+
+from .k_reciprocal import k_reciprocal_rerank
+from .query_expansion import query_expansion
+
+__all__ = [
+    'k_reciprocal_rerank',
+    'query_expansion',
+]
@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+
+import numpy as np
+from scipy import sparse
+
+from ..evaluators import blocked_pairwise_distance, _stack_features
+from ..utils import to_numpy
+
+
+def _row_block_size(memory_budget, num_samples, block_size):
+    # Rows of the (rows, num_samples) float32 distances and their int64
+    # argpartition indices that fit in memory_budget bytes
+    if memory_budget is None:
+        return block_size
+    return max(1, int(memory_budget // (12 * num_samples)))
+
+
+def _nearest_neighbors(features, items, k, num_query, lambda_value, out,
+                       metric=None, block_size=1024, memory_budget=None):
+    # k nearest neighbors and largest distance of every sample, computed from
+    # blocks of rows of the distances between all the samples. The
+    # normalized query-gallery distances, weighted by lambda_value, are
+    # written into out on the way.
+    n = len(items)
+    rows = _row_block_size(memory_budget, n, block_size)
+    knn = np.zeros((n, k), dtype=np.int64)
+    row_max = np.zeros(n, dtype=np.float32)
+    for i in range(0, n, rows):
+        dist = blocked_pairwise_distance(features, items[i:i + rows], items,
+                                         metric=metric, block_size=block_size)
+        np.maximum(dist, 0, out=dist)
+        block_max = dist.max(axis=1)
+        block_max[block_max == 0] = 1
+        row_max[i:i + len(dist)] = block_max
+        if i < num_query:
+            num = min(num_query - i, len(dist))
+            out[i:i + num] = lambda_value * dist[:num, num_query:] / \
+                block_max[:num, np.newaxis]
+        part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(dist, part, 1), axis=1,
+                           kind='stable')
+        knn[i:i + len(dist)] = np.take_along_axis(part, order, 1)
+    return knn, row_max
+
+
+def _k_reciprocal_neighbors(knn, i, k):
+    forward = knn[i, :k]
+    backward = knn[forward, :k]
+    return forward[(backward == i).any(axis=1)]
+
+
+def k_reciprocal_rerank(features, query, gallery, k1=20, k2=6,
+                        lambda_value=0.3, metric=None, block_size=1024,
+                        memory_budget=None, out=None):
+    """k-reciprocal encoding re-ranking [Zhong et al., CVPR 2017].
+
+    Returns the re-ranked query-gallery distances, a ``(len(query),
+    len(gallery))`` float32 matrix for :func:`~reid.evaluators.evaluate_all`,
+    written into ``out`` if given (e.g. a numpy memmap).
+
+    Instead of the dense (q + g)^2 matrices of the reference algorithm, the
+    squared euclidean distances between all the samples are computed by
+    :func:`~reid.evaluators.blocked_pairwise_distance` for ``block_size``
+    rows at a time, or as many rows as fit in ``memory_budget`` bytes, and
+    only their k-nearest neighbors and row maxima are kept. The k-reciprocal
+    encodings form a sparse matrix whose columns are scanned for the sparse
+    Jaccard distances, so that memory grows linearly with the number of
+    samples. Unlike the reference, the encodings are kept in full precision
+    rather than float16.
+    """
+    items = list(query) + list(gallery)
+    m, n = len(query), len(items)
+    k1 = min(k1, n - 1)
+    k2 = min(k2, n)
+    if out is None:
+        out = np.zeros((m, n - m), dtype=np.float32)
+    knn, row_max = _nearest_neighbors(
+        features, items, max(k1 + 1, k2), m, lambda_value, out,
+        metric=metric, block_size=block_size, memory_budget=memory_budget)
+
+    # Sparse k-reciprocal encodings, weighted by the normalized distances
+    half_k1 = int(np.around(k1 / 2.)) + 1
+    indptr, indices, data = [0], [], []
+    for i in range(n):
+        k_reciprocal_index = _k_reciprocal_neighbors(knn, i, k1 + 1)
+        expansion = [k_reciprocal_index]
+        for candidate in k_reciprocal_index:
+            candidate_index = _k_reciprocal_neighbors(knn, candidate, half_k1)
+            if len(np.intersect1d(candidate_index, k_reciprocal_index)) > \
+                    2. / 3 * len(candidate_index):
+                expansion.append(candidate_index)
+        expansion = np.unique(np.concatenate(expansion))
+        x = to_numpy(_stack_features(features, [items[i][0]], metric))
+        y = to_numpy(_stack_features(
+            features, [items[j][0] for j in expansion], metric))
+        dist = (x ** 2).sum() + (y ** 2).sum(axis=1) - 2 * y.dot(x[0])
+        weight = np.exp(-np.maximum(dist, 0) / row_max[i])
+        indices.append(expansion)
+        data.append(weight / weight.sum())
+        indptr.append(indptr[-1] + len(expansion))
+    V = sparse.csr_matrix((np.concatenate(data), np.concatenate(indices),
+                           indptr), shape=(n, n))
+
+    if k2 != 1:
+        # Local query expansion: average the encodings of the k2 neighbors
+        rows = np.repeat(np.arange(n), k2)
+        expand = sparse.csr_matrix(
+            (np.full(n * k2, 1. / k2), (rows, knn[:, :k2].ravel())),
+            shape=(n, n))
+        V = expand.dot(V).tocsr()
+
+    # Sparse Jaccard distances, scanning the gallery encodings by column
+    gallery_V = V[m:].tocsc()
+    for i in range(m):
+        start, end = V.indptr[i], V.indptr[i + 1]
+        cols, values = V.indices[start:end], V.data[start:end]
+        shared = gallery_V[:, cols].tocoo()
+        temp_min = np.bincount(
+            shared.row, np.minimum(shared.data, values[shared.col]),
+            minlength=n - m)
+        out[i] += (1 - lambda_value) * (1 - temp_min / (2 - temp_min))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+from ..evaluators import blocked_pairwise_distance, _stack_features
+
+
+def query_expansion(features, query, gallery, topk=5, alpha=0., metric=None,
+                    block_size=1024):
+    """Replace each query feature by an average over its top-k neighbours.
+
+    The top-k gallery neighbours of the queries come from a first pass of
+    :func:`~reid.evaluators.blocked_pairwise_distance`, so the full distance
+    matrix is never resident. Each query is then re-expressed as the weighted
+    mean of itself (weight 1) and its neighbours, weighted by
+    ``max(cos, 0) ** alpha`` of their cosine similarity to the query:
+    ``alpha=0`` gives average query expansion and ``alpha > 0`` alpha-weighted
+    query expansion. The neighbours of ``block_size`` queries are gathered and
+    aggregated at once by batched matrix products.
+
+    Returns a copy of ``features`` with the query features expanded, for
+    :func:`~reid.evaluators.pairwise_distance` and the like. Query and gallery
+    must not share samples, whose gallery features would change as well.
+    """
+    _, top_indices = blocked_pairwise_distance(
+        features, query, gallery, metric=metric, block_size=block_size,
+        topk=topk)
+    gallery_fnames = [f for f, _, _ in gallery]
+    expanded = OrderedDict(features)
+    for i in range(0, len(query), block_size):
+        fnames = [f for f, _, _ in query[i:i + block_size]]
+        indices = top_indices[i:i + len(fnames)]
+        x = _stack_features(features, fnames)
+        y = _stack_features(features, [gallery_fnames[j]
+                                       for j in indices.ravel()])
+        y = y.view(len(fnames), indices.shape[1], -1)
+        if alpha > 0:
+            sim = torch.bmm(F.normalize(y, dim=2),
+                            F.normalize(x, dim=1).unsqueeze(2)).squeeze(2)
+            weights = sim.clamp(min=0).pow(alpha)
+        else:
+            weights = torch.ones(y.size(0), y.size(1)).type_as(y)
+        x = (x + torch.bmm(weights.unsqueeze(1), y).squeeze(1)) / \
+            (1 + weights.sum(1, keepdim=True))
+        for f, feature in zip(fnames, x):
+            expanded[f] = feature.view_as(features[f])
+    return expanded
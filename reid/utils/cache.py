@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PairwiseScoreCache(object):
+    """LRU cache of pairwise scores, bounded by its memory.
+
+    Scores are stored in blocks per row: the block of ``(group, a)`` holds
+    the sorted column indices ``b`` cached so far with their score vectors.
+    :meth:`lookup` gathers a whole ``rows x cols`` grid with one vectorized
+    search, and :meth:`update` merges new pairs into their rows. Rows are
+    evicted least recently used first. Counts the hits and misses of pairs.
+    """
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+
+    def __len__(self):
+        # Number of cached pairs
+        return sum(len(cols) for cols, _ in self._rows.values())
+
+    def __contains__(self, key):
+        group, a, b = key
+        block = self._rows.get((group, int(a)))
+        if block is None:
+            return False
+        cols = block[0]
+        i = np.searchsorted(cols, b)
+        return i < len(cols) and cols[i] == b
+
+    def lookup(self, group, rows, cols):
+        """Cached scores of the pairs ``(rows[i], cols[j])``.
+
+        Returns a ``(len(rows), len(cols))`` boolean mask of the cached pairs
+        and their ``(mask.sum(), ...)`` scores in row-major order, None if no
+        pair is cached.
+        """
+        cols = np.asarray(cols, dtype=np.int64)
+        keys, blocks = [], []
+        for i, a in enumerate(rows):
+            key = (group, int(a))
+            block = self._rows.pop(key, None)
+            if block is None:
+                continue
+            # Mark as most recently used
+            self._rows[key] = block
+            keys.append(i)
+            blocks.append(block)
+        found = np.zeros((len(rows), len(cols)), dtype=bool)
+        if len(blocks) == 0 or found.size == 0:
+            self.misses += found.size
+            return found, None
+        # Columns of all the cached rows, each shifted past the previous
+        # ones, form a single sorted array to search the whole grid in
+        stride = max(int(cols.max()), max(int(b[0][-1]) for b in blocks)) + 1
+        cached = np.concatenate([block[0] + i * stride
+                                 for i, block in zip(keys, blocks)])
+        scores = np.concatenate([block[1] for block in blocks])
+        queries = np.arange(len(rows))[:, np.newaxis] * stride + cols
+        pos = np.minimum(np.searchsorted(cached, queries), len(cached) - 1)
+        found = cached[pos] == queries
+        self.hits += int(found.sum())
+        self.misses += found.size - int(found.sum())
+        return found, scores[pos[found]]
+
+    def update(self, group, rows, cols, scores):
+        """Add the scores ``(n, ...)`` of the pairs ``(rows[k], cols[k])``."""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        order = np.lexsort((cols, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(rows)]):
+            key = (group, int(rows[start]))
+            new_cols, new_scores = cols[start:end], scores[start:end]
+            block = self._rows.pop(key, None)
+            if block is not None:
+                self.num_bytes -= self._block_bytes(key, block)
+                new_cols = np.concatenate([block[0], new_cols])
+                new_scores = np.concatenate([block[1], new_scores])
+                new_cols, index = np.unique(new_cols, return_index=True)
+                new_scores = new_scores[index]
+            # Owned copies, not views keeping the whole update alive
+            block = (np.array(new_cols, copy=True),
+                     np.array(new_scores, dtype=np.float32, copy=True))
+            self._rows[key] = block
+            self.num_bytes += self._block_bytes(key, block)
+        # Evict the least recently used rows
+        while self.num_bytes > self.max_bytes and len(self._rows) > 0:
+            key, evicted = self._rows.popitem(last=False)
+            self.num_bytes -= self._block_bytes(key, evicted)
+
+    def clear(self):
+        self._rows.clear()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _block_bytes(key, block):
+        # Data of the arrays and the key, the dict slot aside
+        return block[0].nbytes + block[1].nbytes + sys.getsizeof(key)
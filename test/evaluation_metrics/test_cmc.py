@@ -1,7 +1,8 @@
 from unittest import TestCase
 import numpy as np
 
-from reid.evaluation_metrics import cmc
+from reid.evaluation_metrics import (cmc, mean_ap, RankingContext,
+                                     PartialRankingContext)
 
 
 class TestCMC(TestCase):
@@ -32,3 +33,116 @@ class TestCMC(TestCase):
                   query_cams=query_cams, gallery_cams=gallery_cams, topk=5,
                   separate_camera_set=False, single_gallery_shot=False)
         self.assertTrue(np.all(ret == [0.6, 0.6, 0.6, 1, 1]))
+
+    def test_first_match_break(self):
+        distmat = np.tile(np.arange(5), (5, 1))
+        query_ids = [0,0,0,1,1]
+        gallery_ids = [0,0,0,1,1]
+        query_cams = [0,0,0,0,0]
+        gallery_cams = [0,1,1,1,1]
+        ret = cmc(distmat, query_ids=query_ids, gallery_ids=gallery_ids,
+                  query_cams=query_cams, gallery_cams=gallery_cams, topk=5,
+                  separate_camera_set=False, single_gallery_shot=False,
+                  first_match_break=True)
+        self.assertTrue(np.all(ret == [0.6, 0.6, 0.6, 1, 1]))
+
+    def test_separate_camera_set(self):
+        distmat = np.tile(np.arange(4), (2, 1))
+        query_ids = [0, 1]
+        gallery_ids = [1, 0, 1, 0]
+        query_cams = [0, 0]
+        gallery_cams = [0, 0, 1, 1]
+        ret = cmc(distmat, query_ids=query_ids, gallery_ids=gallery_ids,
+                  query_cams=query_cams, gallery_cams=gallery_cams, topk=2,
+                  separate_camera_set=True, single_gallery_shot=False,
+                  first_match_break=True)
+        self.assertTrue(np.all(ret == [0.5, 1]))
+
+    def test_ranking_context(self):
+        rng = np.random.RandomState(0)
+        distmat = rng.rand(20, 50)
+        query_ids = rng.randint(0, 5, 20)
+        gallery_ids = rng.randint(0, 5, 50)
+        query_cams = rng.randint(0, 2, 20)
+        gallery_cams = rng.randint(0, 2, 50)
+        args = (query_ids, gallery_ids, query_cams, gallery_cams)
+        ranking = RankingContext(distmat, *args)
+        for params in [dict(first_match_break=True),
+                       dict(separate_camera_set=True)]:
+            self.assertTrue(np.all(cmc(ranking, **params) ==
+                                   cmc(distmat, *args, **params)))
+        self.assertEqual(mean_ap(ranking), mean_ap(distmat, *args))
+        # Sorted a few rows at a time
+        blocked = RankingContext(distmat, *args, block_size=3)
+        for params in [dict(), dict(separate_camera_set=True)]:
+            self.assertTrue(np.all(cmc(blocked, **params) ==
+                                   cmc(ranking, **params)))
+        self.assertAlmostEqual(mean_ap(blocked), mean_ap(ranking))
+
+    def test_partial_ranking_context(self):
+        rng = np.random.RandomState(0)
+        distmat = rng.rand(20, 50)
+        args = (rng.randint(0, 5, 20), rng.randint(0, 5, 50),
+                rng.randint(0, 2, 20), rng.randint(0, 2, 50))
+        ranking = RankingContext(distmat, *args)
+        partial = PartialRankingContext(distmat, *args)
+        for params in [dict(first_match_break=True),
+                       dict(separate_camera_set=True)]:
+            self.assertTrue(np.all(cmc(ranking, **params) ==
+                                   cmc(partial, **params)))
+        self.assertAlmostEqual(mean_ap(ranking), mean_ap(partial))
+
+    def test_partial_ranking_integer_distances(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            args = (rng.randint(0, 5, 20), rng.randint(0, 5, 50),
+                    rng.randint(0, 2, 20), rng.randint(0, 2, 50))
+            # Tied distances may only reorder the CMC
+            distmat = np.asarray([rng.permutation(50) for _ in range(20)])
+            ranking = RankingContext(distmat, *args)
+            partial = PartialRankingContext(distmat, *args, block_size=7)
+            for params in [dict(), dict(separate_camera_set=True)]:
+                self.assertTrue(np.allclose(cmc(ranking, **params),
+                                            cmc(partial, **params)))
+            distmat = rng.randint(0, 10, (20, 50))
+            self.assertAlmostEqual(
+                mean_ap(RankingContext(distmat, *args)),
+                mean_ap(PartialRankingContext(distmat, *args, block_size=7)))
+
+    def test_partial_ranking_blocks(self):
+        rng = np.random.RandomState(0)
+        distmat = rng.randint(0, 5, (20, 50)).astype(np.float32)
+        distmat[rng.rand(20, 50) < 0.1] = np.inf
+        args = (rng.randint(0, 5, 20), rng.randint(0, 5, 50),
+                rng.randint(0, 2, 20), rng.randint(0, 2, 50))
+        expected = PartialRankingContext(distmat, *args)
+        partial = PartialRankingContext(distmat, *args, block_size=3)
+        for name in ['rows', 'pos_le', 'neg_lt', 'neg_le', 'same_cam_neg_lt',
+                     'num_matches']:
+            self.assertTrue(np.array_equal(getattr(partial, name),
+                                           getattr(expected, name)))
+        ranking = RankingContext(distmat, *args)
+        self.assertAlmostEqual(mean_ap(ranking), mean_ap(partial))
+
+    def test_single_gallery_shot(self):
+        distmat = np.tile(np.arange(4), (2, 1))
+        query_ids = [0, 1]
+        gallery_ids = [0, 0, 1, 1]
+        query_cams = [0, 0]
+        gallery_cams = [1, 1, 1, 1]
+        ret = cmc(distmat, query_ids=query_ids, gallery_ids=gallery_ids,
+                  query_cams=query_cams, gallery_cams=gallery_cams, topk=2,
+                  separate_camera_set=True, single_gallery_shot=True)
+        self.assertTrue(np.allclose(ret, [0.5, 1]))
+
+    def test_single_gallery_shot_seed(self):
+        rng = np.random.RandomState(0)
+        distmat = rng.rand(20, 50)
+        args = (rng.randint(0, 5, 20), rng.randint(0, 5, 50),
+                rng.randint(0, 2, 20), rng.randint(0, 2, 50))
+        params = dict(separate_camera_set=True, single_gallery_shot=True)
+        ret = cmc(distmat, *args, random_state=1, **params)
+        self.assertTrue(np.all(ret == cmc(distmat, *args, random_state=1,
+                                          **params)))
+        self.assertTrue(np.all(ret == cmc(
+            PartialRankingContext(distmat, *args), random_state=1, **params)))
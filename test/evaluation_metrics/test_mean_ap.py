@@ -0,0 +1,38 @@
+from unittest import TestCase
+import numpy as np
+from sklearn.metrics import average_precision_score
+
+from reid.evaluation_metrics import mean_ap
+
+
+def sklearn_mean_ap(distmat, query_ids, gallery_ids, query_cams, gallery_cams):
+    aps = []
+    for i in range(distmat.shape[0]):
+        valid = ((gallery_ids != query_ids[i]) |
+                 (gallery_cams != query_cams[i]))
+        y_true = (gallery_ids == query_ids[i])[valid]
+        if not np.any(y_true): continue
+        aps.append(average_precision_score(y_true, -distmat[i][valid]))
+    return np.mean(aps)
+
+
+class TestMeanAP(TestCase):
+    def test_perfect_ranking(self):
+        distmat = np.array([[0, 1, 2, 3],
+                            [1, 0, 2, 3]])
+        mAP = mean_ap(distmat, query_ids=[0, 1], gallery_ids=[0, 1, 2, 3])
+        self.assertEqual(mAP, 1)
+
+    def test_same_as_sklearn(self):
+        rng = np.random.RandomState(0)
+        m, n = 30, 200
+        query_ids = rng.randint(0, 10, m)
+        gallery_ids = rng.randint(0, 10, n)
+        query_cams = rng.randint(0, 3, m)
+        gallery_cams = rng.randint(0, 3, n)
+        for distmat in [rng.rand(m, n), rng.randint(0, 10, (m, n))]:
+            expected = sklearn_mean_ap(distmat, query_ids, gallery_ids,
+                                       query_cams, gallery_cams)
+            mAP = mean_ap(distmat, query_ids, gallery_ids,
+                          query_cams, gallery_cams)
+            self.assertAlmostEqual(mAP, expected, places=10)
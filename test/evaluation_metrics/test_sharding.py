@@ -0,0 +1,33 @@
+from collections import OrderedDict
+from unittest import TestCase
+import numpy as np
+
+from reid.evaluation_metrics import cmc, mean_ap, sharded_metrics
+
+
+class TestShardedMetrics(TestCase):
+    def test_independent_of_workers(self):
+        rng = np.random.RandomState(0)
+        distmat = rng.rand(50, 80)
+        args = (rng.randint(0, 10, 50), rng.randint(0, 10, 80),
+                rng.randint(0, 3, 50), rng.randint(0, 3, 80))
+        cmc_configs = OrderedDict([
+            ('allshots', dict(separate_camera_set=False,
+                              single_gallery_shot=False,
+                              first_match_break=False)),
+            ('cuhk03', dict(separate_camera_set=True,
+                            single_gallery_shot=True,
+                            first_match_break=False))])
+        results = [sharded_metrics(distmat, *args, cmc_configs=cmc_configs,
+                                   num_workers=num_workers, shard_size=16)
+                   for num_workers in (0, 1, 3)]
+        for mAP, cmc_scores in results[1:]:
+            self.assertEqual(mAP, results[0][0])
+            for name in cmc_configs:
+                self.assertTrue(np.all(cmc_scores[name] ==
+                                       results[0][1][name]))
+        mAP, cmc_scores = results[0]
+        self.assertAlmostEqual(mAP, mean_ap(distmat, *args))
+        self.assertTrue(np.allclose(
+            cmc_scores['allshots'],
+            cmc(distmat, *args, **cmc_configs['allshots'])))
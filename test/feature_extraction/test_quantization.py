@@ -0,0 +1,25 @@
+from unittest import TestCase
+
+import numpy as np
+
+from reid.feature_extraction.quantization import QuantizedFeatures
+
+
+class TestQuantizedFeatures(TestCase):
+    def test_modes(self):
+        rng = np.random.RandomState(0)
+        x = rng.rand(20, 16).astype(np.float32) * np.arange(1, 17)
+        for mode, itemsize in (('float32', 4), ('float16', 2), ('int8', 1)):
+            features = QuantizedFeatures(x, mode=mode,
+                                         fnames=[str(i) for i in range(20)])
+            self.assertEqual(features.bytes_per_vector, 16 * itemsize)
+            error = np.abs(features.dequantize() - x) / np.arange(1, 17)
+            self.assertLess(error.max(), 0.005)
+            rows = features.rows(['3', '1'])
+            self.assertTrue(np.allclose(features.dequantize(rows),
+                                        features.dequantize()[[3, 1]]))
+        # The offset cancels out of differences
+        self.assertTrue(np.allclose(
+            features.dequantize([0]) - features.dequantize([1]),
+            features.dequantize([0], offset=False) -
+            features.dequantize([1], offset=False), atol=1e-5))
@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+import numpy as np
+
+from reid.index import (BinaryIndex, exact_search, hamming_distances,
+                        pack_bits, recall_at_k)
+
+
+class TestBinaryIndex(TestCase):
+    def setUp(self):
+        # Low-rank features, which 16 principal bits can tell apart, and
+        # queries perturbed from gallery samples
+        rng = np.random.RandomState(0)
+        basis = rng.randn(8, 32)
+        self.gallery = rng.randn(600, 8).dot(basis).astype(np.float32)
+        self.query = (self.gallery[rng.choice(600, 30, replace=False)] +
+                      0.05 * rng.randn(30, 32)).astype(np.float32)
+
+    def test_hamming_distances(self):
+        rng = np.random.RandomState(0)
+        x, y = rng.rand(5, 70) > 0.5, rng.rand(8, 70) > 0.5
+        codes_x, codes_y = pack_bits(x), pack_bits(y)
+        self.assertEqual(codes_x.dtype, np.uint64)
+        self.assertEqual(codes_x.shape, (5, 2))
+        expected = (x[:, np.newaxis] != y[np.newaxis]).sum(2)
+        self.assertTrue((hamming_distances(codes_x, codes_y) ==
+                         expected).all())
+
+    def test_search(self):
+        exact_dist, exact_indices = exact_search(self.query, self.gallery, 10)
+        for method in ('sign', 'itq'):
+            index = BinaryIndex(num_bits=16, method=method, shortlist=50)
+            index.train(self.gallery)
+            index.add(self.gallery[:100])
+            index.add(self.gallery[100:])
+            self.assertEqual(len(index), 600)
+            self.assertEqual(index.bytes_per_vector, 8)
+            # Re-scoring the whole gallery is exact
+            dist, indices = index.search(self.query, 10, shortlist=600,
+                                         block_size=7)
+            self.assertTrue(np.allclose(dist, exact_dist, atol=1e-4))
+            self.assertEqual(recall_at_k(indices, exact_indices), 1)
+            _, indices = index.search(self.query, 10)
+            self.assertGreater(recall_at_k(indices, exact_indices), 0.5)
+
+    def test_hamming_only(self):
+        index = BinaryIndex(num_bits=16, shortlist=50)
+        index.train(self.gallery)
+        index.add(self.gallery)
+        dist, indices = index.search(self.query, 10, shortlist=0)
+        self.assertTrue((dist == np.rint(dist)).all())
+        expected = hamming_distances(index.encode(self.query), index.codes)
+        self.assertTrue((dist == np.sort(expected, axis=1)[:, :10]).all())
+        self.assertTrue((np.take_along_axis(expected, indices, axis=1) ==
+                         dist).all())
@@ -0,0 +1,83 @@
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from reid.index import GalleryStore, exact_search
+
+
+class TestGalleryStore(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.randn(50, 8).astype(np.float32)
+        self.entries = [('{}.jpg'.format(i), i // 5, i % 2) for i in range(50)]
+        self.query = rng.randn(6, 8).astype(np.float32)
+
+    def assertSearchMatches(self, store, live):
+        dist, fnames = store.search(self.query, 4, block_size=4)
+        exact_dist, exact_indices = exact_search(self.query, self.x[live], 4)
+        self.assertTrue(np.allclose(dist, exact_dist, atol=1e-4))
+        expected = [[self.entries[live[j]][0] for j in row]
+                    for row in exact_indices]
+        self.assertEqual(fnames.tolist(), expected)
+
+    def test_add_remove(self):
+        store = GalleryStore(8, block_capacity=16)
+        store.add(self.entries[:20], self.x[:20])
+        store.add(self.entries[20:], self.x[20:])
+        self.assertEqual(len(store), 50)
+        self.assertEqual(len(store.blocks), 4)
+        self.assertSearchMatches(store, np.arange(50))
+        self.assertEqual(store.remove(fnames=['0.jpg', '1.jpg'], pids=[3]), 7)
+        self.assertEqual(store.remove(fnames=['0.jpg']), 0)
+        live = np.setdiff1d(np.arange(50), [0, 1, 15, 16, 17, 18, 19])
+        self.assertEqual([e[0] for e in store.entries()],
+                         [self.entries[i][0] for i in live])
+        self.assertSearchMatches(store, live)
+        # Only the first block has enough tombstones
+        self.assertEqual(store.compact(), 1)
+        self.assertSearchMatches(store, live)
+        # Re-adding a fname replaces its sample
+        self.x[2] = self.query[0]
+        store.add([self.entries[2]], self.x[2:3])
+        self.assertEqual(len(store), 43)
+        dist, fnames = store.search(self.query[:1], 1)
+        self.assertEqual(fnames[0, 0], '2.jpg')
+        # Padded beyond the live samples
+        dist, fnames = store.search(self.query, 60)
+        self.assertTrue(np.isinf(dist[:, 43:]).all())
+        self.assertTrue((fnames[:, 43:] == None).all())  # noqa: E711
+
+    def test_duplicate_fnames(self):
+        store = GalleryStore(8, block_capacity=16)
+        store.add(self.entries[:10], self.x[:10])
+        # The last sample of a fname repeated in a batch replaces the others
+        self.x[3] = self.query[0]
+        store.add([self.entries[3], self.entries[12], self.entries[3]],
+                  np.stack([self.x[4], self.x[12], self.x[3]]))
+        self.assertEqual(len(store), 11)
+        self.assertEqual(sum(block.size - block.num_dead()
+                             for block in store.blocks), 11)
+        dist, fnames = store.search(self.query[:1], 11)
+        self.assertEqual(fnames[0].tolist().count('3.jpg'), 1)
+        self.assertEqual(fnames[0, 0], '3.jpg')
+        self.assertAlmostEqual(dist[0, 0], 0, places=4)
+        self.assertSearchMatches(store, np.r_[0:10, 12])
+        self.assertEqual(store.remove(fnames=['3.jpg']), 1)
+        self.assertEqual(len(store), 10)
+        dist, fnames = store.search(self.query[:1], 11)
+        self.assertNotIn('3.jpg', fnames[0].tolist())
+        self.assertTrue(np.isinf(dist[0, 10]))
+
+    def test_background_compaction(self):
+        with GalleryStore(8, block_capacity=16) as store:
+            store.add(self.entries, self.x)
+            store.start(interval=0.01)
+            store.remove(pids=range(4))
+            for _ in range(100):
+                if sum(block.size for block in store.blocks) == 30:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(sum(block.size for block in store.blocks), 30)
+            self.assertSearchMatches(store, np.arange(20, 50))
+        self.assertTrue(store._thread is None)
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+import numpy as np
+
+from reid.index import IVFIndex, exact_search, kmeans, recall_at_k
+
+
+class TestIVFIndex(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        centers = rng.randn(20, 8)
+        self.gallery = (centers[rng.randint(20, size=500)] +
+                        0.1 * rng.randn(500, 8)).astype(np.float32)
+        self.query = (centers[rng.randint(20, size=30)] +
+                      0.1 * rng.randn(30, 8)).astype(np.float32)
+
+    def test_exact_search(self):
+        dist, indices = exact_search(self.query, self.gallery, 10,
+                                     block_size=7)
+        full = ((self.query[:, np.newaxis] - self.gallery) ** 2).sum(2)
+        self.assertTrue(np.allclose(dist, np.sort(full, axis=1)[:, :10],
+                                    atol=1e-4))
+        self.assertEqual(
+            recall_at_k(indices, np.argsort(full, axis=1), k=10), 1)
+
+    def test_kmeans(self):
+        centroids = kmeans(self.gallery, 20, seed=1)
+        self.assertEqual(centroids.shape, (20, 8))
+
+    def test_search(self):
+        index = IVFIndex(num_lists=16, num_probes=2)
+        index.train(self.gallery)
+        index.add(self.gallery[:200])
+        index.add(self.gallery[200:])
+        self.assertEqual(len(index), 500)
+        self.assertEqual(index.list_sizes().sum(), 500)
+        exact_dist, exact_indices = exact_search(self.query, self.gallery, 10)
+        # Probing all the lists is exact
+        dist, indices = index.search(self.query, 10, num_probes=16,
+                                     block_size=7)
+        self.assertTrue(np.allclose(dist, exact_dist, atol=1e-4))
+        self.assertEqual(recall_at_k(indices, exact_indices), 1)
+        # Fewer probes lose some neighbours at most
+        _, indices = index.search(self.query, 10)
+        self.assertGreater(recall_at_k(indices, exact_indices), 0.5)
+        self.assertTrue(((indices >= 0) & (indices < 500)).all())
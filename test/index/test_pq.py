@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+import numpy as np
+
+from reid.index import PQIndex, ProductQuantizer, exact_search, recall_at_k
+
+
+class TestPQIndex(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        centers = rng.randn(20, 16)
+        self.gallery = (centers[rng.randint(20, size=600)] +
+                        0.1 * rng.randn(600, 16)).astype(np.float32)
+        self.query = (centers[rng.randint(20, size=30)] +
+                      0.1 * rng.randn(30, 16)).astype(np.float32)
+
+    def test_asymmetric_distances(self):
+        pq = ProductQuantizer(num_subspaces=4, num_centroids=32)
+        pq.train(self.gallery)
+        codes = pq.encode(self.gallery, block_size=100)
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertEqual(codes.shape, (600, 4))
+        decoded = pq.decode(codes)
+        expected = ((self.query[:, np.newaxis] - decoded) ** 2).sum(2)
+        dist = pq.asymmetric_distances(pq.distance_tables(self.query), codes)
+        self.assertTrue(np.allclose(dist, expected, atol=1e-3))
+
+    def test_search(self):
+        index = PQIndex(num_subspaces=4, num_centroids=32, shortlist=50)
+        index.train(self.gallery)
+        index.add(self.gallery[:100])
+        index.add(self.gallery[100:])
+        self.assertEqual(len(index), 600)
+        self.assertEqual(index.bytes_per_vector, 4)
+        exact_dist, exact_indices = exact_search(self.query, self.gallery, 10)
+        # Re-scoring the whole gallery is exact
+        dist, indices = index.search(self.query, 10, shortlist=600,
+                                     block_size=7)
+        self.assertTrue(np.allclose(dist, exact_dist, atol=1e-4))
+        self.assertEqual(recall_at_k(indices, exact_indices), 1)
+        _, indices = index.search(self.query, 10)
+        self.assertGreater(recall_at_k(indices, exact_indices), 0.5)
+        # Without re-scoring, the asymmetric distance estimates
+        dist, indices = index.search(self.query, 10, shortlist=0)
+        expected = index.quantizer.asymmetric_distances(
+            index.quantizer.distance_tables(self.query), index.codes)
+        self.assertTrue(np.allclose(dist, np.sort(expected, axis=1)[:, :10]))
+        self.assertFalse(np.allclose(dist, exact_dist, atol=1e-4))
+        # Padded beyond the gallery size
+        dist, indices = index.search(self.query, 700, shortlist=600)
+        self.assertTrue((indices[:, 600:] == -1).all())
+        self.assertTrue(np.isinf(dist[:, 600:]).all())
+
+    def test_save_load(self):
+        from reid.feature_extraction import FeatureDatabase
+
+        index = PQIndex(num_subspaces=4, num_centroids=32, shortlist=20)
+        index.train(self.gallery)
+        index.add(self.gallery)
+        expected = index.search(self.query, 10)
+        with FeatureDatabase('/tmp/open-reid/test_pq.h5', 'w') as db:
+            index.save(db)
+        with FeatureDatabase('/tmp/open-reid/test_pq.h5', 'r') as db:
+            loaded = PQIndex(shortlist=20)
+            loaded.load(db)
+            dist, indices = loaded.search(self.query, 10)
+        self.assertTrue(np.allclose(dist, expected[0]))
+        self.assertTrue((indices == expected[1]).all())
@@ -0,0 +1,158 @@
+from unittest import TestCase
+
+
+class TestGridScores(TestCase):
+    def _randomize_bn(self, bn):
+        bn.weight.data.uniform_(0.5, 1.5)
+        bn.bias.data.normal_()
+        bn.running_mean.uniform_(0, 1)
+        bn.running_var.uniform_(0.5, 1.5)
+
+    def test_random_walk_embed(self):
+        import torch
+        from reid.models.embedding import RandomWalkEmbed
+
+        model = RandomWalkEmbed(feat_num=16, num_classes=2)
+        self._randomize_bn(model.bn)
+        model.eval()
+        probe_x, gallery_x = torch.randn(5, 16), torch.randn(7, 16)
+        expected = model.pair_forward(
+            probe_x.unsqueeze(1).expand(5, 7, 16).contiguous().view(-1, 16),
+            gallery_x.repeat(5, 1)).view(5, 7, 2)
+        scores = model(probe_x, gallery_x)
+        self.assertEquals(scores.size(), (5, 7, 2))
+        self.assertLess((scores - expected).abs().max(), 1e-4)
+
+    def test_eltwise_sub_embed(self):
+        import torch
+        from reid.models.embedding import EltwiseSubEmbed
+
+        model = EltwiseSubEmbed(use_batch_norm=True, use_classifier=True,
+                                num_features=16, num_classes=2)
+        self._randomize_bn(model.bn)
+        model.eval()
+        probe_x, gallery_x = torch.randn(5, 16), torch.randn(7, 16)
+        expected = model(
+            probe_x.unsqueeze(1).expand(5, 7, 16).contiguous().view(-1, 16),
+            gallery_x.repeat(5, 1)).view(5, 7, 2)
+        scores = model.grid_scores(probe_x, gallery_x)
+        self.assertLess((scores - expected).abs().max(), 1e-4)
+
+
+class TestTiledForward(TestCase):
+    def test_same_as_untiled(self):
+        import copy
+        import torch
+        from torch.autograd import Variable
+        from reid.models.embedding import RandomWalkEmbed
+
+        model = RandomWalkEmbed(feat_num=16, num_classes=2, drop_ratio=0)
+        tiled = copy.deepcopy(model)
+        tiled.tile_size = 3
+        x = torch.randn(8, 16)
+        probe_x = Variable(x[:5].clone(), requires_grad=True)
+        gallery_x = Variable(x[5:].clone(), requires_grad=True)
+        tiled_probe_x = Variable(x[:5].clone(), requires_grad=True)
+        tiled_gallery_x = Variable(x[5:].clone(), requires_grad=True)
+        weight = torch.randn(5, 3, 2)
+
+        out = model(probe_x, gallery_x)
+        (out * Variable(weight)).sum().backward()
+        tiled_out = tiled(tiled_probe_x, tiled_gallery_x)
+        (tiled_out * Variable(weight)).sum().backward()
+
+        self.assertLess((out - tiled_out).abs().max().item(), 1e-5)
+        self.assertLess((probe_x.grad - tiled_probe_x.grad)
+                        .abs().max().item(), 1e-5)
+        self.assertLess((gallery_x.grad - tiled_gallery_x.grad)
+                        .abs().max().item(), 1e-5)
+        self.assertLess((model.bn.weight.grad - tiled.bn.weight.grad)
+                        .abs().max().item(), 1e-5)
+        self.assertLess((model.bn.running_var - tiled.bn.running_var)
+                        .abs().max().item(), 1e-5)
+        self.assertLess(tiled.peak_memory(5, 3), model.peak_memory(5, 3))
+
+    def test_dropout_gradients(self):
+        import copy
+        import torch
+        from torch.autograd import Variable
+        from reid.models.embedding import RandomWalkEmbed
+
+        model = RandomWalkEmbed(feat_num=16, num_classes=2, drop_ratio=0.5,
+                                tile_size=2)
+        reference = copy.deepcopy(model)
+        x = torch.randn(8, 16)
+        weight = Variable(torch.randn(5, 3, 2))
+
+        # Checkpointed tiles, recomputed in the backward pass
+        probe_x = Variable(x[:5].clone(), requires_grad=True)
+        gallery_x = Variable(x[5:].clone(), requires_grad=True)
+        torch.manual_seed(0)
+        (model(probe_x, gallery_x) * weight).sum().backward()
+
+        # The same tiles and dropout draws, kept for the backward pass
+        ref_probe_x = Variable(x[:5].clone(), requires_grad=True)
+        ref_gallery_x = Variable(x[5:].clone(), requires_grad=True)
+        torch.manual_seed(0)
+        mean, var = reference._grid_moments(ref_probe_x, ref_gallery_x)
+        scale = reference.bn.weight / torch.sqrt(var + reference.bn.eps)
+        shift = reference.bn.bias - mean * scale
+        out = torch.cat([reference._tile_scores(ref_probe_x[i:i + 2],
+                                                ref_gallery_x, scale, shift)
+                         for i in range(0, 5, 2)], 0)
+        (out * weight).sum().backward()
+
+        self.assertLess((probe_x.grad - ref_probe_x.grad)
+                        .abs().max().item(), 1e-5)
+        self.assertLess((gallery_x.grad - ref_gallery_x.grad)
+                        .abs().max().item(), 1e-5)
+        self.assertLess((model.classifier.weight.grad -
+                         reference.classifier.weight.grad)
+                        .abs().max().item(), 1e-5)
+
+
+class TestGroupedRandomWalkEmbed(TestCase):
+    def test_same_as_heads(self):
+        import torch
+        from reid.models.embedding import (RandomWalkEmbed,
+                                           GroupedRandomWalkEmbed)
+
+        heads = [RandomWalkEmbed(feat_num=4, num_classes=2, drop_ratio=0)
+                 for _ in range(3)]
+        for head in heads:
+            head.bn.running_mean.uniform_(0, 1)
+            head.classifier.weight.data.normal_()
+        model = GroupedRandomWalkEmbed.from_embeds(heads)
+        probe_x, gallery_x = torch.randn(5, 12), torch.randn(6, 12)
+        for training in (True, False):
+            model.train(training)
+            scores = model(probe_x, gallery_x)
+            self.assertEquals(scores.size(), (3, 5, 6, 2))
+            for i, head in enumerate(heads):
+                head.train(training)
+                expected = head(probe_x[:, i * 4:(i + 1) * 4].contiguous(),
+                                gallery_x[:, i * 4:(i + 1) * 4].contiguous())
+                self.assertLess((scores[i] - expected).abs().max().item(),
+                                1e-4)
+
+    def test_convert_state_dict(self):
+        import torch
+        from collections import OrderedDict
+        from reid.models.embedding import (RandomWalkEmbed,
+                                           GroupedRandomWalkEmbed)
+
+        heads = [RandomWalkEmbed(feat_num=4, num_classes=2) for _ in range(2)]
+        state_dict = OrderedDict()
+        for i, head in enumerate(heads):
+            for key, value in head.state_dict().items():
+                state_dict['embed_{}.{}'.format(i, key)] = value
+        state_dict['base.weight'] = torch.zeros(1)
+        converted = GroupedRandomWalkEmbed.convert_state_dict(state_dict, 2)
+        self.assertTrue('base.weight' in converted)
+        self.assertFalse(any(key.startswith('embed_') for key in converted))
+        model = GroupedRandomWalkEmbed(2, feat_num=4, num_classes=2)
+        model.load_state_dict(OrderedDict(
+            (key[len('embed.'):], value) for key, value in converted.items()
+            if key.startswith('embed.')))
+        self.assertTrue(model.classifier_weight.data[1].equal(
+            heads[1].classifier.weight.data))
@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+
+class TestRandomWalk(TestCase):
+    def test_solvers(self):
+        import torch
+        import torch.nn.functional as F
+        from reid.models.multi_branch import random_walk
+
+        alpha = 0.2
+        affinity = F.softmax(torch.randn(3, 6, 6), dim=2)
+        scores = torch.randn(3, 4, 6, 2)
+        # Per-query explicit inverse
+        expected = []
+        for A, p_g_score in zip(affinity, scores):
+            A = (1 - alpha) * torch.inverse(torch.eye(6) - alpha * A)
+            expected.append(torch.matmul(p_g_score.permute(2, 0, 1),
+                                         A.transpose(0, 1)).permute(1, 2, 0))
+        expected = torch.stack(expected, 0)
+        for solver in ('solve', 'series', 'inverse'):
+            out = random_walk(affinity, scores, alpha, solver=solver)
+            self.assertEquals(out.size(), scores.size())
+            self.assertLess((out - expected).abs().max(), 1e-5)
+        out = random_walk(affinity[0], scores[0], alpha)
+        self.assertLess((out - expected[0]).abs().max(), 1e-5)
+        with self.assertRaises(ValueError):
+            random_walk(affinity, scores, alpha, solver='lstsq')
+
+
+class TestRandomWalkNetGrp(TestCase):
+    def test_load_baseline_checkpoint(self):
+        import torch
+        from collections import OrderedDict
+        from torch import nn
+        from reid.models.embedding import (RandomWalkEmbed,
+                                           GroupedRandomWalkEmbed)
+        from reid.models.multi_branch import RandomWalkNetGrp
+
+        # Baseline checkpoints hold one embed_<i> head per group
+        base = nn.Linear(3, 8)
+        heads = [RandomWalkEmbed(feat_num=4, num_classes=2) for _ in range(2)]
+        state_dict = OrderedDict(
+            ('module.base.' + key, value)
+            for key, value in base.state_dict().items())
+        for i, head in enumerate(heads):
+            head.bn.running_mean.uniform_(0, 1)
+            head.classifier.weight.data.normal_()
+            for key, value in head.state_dict().items():
+                state_dict['module.embed_{}.{}'.format(i, key)] = value
+
+        model = RandomWalkNetGrp(
+            base_model=nn.Linear(3, 8),
+            embed_model=GroupedRandomWalkEmbed(2, feat_num=4, num_classes=2))
+        nn.DataParallel(model).load_state_dict(state_dict)
+        self.assertTrue(model.base.weight.data.equal(base.weight.data))
+        self.assertTrue(model.embed.classifier_weight.data[1].equal(
+            heads[1].classifier.weight.data))
+        self.assertTrue(model.embed.bn.running_mean[4:].equal(
+            heads[1].bn.running_mean))
+
+    def test_list_of_heads(self):
+        import torch
+        from torch import nn
+        from torch.autograd import Variable
+        from reid.models.embedding import (RandomWalkEmbed,
+                                           GroupedRandomWalkEmbed)
+        from reid.models.multi_branch import RandomWalkNetGrp
+
+        heads = [RandomWalkEmbed(feat_num=4, num_classes=2) for _ in range(2)]
+        model = RandomWalkNetGrp(base_model=nn.Linear(3, 8),
+                                 embed_model=heads)
+        self.assertIsInstance(model.embed, GroupedRandomWalkEmbed)
+        self.assertEqual(model.embed.num_groups, 2)
+        self.assertTrue(model.embed.classifier_weight.data[1].equal(
+            heads[1].classifier.weight.data))
+        model.eval()
+        # 2 groups of 2 probes and 6 gallery samples against the gallery
+        self.assertEqual(model(Variable(torch.randn(8, 3))).size(), (96, 2))
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from unittest import TestCase
+
+import numpy as np
+
+
+def dense_re_ranking(q_g_dist, q_q_dist, g_g_dist, k1, k2, lambda_value):
+    # Reference algorithm on dense matrices of squared distances
+    original_dist = np.concatenate(
+        [np.concatenate([q_q_dist, q_g_dist], axis=1),
+         np.concatenate([q_g_dist.T, g_g_dist], axis=1)], axis=0)
+    original_dist = np.maximum(original_dist, 0)
+    original_dist = np.transpose(original_dist / np.max(original_dist, axis=0))
+    V = np.zeros_like(original_dist)
+    initial_rank = np.argsort(original_dist, kind='stable')
+    query_num = q_g_dist.shape[0]
+    all_num = original_dist.shape[0]
+
+    for i in range(all_num):
+        forward_k_neigh_index = initial_rank[i, :k1 + 1]
+        backward_k_neigh_index = initial_rank[forward_k_neigh_index, :k1 + 1]
+        fi = np.where(backward_k_neigh_index == i)[0]
+        k_reciprocal_index = forward_k_neigh_index[fi]
+        k_reciprocal_expansion_index = k_reciprocal_index
+        for candidate in k_reciprocal_index:
+            half = int(np.around(k1 / 2.)) + 1
+            candidate_forward = initial_rank[candidate, :half]
+            candidate_backward = initial_rank[candidate_forward, :half]
+            fi_candidate = np.where(candidate_backward == candidate)[0]
+            candidate_index = candidate_forward[fi_candidate]
+            if len(np.intersect1d(candidate_index, k_reciprocal_index)) > \
+                    2. / 3 * len(candidate_index):
+                k_reciprocal_expansion_index = np.append(
+                    k_reciprocal_expansion_index, candidate_index)
+        k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
+        weight = np.exp(-original_dist[i, k_reciprocal_expansion_index])
+        V[i, k_reciprocal_expansion_index] = weight / np.sum(weight)
+    original_dist = original_dist[:query_num]
+    if k2 != 1:
+        V = np.array([np.mean(V[initial_rank[i, :k2]], axis=0)
+                      for i in range(all_num)])
+
+    jaccard_dist = np.zeros_like(original_dist)
+    for i in range(query_num):
+        temp_min = np.minimum(V[i][np.newaxis], V).sum(axis=1)
+        jaccard_dist[i] = 1 - temp_min / (2 - temp_min)
+    final_dist = jaccard_dist * (1 - lambda_value) + \
+        original_dist * lambda_value
+    return final_dist[:, query_num:]
+
+
+class TestKReciprocalRerank(TestCase):
+    def test_dense_reference(self):
+        import torch
+        from reid.reranking import k_reciprocal_rerank
+
+        rng = np.random.RandomState(0)
+        # Clustered features so that the neighborhoods are meaningful
+        centers = rng.randn(8, 16)
+        x = centers[rng.randint(8, size=60)] + 0.3 * rng.randn(60, 16)
+        x = x.astype(np.float32)
+        features = OrderedDict((str(i), torch.from_numpy(x[i]))
+                               for i in range(60))
+        query = [(str(i), 0, 0) for i in range(15)]
+        gallery = [(str(i), 0, 1) for i in range(15, 60)]
+        x = x.astype(np.float64)
+        dist = (x ** 2).sum(1)[:, np.newaxis] + (x ** 2).sum(1) - \
+            2 * x.dot(x.T)
+        expected = dense_re_ranking(dist[:15, 15:], dist[:15, :15],
+                                    dist[15:, 15:], 6, 3, 0.3)
+        for memory_budget in (None, 1000):
+            distmat = k_reciprocal_rerank(features, query, gallery, k1=6,
+                                          k2=3, block_size=7,
+                                          memory_budget=memory_budget)
+            self.assertEqual(distmat.shape, (15, 45))
+            self.assertTrue(np.allclose(distmat, expected, atol=1e-4))
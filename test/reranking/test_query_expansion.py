@@ -0,0 +1,32 @@
+from collections import OrderedDict
+from unittest import TestCase
+
+import numpy as np
+
+
+class TestQueryExpansion(TestCase):
+    def test_per_query(self):
+        import torch
+        from reid.reranking import query_expansion
+
+        rng = np.random.RandomState(0)
+        x = rng.randn(30, 8).astype(np.float32)
+        features = OrderedDict((str(i), torch.from_numpy(x[i]))
+                               for i in range(30))
+        query = [(str(i), 0, 0) for i in range(10)]
+        gallery = [(str(i), 0, 1) for i in range(10, 30)]
+        for alpha in (0, 3):
+            expanded = query_expansion(features, query, gallery, topk=4,
+                                       alpha=alpha, block_size=3)
+            for i in range(10):
+                dist = ((x[10:] - x[i]) ** 2).sum(1)
+                neighbours = x[10:][np.argsort(dist)[:4]]
+                sim = neighbours.dot(x[i]) / np.linalg.norm(x[i]) / \
+                    np.linalg.norm(neighbours, axis=1)
+                weights = np.maximum(sim, 0) ** alpha
+                expected = (x[i] + weights.dot(neighbours)) / \
+                    (1 + weights.sum())
+                self.assertTrue(np.allclose(expanded[str(i)].numpy(),
+                                            expected, atol=1e-5))
+            for i in range(10, 30):
+                self.assertTrue(expanded[str(i)] is features[str(i)])
@@ -0,0 +1,309 @@
+from collections import OrderedDict
+from unittest import TestCase
+
+import numpy as np
+
+
+class TestBlockedPairwiseDistance(TestCase):
+    def setUp(self):
+        import torch
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(7, 5).astype(np.float32)
+        self.y = rng.rand(11, 5).astype(np.float32)
+        self.features = OrderedDict()
+        for i, f in enumerate(self.x):
+            self.features['q%d' % i] = torch.from_numpy(f)
+        for i, f in enumerate(self.y):
+            self.features['g%d' % i] = torch.from_numpy(f)
+        self.query = [('q%d' % i, 0, 0) for i in range(len(self.x))]
+        self.gallery = [('g%d' % i, 0, 0) for i in range(len(self.y))]
+        self.expected = ((self.x[:, np.newaxis] - self.y) ** 2).sum(2)
+
+    def test_full_matrix(self):
+        from reid.evaluators import blocked_pairwise_distance
+        dist = blocked_pairwise_distance(self.features, self.query,
+                                         self.gallery, block_size=3)
+        self.assertEqual(dist.shape, (7, 11))
+        self.assertTrue(np.allclose(dist, self.expected, atol=1e-5))
+
+    def test_topk(self):
+        from reid.evaluators import blocked_pairwise_distance
+        dist, indices = blocked_pairwise_distance(
+            self.features, self.query, self.gallery, block_size=3, topk=4)
+        expected = np.argsort(self.expected, axis=1)[:, :4]
+        self.assertTrue(np.all(indices == expected))
+        self.assertTrue(np.allclose(
+            dist, np.sort(self.expected, axis=1)[:, :4], atol=1e-5))
+
+    def test_quantized_modes(self):
+        from reid.evaluators import quantized_pairwise_distance
+        for mode, atol in (('float32', 1e-5), ('float16', 1e-2),
+                           ('int8', 5e-2)):
+            dist = quantized_pairwise_distance(
+                self.features, self.query, self.gallery, mode=mode,
+                block_size=3)
+            self.assertEqual(dist.shape, (7, 11))
+            self.assertTrue(np.allclose(dist, self.expected, atol=atol))
+
+
+class TestMergeTwoStageDistances(TestCase):
+    def merge_per_element(self, distmat, rank_indices, embeddings,
+                          rerank_topk):
+        for k, embed in enumerate(embeddings):
+            i, j = k // rerank_topk, k % rerank_topk
+            distmat[i, rank_indices[i, j]] = embed
+        for i, indices in enumerate(rank_indices):
+            bar = max(distmat[i][indices[:rerank_topk]])
+            gap = max(bar + 1. - distmat[i, indices[rerank_topk]], 0)
+            if gap > 0:
+                distmat[i][indices[rerank_topk:]] += gap
+        return distmat
+
+    def test_bit_identical(self):
+        from reid.evaluators import merge_two_stage_distances
+        rng = np.random.RandomState(0)
+        for rerank_topk in (1, 5, 19):
+            distmat = (rng.rand(10, 20) * 100).astype(np.float32)
+            rank_indices = np.argsort(distmat, axis=1)
+            embeddings = rng.rand(10 * rerank_topk).astype(np.float32)
+            expected = self.merge_per_element(distmat.copy(), rank_indices,
+                                              embeddings, rerank_topk)
+            merged = merge_two_stage_distances(distmat.copy(), rank_indices,
+                                               embeddings, rerank_topk)
+            self.assertEqual(merged.tobytes(), expected.tobytes())
+
+
+class TestRandomWalkScoreCache(TestCase):
+    def test_same_scores(self):
+        import torch
+        from torch import nn
+        from reid.evaluators import compute_random_walk_batch
+        from reid.models.embedding import RandomWalkEmbed
+        from reid.utils.cache import PairwiseScoreCache
+
+        heads = nn.ModuleList([RandomWalkEmbed(feat_num=4, num_classes=2)
+                               for _ in range(2)])
+        for head in heads:
+            head.bn.running_mean.uniform_(0, 1)
+            head.classifier.weight.data.normal_()
+            head.eval()
+        rng = np.random.RandomState(0)
+        gallery = torch.randn(10, 8)
+        batches = []
+        for _ in range(4):
+            # Overlapping top-5 gallery samples of 3 probes
+            indices = [rng.choice(10, 5, replace=False).tolist()
+                       for _ in range(3)]
+            batches.append((torch.randn(3, 8), indices, torch.stack(
+                [gallery[torch.LongTensor(row)] for row in indices])))
+        expected = [compute_random_walk_batch(heads, probe, gallery_feature,
+                                              0.3).data
+                    for probe, _, gallery_feature in batches]
+        # Large enough for everything, then small enough to evict rows
+        misses = []
+        for max_bytes in (1 << 20, 1000):
+            cache = PairwiseScoreCache(max_bytes)
+            for _ in range(2):
+                for (probe, indices, gallery_feature), score in zip(
+                        batches, expected):
+                    cached = compute_random_walk_batch(
+                        heads, probe, gallery_feature, 0.3,
+                        gallery_indices=indices, score_cache=cache).data
+                    self.assertLess((cached - score).abs().max(), 1e-5)
+            self.assertGreater(cache.hits, 0)
+            self.assertLessEqual(cache.num_bytes, max_bytes)
+            misses.append(cache.misses)
+        # Evicted pairs were scored again
+        self.assertGreater(misses[1], misses[0])
+
+
+class TestRandomWalkSweep(TestCase):
+    def test_matches_inverse(self):
+        from reid.evaluators import random_walk_sweep
+        rng = np.random.RandomState(0)
+        logits = rng.randn(4, 6, 6)
+        affinity = np.exp(logits) / np.exp(logits).sum(2, keepdims=True)
+        scores = rng.randn(4, 3, 6, 2).astype(np.float32)
+        alphas = [0, 0.1, 0.5, 0.9]
+        outputs = random_walk_sweep(affinity, scores, alphas)
+        self.assertEqual(outputs.shape, (4,) + scores.shape)
+        for alpha, output in zip(alphas, outputs):
+            for A, score, out in zip(affinity, scores, output):
+                P = (1 - alpha) * np.linalg.inv(np.eye(6) - alpha * A)
+                expected = np.einsum('kl,nlc->nkc', P, score)
+                self.assertTrue(np.allclose(out, expected, atol=1e-5))
+
+
+class TestAsModels(TestCase):
+    def test_module_list(self):
+        from torch import nn
+        from reid.evaluators import _as_models
+        from reid.models.embedding import RandomWalkEmbed
+
+        heads = [RandomWalkEmbed(feat_num=4, num_classes=2) for _ in range(2)]
+        for model in (heads, tuple(heads), nn.ModuleList(heads)):
+            models = _as_models(model)
+            self.assertEqual(len(models), 2)
+            self.assertTrue(all(a is b for a, b in zip(models, heads)))
+        self.assertEqual(_as_models(heads[0]), [heads[0]])
+
+
+class TestConfidentQueries(TestCase):
+    def test_margin_and_ratio(self):
+        from reid.evaluators import confident_queries
+        distmat = np.array([[1., 5., 6.],
+                            [2., 2.5, 9.],
+                            [4., 3., 7.]])
+        rank_indices = np.argsort(distmat, axis=1)
+        confident, top1, top2 = confident_queries(distmat, rank_indices,
+                                                  margin=2)
+        self.assertEqual(confident.tolist(), [True, False, False])
+        self.assertEqual(top1.tolist(), [1., 2., 3.])
+        self.assertEqual(top2.tolist(), [5., 2.5, 4.])
+        confident, _, _ = confident_queries(distmat, rank_indices, ratio=0.8)
+        self.assertEqual(confident.tolist(), [True, True, True])
+        confident, _, _ = confident_queries(distmat, rank_indices, ratio=0.75)
+        self.assertEqual(confident.tolist(), [True, False, True])
+        self.assertFalse(confident_queries(distmat, rank_indices)[0].any())
+
+
+class TestPruneJunkCandidates(TestCase):
+    def test_prune(self):
+        from reid.evaluators import prune_junk_candidates
+        query = [('q0', 1, 0), ('q1', 2, 1)]
+        gallery = [('g0', 1, 0), ('g1', 1, 1), ('g2', 2, 1), ('g3', 3, 0),
+                   ('g4', 1, 0), ('g5', 2, 0)]
+        rank_indices = np.array([[0, 4, 1, 2, 3, 5],
+                                 [3, 2, 5, 0, 1, 4]])
+        pruned, num_junk = prune_junk_candidates(rank_indices, query,
+                                                 gallery, 2)
+        self.assertEqual(num_junk, 3)
+        self.assertEqual(pruned.tolist(), [[1, 2, 0, 4, 3, 5],
+                                           [3, 5, 2, 0, 1, 4]])
+
+
+class TestGridEmbeddingDistance(TestCase):
+    def test_grouped_model(self):
+        import torch
+        from reid.evaluators import grid_embedding_distance
+        from reid.models.embedding import (RandomWalkEmbed,
+                                           GroupedRandomWalkEmbed)
+
+        heads = [RandomWalkEmbed(feat_num=4, num_classes=2) for _ in range(2)]
+        for head in heads:
+            head.bn.running_mean.uniform_(0, 1)
+            head.classifier.weight.data.normal_()
+            head.eval()
+        model = GroupedRandomWalkEmbed.from_embeds(heads)
+        x = torch.randn(8, 8)
+        features = OrderedDict((str(i), x[i]) for i in range(8))
+        query = [(str(i), 0, 0) for i in range(3)]
+        gallery = [(str(i), 0, 1) for i in range(3, 8)]
+        dist = grid_embedding_distance(model, features, query, gallery,
+                                       embed_dist_fn=lambda s: s[:, 0],
+                                       block_size=2)
+        self.assertEqual(dist.shape, (3, 5))
+        expected = sum(head(x[:3, 4 * g:4 * (g + 1)].contiguous(),
+                            x[3:, 4 * g:4 * (g + 1)].contiguous())[..., 0]
+                       for g, head in enumerate(heads)) / 2
+        self.assertTrue(np.allclose(dist, expected.data.numpy(), atol=1e-4))
+
+
+class TestExtractEmbeddings(TestCase):
+    def test_batches(self):
+        import torch
+        from torch.autograd import Variable
+        from reid.evaluators import extract_embeddings
+        from reid.models.embedding import RandomWalkEmbed
+
+        model = RandomWalkEmbed(feat_num=4, num_classes=2)
+        model.bn.running_mean.uniform_(0, 1)
+        model.classifier.weight.data.normal_()
+        x = torch.randn(12, 4)
+        features = OrderedDict((str(i), x[i]) for i in range(12))
+        query = [(str(i), 0, 0) for i in range(7)]
+        rng = np.random.RandomState(0)
+        topk_gallery = [[(str(j), 0, 1) for j in rng.choice(range(7, 12), 4,
+                                                            replace=False)]
+                        for _ in query]
+        # The last batch only holds one query
+        scores = extract_embeddings(model, features, 0, query=query,
+                                    topk_gallery=topk_gallery, rerank_topk=4,
+                                    batch_size=3)
+        self.assertEqual(scores.size(), (7 * 4, 2))
+        scores = scores.data.view(7, 4, 2)
+        for q, (f, _, _) in enumerate(query):
+            gallery = torch.stack([features[g] for g, _, _ in topk_gallery[q]])
+            expected = model(Variable(features[f].view(1, -1)),
+                             Variable(gallery)).data.view(4, 2)
+            self.assertLess((scores[q] - expected).abs().max(), 1e-5)
+
+
+class TestEvaluator(TestCase):
+    def test_memory_budget(self):
+        import os
+        import torch
+        from torch import nn
+        import reid.evaluators as evaluators
+
+        torch.manual_seed(0)
+        model = nn.Linear(6, 4)
+        imgs = torch.randn(10, 6)
+        fnames = [str(i) for i in range(10)]
+        pids = [i % 3 for i in range(10)]
+        data_loader = [(imgs[i:i + 4], fnames[i:i + 4], pids[i:i + 4], None)
+                       for i in range(0, 10, 4)]
+        query = [(fnames[i], pids[i], 0) for i in range(4)]
+        gallery = [(fnames[i], pids[i], 1) for i in range(4, 10)]
+        evaluator = evaluators.Evaluator(model)
+        expected = evaluator.evaluate(data_loader, query, gallery)
+
+        captured = []
+        evaluate_all = evaluators.evaluate_all
+
+        def capture(distmat, **kwargs):
+            captured.append((type(distmat), distmat.filename))
+            return evaluate_all(distmat, **kwargs)
+
+        evaluators.evaluate_all = capture
+        try:
+            score = evaluator.evaluate(data_loader, query, gallery,
+                                       memory_budget=1000)
+        finally:
+            evaluators.evaluate_all = evaluate_all
+        self.assertAlmostEqual(score, expected)
+        # The output went to a temporary memmap, removed afterwards
+        self.assertIs(captured[0][0], np.memmap)
+        self.assertFalse(os.path.exists(captured[0][1]))
+
+
+class TestIndexPairwiseDistance(TestCase):
+    def test_stale_index(self):
+        import torch
+        from reid.evaluators import (index_pairwise_distance,
+                                     pairwise_distance)
+        from reid.index import IVFIndex
+
+        x = torch.randn(12, 5)
+        features = OrderedDict((str(i), x[i]) for i in range(12))
+        query = [(str(i), 0, 0) for i in range(3)]
+        index = IVFIndex(num_lists=2, num_probes=2)
+        # Filled with a larger gallery first, then reused for a smaller one
+        for gallery in ([(str(i), 0, 1) for i in range(3, 12)],
+                        [(str(i), 0, 1) for i in range(6, 12)]):
+            distmat = index_pairwise_distance(index, features, query, gallery,
+                                              topk=len(gallery))
+            self.assertEqual(len(index), len(gallery))
+            expected = pairwise_distance(features, query, gallery).numpy()
+            self.assertTrue(np.allclose(distmat, expected, atol=1e-4))
+
+
+class TestCascadeEvaluator(TestCase):
+    def test_full_gallery_options(self):
+        from reid.evaluators import CascadeEvaluator
+
+        evaluator = CascadeEvaluator(None, None)
+        for kwargs in (dict(random_walk=True), dict(prune_junk=True),
+                       dict(exit_margin=0.1), dict(exit_ratio=0.5)):
+            with self.assertRaises(ValueError):
+                evaluator.evaluate(None, [], [], rerank_topk=None, **kwargs)
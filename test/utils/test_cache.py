@@ -0,0 +1,69 @@
+from unittest import TestCase
+
+import numpy as np
+
+from reid.utils.cache import PairwiseScoreCache
+
+
+class TestPairwiseScoreCache(TestCase):
+    def test_hits_and_misses(self):
+        cache = PairwiseScoreCache()
+        found, scores = cache.lookup(0, [1, 3], [1, 3])
+        self.assertFalse(found.any())
+        self.assertIsNone(scores)
+        cache.update(0, [3, 1], [1, 3], np.asarray([[3, 1], [1, 3]],
+                                                   dtype=np.float32))
+        found, scores = cache.lookup(0, [1, 3, 5], [1, 3])
+        self.assertTrue(np.array_equal(
+            found, [[False, True], [True, False], [False, False]]))
+        self.assertTrue(np.array_equal(scores, [[1, 3], [3, 1]]))
+        self.assertEqual((cache.hits, cache.misses), (2, 8))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue((0, 1, 3) in cache)
+        self.assertFalse((1, 1, 3) in cache)
+
+    def test_merge_rows(self):
+        cache = PairwiseScoreCache()
+        rng = np.random.RandomState(0)
+        expected = rng.rand(10, 10, 2, 3).astype(np.float32)
+        for _ in range(3):
+            a, b = rng.randint(10, size=(2, 30))
+            cache.update(1, a, b, expected[a, b])
+        rows = rng.permutation(10)[:6]
+        found, scores = cache.lookup(1, rows, rows)
+        a, b = np.nonzero(found)
+        self.assertTrue(np.array_equal(scores, expected[rows[a], rows[b]]))
+        self.assertEqual(found.sum(), sum((1, x, y) in cache for x in rows
+                                          for y in rows))
+        self.assertFalse(any((0, x, y) in cache for x in rows for y in rows))
+
+    def test_lru_eviction(self):
+        score = np.zeros((1, 2), dtype=np.float32)
+        cache = PairwiseScoreCache()
+        cache.update(0, [0], [0], score)
+        row_bytes = cache.num_bytes
+        cache = PairwiseScoreCache(max_bytes=2 * row_bytes)
+        cache.update(0, [0], [0], score)
+        cache.update(0, [1], [0], score)
+        cache.lookup(0, [0], [0])
+        cache.update(0, [2], [0], score)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue((0, 0, 0) in cache and (0, 2, 0) in cache)
+        self.assertFalse((0, 1, 0) in cache)
+        self.assertEqual(cache.num_bytes, 2 * row_bytes)
+
+    def test_retained_memory(self):
+        rng = np.random.RandomState(0)
+        cache = PairwiseScoreCache(max_bytes=100000)
+        a, b = rng.randint(500, size=(2, 20000))
+        cache.update(0, a, b, rng.rand(20000, 2, 2).astype(np.float32))
+        a, b = rng.randint(1000, size=(2, 20000))
+        cache.update(0, a, b, rng.rand(20000, 2, 2).astype(np.float32))
+        retained = 0
+        for cols, scores in cache._rows.values():
+            for x in (cols, scores):
+                # Views would keep their whole base alive
+                self.assertIsNone(x.base)
+                retained += x.nbytes
+        self.assertGreater(retained, 0)
+        self.assertLessEqual(retained, cache.max_bytes)